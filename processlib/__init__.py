@@ -4,5 +4,10 @@ from django.utils.module_loading import autodiscover_modules
 def autodiscover_flows():
     autodiscover_modules("flows")
 
+    from .flow import get_flows
+
+    for label, flow in get_flows():
+        flow.compile()
+
 
 __all__ = ["autodiscover_flows"]
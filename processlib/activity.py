@@ -1,18 +1,75 @@
+import asyncio
 import logging
+from collections import OrderedDict
 
-from django.db import transaction
+from asgiref.sync import async_to_sync, sync_to_async
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.db.models import BooleanField, ExpressionWrapper, Q, Value
+from django.db.models.functions import Coalesce
 from django.http import HttpResponseRedirect
 from django.urls import reverse
 from django.utils import timezone
 
 from processlib.assignment import inherit
-from processlib.tasks import run_async_activity
+from processlib.instrumentation import (
+    instrument_batch,
+    instrument_class,
+    send_processes_started,
+)
+from processlib.tasks import batch_async_dispatch, dispatch_async_activity
+from processlib.tracking import track_instances, track_processes
 
 
 logger = logging.getLogger(__name__)
 
 
+class Transition(object):
+    """
+    State shared by all activities taking part in a single transition, i.e.
+    everything that happens because one activity was finished.
+
+    It holds the process object all activities share and an identity map of
+    the activity instances written during the transition, so those rows are
+    not read again. queries_saved only counts the lookups of open wait
+    instances answered from the map, not the reads of the shared process.
+    """
+
+    def __init__(self, process):
+        self.process = process
+        self.instances = {}
+        self.queries_saved = 0
+
+        # pks of the wait instances written during this transition
+        self._joins = []
+
+    def add(self, instance):
+        self.instances[instance.pk] = instance
+
+    def add_join(self, instance):
+        self.add(instance)
+        if instance.pk not in self._joins:
+            self._joins.append(instance.pk)
+
+    def get_open_join(self, activity_name):
+        for pk in self._joins:
+            instance = self.instances[pk]
+            if (
+                instance.activity_name == activity_name
+                and instance.status != instance.STATUS_DONE
+            ):
+                return instance
+        return None
+
+
 class Activity(object):
+    transition = None
+    last_transition = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        instrument_class(cls)
+
     def __init__(
         self,
         flow,
@@ -62,6 +119,19 @@ class Activity(object):
     def instantiate(
         self, predecessor=None, instance_kwargs=None, request=None, **kwargs
     ):
+        self.prepare_instance(
+            predecessor=predecessor, instance_kwargs=instance_kwargs, request=request
+        )
+        self.instance.save()
+        if predecessor:
+            self.instance.predecessors.add(predecessor.instance)
+        self.after_instantiate()
+        track_instances([self.instance])
+
+    def prepare_instance(self, predecessor=None, instance_kwargs=None, request=None):
+        """
+        Build the (unsaved) activity instance, including its assignment.
+        """
         assert not self.instance
         instance_kwargs = instance_kwargs or {}
 
@@ -78,16 +148,21 @@ class Activity(object):
             instance_kwargs["assigned_group"] = group
 
         self.instance = self.flow.activity_model(
-            process=self.process, activity_name=self.name, **(instance_kwargs or {})
+            process=self.process, activity_name=self.name, **instance_kwargs
         )
-        self.instance.save()
-        if predecessor:
-            self.instance.predecessors.add(predecessor.instance)
+
+    def after_instantiate(self):
+        """
+        Called once the instance has been saved and linked to its predecessor.
+        Activities that continue on their own (e.g. State) do so here.
+        """
+        pass
 
     def assign_to(self, user, group):
         self.instance.assigned_user = user
         self.instance.assigned_group = group
         self.instance.save()
+        track_instances([self.instance])
 
     def start(self, **kwargs):
         assert self.instance.status in (
@@ -98,6 +173,34 @@ class Activity(object):
             self.instance.started_at = timezone.now()
         self.instance.status = self.instance.STATUS_STARTED
 
+    def claim(self):
+        """
+        Atomically move the scheduled instance to started. Returns False if it
+        is not scheduled (anymore), e.g. because another worker claimed it, or
+        not due yet.
+        """
+        now = timezone.now()
+        claimed = (
+            self.flow.activity_model._default_manager.filter(
+                Q(due_at__isnull=True) | Q(due_at__lte=now),
+                pk=self.instance.pk,
+                status=self.instance.STATUS_SCHEDULED,
+            ).update(
+                status=self.instance.STATUS_STARTED,
+                started_at=Coalesce("started_at", Value(now)),
+                due_at=None,
+                dispatched_at=None,
+            )
+            == 1
+        )
+        if claimed:
+            self.instance.status = self.instance.STATUS_STARTED
+            self.instance.due_at = None
+            self.instance.dispatched_at = None
+            if not self.instance.started_at:
+                self.instance.started_at = now
+        return claimed
+
     def finish(self, **kwargs):
         assert self.instance.status == self.instance.STATUS_STARTED
         if not self.instance.finished_at:
@@ -105,16 +208,28 @@ class Activity(object):
         self.instance.status = self.instance.STATUS_DONE
         self.instance.modified_by = kwargs.get("user", None)
         self.instance.save()
+        track_instances([self.instance])
         self._instantiate_next_activities()
 
     def cancel(self, **kwargs):
         assert self.instance.status in (
             self.instance.STATUS_INSTANTIATED,
+            self.instance.STATUS_SCHEDULED,
             self.instance.STATUS_ERROR,
+            self.instance.STATUS_DEAD_LETTER,
         )
+        if self.instance.status == self.instance.STATUS_SCHEDULED:
+            # a worker may claim the instance at the same time
+            canceled = self.flow.activity_model._default_manager.filter(
+                pk=self.instance.pk, status=self.instance.STATUS_SCHEDULED
+            ).update(status=self.instance.STATUS_CANCELED)
+            assert canceled, "The scheduled instance was started in the meantime"
         self.instance.status = self.instance.STATUS_CANCELED
+        self.instance.due_at = None
+        self.instance.dispatched_at = None
         self.instance.modified_by = kwargs.get("user", None)
         self.instance.save()
+        track_instances([self.instance])
 
     def undo(self, **kwargs):
         assert self.instance.status == self.instance.STATUS_DONE
@@ -122,6 +237,7 @@ class Activity(object):
         self.instance.status = self.instance.STATUS_INSTANTIATED
         self.instance.modified_by = kwargs.get("user", None)
         self.instance.save()
+        track_instances([self.instance])
 
         undo_callback = getattr(self.process, "undo_{}".format(self.name), None)
         if undo_callback is not None:
@@ -133,21 +249,222 @@ class Activity(object):
         self.instance.finished_at = timezone.now()
         self.instance.modified_by = kwargs.get("user", None)
         self.instance.save()
+        track_instances([self.instance])
 
     def _get_next_activities(self):
-        for activity_name in self.flow._out_edges[self.name]:
-            activity = self.flow._get_activity_by_name(
+        # conditional activities are built to evaluate skip_if, keep them around
+        # so they are not built a second time if they are not skipped
+        checked = {}
+
+        def should_skip(activity_name):
+            activity = checked[activity_name] = self.flow._get_activity_by_name(
                 process=self.process, activity_name=activity_name
             )
-            if activity.should_skip():
-                for later_activity in activity._get_next_activities():
-                    yield later_activity
-            else:
-                yield activity
+            return activity.should_skip()
+
+        for activity_name in self.flow.compile().get_next_activity_names(
+            self.name, should_skip
+        ):
+            activity = checked.pop(activity_name, None)
+            if activity is None:
+                activity = self.flow._get_activity_by_name(
+                    process=self.process, activity_name=activity_name
+                )
+            yield activity
 
     def _instantiate_next_activities(self):
-        for activity in self._get_next_activities():
-            activity.instantiate(predecessor=self)
+        transition = self.transition
+        if transition is None:
+            transition = Transition(self.process)
+        transition.add(self.instance)
+
+        activities = list(self._get_next_activities())
+        for activity in activities:
+            activity.transition = transition
+
+        if self.transition is not None:
+            bulk_instantiate((activity, self) for activity in activities)
+            return
+
+        self.transition = transition
+        try:
+            with batch_async_dispatch():
+                bulk_instantiate((activity, self) for activity in activities)
+        finally:
+            self.transition = None
+        self.last_transition = transition
+        logger.debug(
+            "Transition from %s.%s reused open joins %d times",
+            self.flow.label,
+            self.name,
+            transition.queries_saved,
+        )
+
+
+instrument_class(Activity)
+
+
+def _supports_bulk_instantiate(activity):
+    return (
+        type(activity).instantiate is Activity.instantiate
+        # django can't bulk create multi-table inherited models
+        and not activity.flow.activity_model._meta.parents
+    )
+
+
+def create_predecessor_links(activity_model, links):
+    """
+    Insert (instance, predecessor instance) pairs into the predecessors
+    through table with a single query, without checking for existing rows.
+    """
+    if not links:
+        return
+    field = activity_model._meta.get_field("predecessors")
+    through = field.remote_field.through
+    from_attname = through._meta.get_field(field.m2m_field_name()).attname
+    to_attname = through._meta.get_field(field.m2m_reverse_field_name()).attname
+    through._default_manager.bulk_create(
+        [
+            through(**{from_attname: instance.pk, to_attname: predecessor.pk})
+            for instance, predecessor in links
+        ]
+    )
+
+
+def bulk_instantiate(activities_with_predecessors):
+    """
+    Instantiate activities given as (activity, predecessor) pairs.
+
+    The instances are written with one INSERT per activity model and the
+    predecessor relations with one more. Activities that override instantiate
+    (e.g. Wait) are instantiated one by one. after_instantiate is called in the
+    given order once all instances exist. The bulk instantiated activities
+    send an instantiate event each, see instrument_batch.
+    """
+    pairs = list(activities_with_predecessors)
+    bulk = [
+        (activity, predecessor)
+        for activity, predecessor in pairs
+        if _supports_bulk_instantiate(activity)
+    ]
+
+    with instrument_batch([activity for activity, _ in bulk], "instantiate"):
+        by_model = OrderedDict()
+        for activity, predecessor in bulk:
+            activity.prepare_instance(predecessor=predecessor)
+            model = activity.flow.activity_model
+            by_model.setdefault(model, []).append((activity, predecessor))
+
+        for model, group in by_model.items():
+            model._default_manager.bulk_create(
+                [activity.instance for activity, _ in group]
+            )
+            create_predecessor_links(
+                model,
+                [
+                    (activity.instance, predecessor.instance)
+                    for activity, predecessor in group
+                    if predecessor
+                ],
+            )
+
+        for activity, predecessor in pairs:
+            if _supports_bulk_instantiate(activity):
+                activity.after_instantiate()
+            else:
+                activity.instantiate(predecessor=predecessor)
+
+        track_instances(activity.instance for activity, _ in bulk)
+
+
+def _bulk_save(model, objects):
+    # django can't bulk create multi-table inherited models
+    if model._meta.parents:
+        for obj in objects:
+            obj.save()
+    else:
+        model._default_manager.bulk_create(objects)
+
+
+class SuccessorsFailed(Exception):
+    """
+    Raised by start_processes if instantiating the successors of the start
+    activities failed, i.e. after activity code may have had side effects.
+    """
+
+    def __init__(self, exception):
+        super(SuccessorsFailed, self).__init__(exception)
+        self.exception = exception
+
+
+def start_processes(flow, rows, activity_instance_kwargs=None, user=None):
+    """
+    Start and finish a process of flow for every row of process field values.
+
+    Rows that can't be turned into a valid process are reported in the errors
+    dict (row index to exception), the others are started together: one INSERT
+    for the processes, one for the start instances, and their successors are
+    instantiated with bulk_instantiate. Process.save and model signals are
+    bypassed unless the process model uses multi-table inheritance.
+
+    :return: a list with the started process or None per row, and the errors
+    :raises SuccessorsFailed: if instantiating a successor raised
+    """
+    now = timezone.now()
+    start_name = flow.compile().names[0]
+    processes = []
+    errors = {}
+    starts = []
+    for i, row in enumerate(rows):
+        try:
+            process_kwargs = {
+                "started_at": now,
+                "status": flow.process_model.STATUS_STARTED,
+            }
+            process_kwargs.update(row)
+            process_kwargs["flow_label"] = flow.label
+            process = flow.process_model(**process_kwargs)
+            process.full_clean(validate_unique=False)
+        except (TypeError, ValueError, ValidationError) as e:
+            errors[i] = e
+            processes.append(None)
+            continue
+
+        start = flow._get_activity_by_name(process, start_name)
+        start.prepare_instance(instance_kwargs=dict(activity_instance_kwargs or {}))
+        start.start(user=user)
+        starts.append(start)
+        processes.append(process)
+
+    with transaction.atomic():
+        _bulk_save(flow.process_model, [start.process for start in starts])
+        track_processes(start.process for start in starts)
+        for start in starts:
+            start.instance.process = start.process
+            start.instance.status = start.instance.STATUS_DONE
+            start.instance.finished_at = now
+            start.instance.modified_by = user
+        _bulk_save(flow.activity_model, [start.instance for start in starts])
+        track_instances(start.instance for start in starts)
+
+        pairs = []
+        for start in starts:
+            start.transition = Transition(start.process)
+            start.transition.add(start.instance)
+            for activity in start._get_next_activities():
+                activity.transition = start.transition
+                pairs.append((activity, start))
+
+        try:
+            with batch_async_dispatch():
+                bulk_instantiate(pairs)
+        except Exception as e:
+            raise SuccessorsFailed(e) from e
+
+    for start in starts:
+        start.last_transition, start.transition = start.transition, None
+    send_processes_started(flow, [start.process for start in starts])
+    return processes, errors
 
 
 class State(Activity):
@@ -156,8 +473,7 @@ class State(Activity):
     if the activity before it was conditional.
     """
 
-    def instantiate(self, **kwargs):
-        super(State, self).instantiate(**kwargs)
+    def after_instantiate(self):
         self.start()
         self.finish()
 
@@ -187,61 +503,173 @@ class ViewActivity(Activity):
         return self.view(request, *args, **kwargs)
 
 
-class FunctionActivity(Activity):
+class RetryMixin(Activity):
+    """
+    Retries a failed callback according to the activity's retry_policy (a
+    processlib.retry.RetryPolicy). Without a policy failures are errors that
+    have to be retried by a user.
+    """
+
+    def __init__(self, retry_policy=None, **kwargs):
+        self.retry_policy = retry_policy
+        super(RetryMixin, self).__init__(**kwargs)
+
+    def handle_error(self, exception):
+        """
+        Record a failed attempt and schedule the next one if the policy allows.
+        """
+        if self.retry_policy is None:
+            self.error(exception=exception)
+            return
+
+        self.instance.attempts += 1
+        if self.retry_policy.should_retry(self.instance.attempts, exception):
+            self.schedule_retry(self.retry_policy.get_delay(self.instance.attempts))
+        else:
+            self.dead_letter(exception=exception)
+
+    def schedule_retry(self, delay):
+        """
+        Schedule the instance to be run by dispatch_due_activities after delay.
+        """
+        assert self.instance.status != self.instance.STATUS_DONE
+        now = timezone.now()
+        self.instance.status = self.instance.STATUS_SCHEDULED
+        self.instance.scheduled_at = now
+        self.instance.due_at = now + delay
+        self.instance.dispatched_at = None
+        self.instance.save()
+        track_instances([self.instance])
+
+    def dead_letter(self, **kwargs):
+        assert self.instance.status != self.instance.STATUS_DONE
+        self.instance.status = self.instance.STATUS_DEAD_LETTER
+        self.instance.finished_at = timezone.now()
+        self.instance.due_at = None
+        self.instance.save()
+        track_instances([self.instance])
+
+    def reset_attempts(self):
+        assert self.instance.status in self.instance.FAILED_STATUSES
+        self.instance.status = self.instance.STATUS_INSTANTIATED
+        self.instance.finished_at = None
+        self.instance.attempts = 0
+        self.instance.due_at = None
+        self.instance.dispatched_at = None
+
+
+class FunctionActivity(RetryMixin, Activity):
     def __init__(self, callback=None, **kwargs):
         self.callback = callback
         super(FunctionActivity, self).__init__(**kwargs)
 
-    def instantiate(self, **kwargs):
-        super(FunctionActivity, self).instantiate(**kwargs)
+    def after_instantiate(self):
         self.start()
 
     def start(self, **kwargs):
         super(FunctionActivity, self).start(**kwargs)
 
         try:
-            self.callback(self)
+            self.run()
         except Exception as e:
             logger.exception(e)
-            self.error(exception=e)
+            self.handle_error(e)
             return
 
         self.finish()
 
+    def run(self):
+        self.callback(self)
+
     def retry(self):
-        assert self.instance.status == self.instance.STATUS_ERROR
-        self.instance.status = self.instance.STATUS_INSTANTIATED
-        self.instance.finished_at = None
+        self.reset_attempts()
         self.instance.save()
         self.start()
 
 
-class AsyncActivity(Activity):
+class AsyncActivity(RetryMixin, Activity):
     def __init__(self, callback=None, **kwargs):
         self.callback = callback
         super(AsyncActivity, self).__init__(**kwargs)
 
-    def instantiate(self, **kwargs):
-        super(AsyncActivity, self).instantiate(**kwargs)
+    def after_instantiate(self):
         self.schedule()
 
     def schedule(self, **kwargs):
         self.instance.status = self.instance.STATUS_SCHEDULED
         self.instance.scheduled_at = timezone.now()
         self.instance.save()
-        transaction.on_commit(
-            lambda: run_async_activity.delay(self.flow.label, self.instance.pk)
-        )
+        track_instances([self.instance])
+        dispatch_async_activity(self.flow.label, self.instance.pk)
 
     def retry(self, **kwargs):
-        assert self.instance.status == self.instance.STATUS_ERROR
-        self.instance.status = self.instance.STATUS_INSTANTIATED
-        self.instance.finished_at = None
+        self.reset_attempts()
         self.schedule(**kwargs)
 
     def start(self, **kwargs):
         super(AsyncActivity, self).start(**kwargs)
-        self.callback(self)
+        self.run()
+
+    def run(self):
+        if asyncio.iscoroutinefunction(self.callback):
+            async_to_sync(self.callback)(self)
+        else:
+            self.callback(self)
+
+    async def arun(self):
+        if asyncio.iscoroutinefunction(self.callback):
+            await self.callback(self)
+        else:
+            await sync_to_async(self.callback)(self)
+
+
+class TimerActivity(RetryMixin, Activity):
+    """
+    Waits until a point in time, then continues with its successors.
+
+    The time is given as a delay (a timedelta) after the instance was
+    instantiated or as a due callable that receives the activity and returns a
+    datetime. The optional callback runs when the timer fires. Due timers are
+    dispatched by dispatch_due_activities, e.g. run by the processlib_scheduler
+    command.
+    """
+
+    def __init__(self, delay=None, due=None, callback=None, **kwargs):
+        if (delay is None) == (due is None):
+            raise ValueError(
+                "A TimerActivity requires either a delay or a due callable"
+            )
+        self.delay = delay
+        self.due = due
+        self.callback = callback
+        super(TimerActivity, self).__init__(**kwargs)
+
+    def after_instantiate(self):
+        self.schedule()
+
+    def get_due_at(self):
+        if self.due is not None:
+            return self.due(self)
+        return timezone.now() + self.delay
+
+    def schedule(self, **kwargs):
+        self.instance.status = self.instance.STATUS_SCHEDULED
+        self.instance.scheduled_at = timezone.now()
+        self.instance.due_at = self.get_due_at()
+        self.instance.dispatched_at = None
+        self.instance.save()
+        track_instances([self.instance])
+
+    def run(self):
+        if self.callback is not None:
+            self.callback(self)
+
+    def retry(self, **kwargs):
+        self.reset_attempts()
+        self.instance.status = self.instance.STATUS_SCHEDULED
+        self.instance.due_at = timezone.now()
+        self.instance.save()
+        track_instances([self.instance])
 
 
 class AsyncViewActivity(AsyncActivity):
@@ -278,24 +706,9 @@ class StartMixin(Activity):
     def instantiate(
         self, predecessor=None, instance_kwargs=None, request=None, **kwargs
     ):
-        assert not self.instance
+        # the start instance is saved along with the process in finish
         assert not predecessor
-        instance_kwargs = instance_kwargs or {}
-
-        request_user = (
-            request.user if request and request.user.is_authenticated else None
-        )
-        user, group = self._get_assignment(
-            request_user=request_user, predecessor=predecessor
-        )
-        if "assigned_user" not in instance_kwargs:
-            instance_kwargs["assigned_user"] = user
-        if "assigned_group" not in instance_kwargs:
-            instance_kwargs["assigned_group"] = group
-
-        self.instance = self.flow.activity_model(
-            process=self.process, activity_name=self.name, **(instance_kwargs or {})
-        )
+        self.prepare_instance(instance_kwargs=instance_kwargs, request=request)
 
     def finish(self, **kwargs):
         assert self.instance.status == self.instance.STATUS_STARTED
@@ -303,10 +716,12 @@ class StartMixin(Activity):
             self.instance.finished_at = timezone.now()
 
         self.process.save()
+        track_processes([self.process])
         self.instance.process = self.process
         self.instance.status = self.instance.STATUS_DONE
         self.instance.modified_by = kwargs.get("user", None)
         self.instance.save()
+        send_processes_started(self.flow, [self.process])
         self._instantiate_next_activities()
 
 
@@ -319,8 +734,7 @@ class StartViewActivity(StartMixin, ViewActivity):
 
 
 class EndActivity(Activity):
-    def instantiate(self, **kwargs):
-        super(EndActivity, self).instantiate(**kwargs)
+    def after_instantiate(self):
         self.start()
         self.finish()
 
@@ -337,6 +751,7 @@ class EndActivity(Activity):
             update_fields.append("status")
 
         self.process.save(update_fields=update_fields)
+        track_processes([self.process])
 
 
 class FormActivity(Activity):
@@ -358,6 +773,29 @@ class IfElse(Activity):
 
 
 class Wait(Activity):
+    """
+    Joins branches, finishing once every activity in wait_for arrived.
+
+    The arrivals of one loop iteration share an instance. Its join_mask has a
+    bit per name in wait_for (in sorted order), set with a compare-and-swap
+    update by each arriving branch, and its generation counts the iterations.
+    Finding the open join is a single lookup of the latest generation and
+    only the arrival setting the last bit finishes it. Concurrent arrivals
+    creating the same generation are kept apart by the unique constraint on
+    (process, activity_name, generation), the losers join the winner's
+    instance.
+
+    An arrival that lost the compare-and-swap reads the instance again with
+    SELECT ... FOR UPDATE, which returns the latest committed join_mask also
+    under REPEATABLE READ (MySQL's default) where a plain read would return
+    the same snapshot again. It gives up after max_join_attempts lost races.
+
+    Instances written before join_mask existed get their join state from
+    their predecessors when the join is touched first.
+    """
+
+    max_join_attempts = 10
+
     def __init__(self, flow, process, instance, name, **kwargs):
         wait_for = kwargs.pop("wait_for", None)
         if not wait_for:
@@ -365,49 +803,171 @@ class Wait(Activity):
 
         super(Wait, self).__init__(flow, process, instance, name, **kwargs)
 
-        self._wait_for = set(wait_for) if wait_for else None
-
-    def _find_existing_instance(self, predecessor):
-        candidates = list(
-            self.flow.activity_model.objects.filter(
-                process=self.process, activity_name=self.name
+        self._wait_for = set(wait_for)
+        if len(self._wait_for) > 63:
+            raise ValueError("Wait activity can wait for at most 63 activities.")
+        self._join_bits = {
+            name: 1 << i for i, name in enumerate(sorted(self._wait_for))
+        }
+        self._complete_mask = (1 << len(self._wait_for)) - 1
+
+    def is_complete(self):
+        join_mask = self.instance.join_mask or 0
+        return join_mask & self._complete_mask == self._complete_mask
+
+    def _get_latest_instance(self, lock=False):
+        instances = self.flow.activity_model._default_manager.filter(
+            process=self.process, activity_name=self.name
+        ).order_by(
+            # instances without join state first, to upgrade them
+            ExpressionWrapper(
+                Q(join_mask__isnull=True), output_field=BooleanField()
+            ).desc(),
+            "-generation",
+        )
+        if lock:
+            with transaction.atomic():
+                instance = instances.select_for_update().first()
+        else:
+            instance = instances.first()
+
+        if instance is not None and instance.join_mask is None:
+            self._upgrade_instances()
+            # a locking read sees the state of a concurrent upgrade
+            return self._get_latest_instance(lock=True)
+        return instance
+
+    def _upgrade_instances(self):
+        """
+        Number the instances without join state by instantiation and set the
+        bits of their predecessors.
+        """
+        model = self.flow.activity_model
+        instance_ids = list(
+            model._default_manager.filter(
+                process=self.process, activity_name=self.name, join_mask__isnull=True
             )
+            .order_by("instantiated_at", "pk")
+            .values_list("pk", flat=True)
+        )
+        field = model._meta.get_field("predecessors")
+        from_name = field.m2m_field_name()
+        predecessor_names = {}
+        for instance_id, predecessor_name in field.remote_field.through.objects.filter(
+            **{"{}_id__in".format(from_name): instance_ids}
+        ).values_list(
+            "{}_id".format(from_name),
+            "{}__activity_name".format(field.m2m_reverse_field_name()),
+        ):
+            predecessor_names.setdefault(instance_id, set()).add(predecessor_name)
+
+        for generation, instance_id in enumerate(instance_ids):
+            join_mask = sum(
+                self._join_bits.get(name, 0)
+                for name in predecessor_names.get(instance_id, ())
+            )
+            # concurrent upgrades compute the same state
+            model._default_manager.filter(
+                pk=instance_id, join_mask__isnull=True
+            ).update(join_mask=join_mask, generation=generation)
+
+    def _ensure_join_state(self):
+        if self.instance.pk is not None and self.instance.join_mask is None:
+            self._upgrade_instances()
+            self.instance.refresh_from_db(fields=["join_mask", "generation"])
+
+    def _create_instance(self, generation, join_mask, instance_kwargs):
+        instance = self.flow.activity_model(
+            process=self.process,
+            activity_name=self.name,
+            generation=generation,
+            join_mask=join_mask,
+            status=self.flow.activity_model.STATUS_STARTED,
+            started_at=timezone.now(),
+            **(instance_kwargs or {})
+        )
+        try:
+            with transaction.atomic():
+                instance.save()
+        except IntegrityError:
+            # a concurrent arrival created the instance of this generation
+            return None
+        return instance
+
+    def _arrive(self, predecessor, instance_kwargs=None):
+        """
+        Set the bit of predecessor in the open join instance, creating the
+        instance of the next generation if there is none. Returns whether the
+        bit was set by this arrival.
+        """
+        model = self.flow.activity_model
+        bit = self._join_bits.get(predecessor.name, 0)
+
+        instance = None
+        if self.transition is not None:
+            instance = self.transition.get_open_join(self.name)
+            if instance is not None:
+                self.transition.queries_saved += 1
+
+        for attempt in range(self.max_join_attempts):
+            if instance is None:
+                instance = self._get_latest_instance(lock=attempt > 0)
+
+            if instance is None or instance.status == instance.STATUS_DONE:
+                generation = 0 if instance is None else instance.generation + 1
+                instance = self._create_instance(generation, bit, instance_kwargs)
+                if instance is not None:
+                    self.instance = instance
+                    return bool(bit)
+                continue
+
+            self.instance = instance
+            if instance.join_mask & bit == bit:
+                return False
+            if model._default_manager.filter(
+                pk=instance.pk, join_mask=instance.join_mask
+            ).update(join_mask=instance.join_mask | bit):
+                instance.join_mask |= bit
+                return True
+            # another branch arrived concurrently, read the instance again
+            instance = None
+
+        raise RuntimeError(
+            "Could not join {} of process {}".format(self.name, self.process.pk)
         )
-
-        for candidate in candidates:
-            # FIXME this only corrects for simple loops, may fail with more complex scenarios
-            if not candidate.successors.filter(
-                status=candidate.STATUS_DONE, activity_name=self.name
-            ).exists():
-                return candidate
-
-        raise self.flow.activity_model.DoesNotExist()
 
     def instantiate(self, predecessor=None, instance_kwargs=None, **kwargs):
         if predecessor is None:
             raise ValueError("Can't wait for something without a predecessor.")
 
-        # find the instance
-        try:
-            self.instance = self._find_existing_instance(predecessor)
-        except self.flow.activity_model.DoesNotExist:
-            self.instance = self.flow.activity_model(
-                process=self.process, activity_name=self.name, **(instance_kwargs or {})
+        arrived = self._arrive(predecessor, instance_kwargs=instance_kwargs)
+        if self.transition is not None:
+            self.transition.add_join(self.instance)
+
+        if arrived:
+            # the predecessor's bit was not set, so the relation can't exist yet
+            create_predecessor_links(
+                self.flow.activity_model, [(self.instance, predecessor.instance)]
             )
-            self.instance.save()
+        else:
+            self.instance.predecessors.add(predecessor.instance)
 
-        self.instance.predecessors.add(predecessor.instance)
-        self.start()
+        if arrived and self.is_complete():
+            self.finish()
+        elif (
+            self.is_complete()
+            and self.instance.status == self.instance.STATUS_INSTANTIATED
+        ):
+            # the join was undone and continues once a branch arrives again
+            self.start()
 
     def start(self, **kwargs):
+        self._ensure_join_state()
         if not self.instance.started_at:
             self.instance.started_at = timezone.now()
 
         self.instance.status = self.instance.STATUS_STARTED
         self.instance.save()
 
-        predecessor_names = {
-            instance.activity_name for instance in self.instance.predecessors.all()
-        }
-        if self._wait_for.issubset(predecessor_names):
+        if self.is_complete():
             self.finish()
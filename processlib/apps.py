@@ -1,12 +1,20 @@
 from django.apps import AppConfig
-from django.db.models.signals import post_migrate
+from django.core.signals import setting_changed
+from django.db.models.signals import post_migrate, m2m_changed
 
 
 class ProcesslibAppConfig(AppConfig):
     name = "processlib"
 
     def ready(self):
+        from django.contrib.auth import get_user_model
+        from django.contrib.auth.models import Group
+
         import processlib.tasks  # noqa
+        from .count_cache import invalidate_all_to_do_counts
+        from .executors import reset_executor
+        from .metrics import update_metrics_receivers
+        from .permissions import invalidate_permission_resolvers
         from .signals import create_flow_permissions
 
         post_migrate.connect(
@@ -14,3 +22,33 @@ class ProcesslibAppConfig(AppConfig):
             dispatch_uid="processlib.signals.create_flow_permissions",
             sender=self,
         )
+        setting_changed.connect(
+            reset_executor, dispatch_uid="processlib.executors.reset_executor"
+        )
+        update_metrics_receivers()
+        setting_changed.connect(
+            update_metrics_receivers,
+            dispatch_uid="processlib.metrics.update_metrics_receivers",
+        )
+
+        user_model = get_user_model()
+        relations = [Group.permissions]
+        if hasattr(user_model, "groups"):
+            relations.append(user_model.groups)
+        if hasattr(user_model, "user_permissions"):
+            relations.append(user_model.user_permissions)
+        for relation in relations:
+            m2m_changed.connect(
+                invalidate_permission_resolvers,
+                sender=relation.through,
+                dispatch_uid="processlib.permissions.invalidate_{}".format(
+                    relation.through._meta.label_lower
+                ),
+            )
+            m2m_changed.connect(
+                invalidate_all_to_do_counts,
+                sender=relation.through,
+                dispatch_uid="processlib.count_cache.invalidate_{}".format(
+                    relation.through._meta.label_lower
+                ),
+            )
@@ -0,0 +1,78 @@
+"""
+Archival of finished processes.
+
+archive_processes moves processes that were done or canceled before a cutoff,
+with their activity instances and predecessor links, into ArchivedProcess rows
+holding compressed JSON and deletes them from the live tables, keeping those
+and their indexes small. Archived processes stay readable through
+ProcessDetailView.
+"""
+
+from django.db import transaction
+
+from .export import get_activity_timelines
+from .models import ArchivedProcess, Process
+from .services import get_concrete_processes
+from .tracking import track_processes
+
+
+def _get_payload(process, activities):
+    return {
+        "process": {
+            field.attname: field.value_to_string(process)
+            for field in process._meta.concrete_fields
+        },
+        "process_model": process._meta.label,
+        "description": process.description,
+        "activities": activities,
+    }
+
+
+def archive_batch(processes):
+    """
+    Archive the given processes and delete them with their activity instances.
+    """
+    processes = get_concrete_processes(processes)
+    if not processes:
+        return 0
+
+    with transaction.atomic():
+        timelines = get_activity_timelines([process.pk for process in processes])
+        archived = []
+        for process in processes:
+            archived_process = ArchivedProcess(
+                id=process.pk,
+                flow_label=process.flow_label,
+                status=process.status,
+                started_at=process.started_at,
+                finished_at=process.finished_at,
+            )
+            archived_process.payload = _get_payload(process, timelines[process.pk])
+            archived.append(archived_process)
+        ArchivedProcess.objects.bulk_create(archived)
+        # before the delete, which removes the to-dos the tracking looks up
+        track_processes(processes, deleted=True)
+        Process.objects.filter(pk__in=[process.pk for process in processes]).delete()
+    return len(processes)
+
+
+def archive_processes(finished_before, batch_size=500):
+    """
+    Archive all processes that were done or canceled before finished_before,
+    batch_size at a time, each batch in its own transaction. Returns the number
+    of archived processes.
+    """
+    total = 0
+    while True:
+        batch = list(
+            Process.objects.filter(
+                status__in=(Process.STATUS_DONE, Process.STATUS_CANCELED),
+                finished_at__lt=finished_before,
+            ).order_by("finished_at")[:batch_size]
+        )
+        if not batch:
+            return total
+        archived = archive_batch(batch)
+        if not archived:
+            return total
+        total += archived
@@ -0,0 +1,298 @@
+"""
+Benchmarks for the hot paths of processlib, run by the processlib_benchmark
+management command.
+
+A synthetic dataset of users, groups and processes is created inside a
+transaction that is rolled back afterwards, so the benchmarks can run against
+any database. Every benchmark records wall times and query counts, the results
+are plain dicts meant to be dumped as JSON and compared between runs.
+"""
+
+import platform
+import random
+import statistics
+import time
+from datetime import datetime, timezone as dt_timezone
+
+import django
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from .activity import (
+    EndActivity,
+    FunctionActivity,
+    StartActivity,
+    ViewActivity,
+    Wait,
+)
+from .flow import Flow, get_flows
+from .models import Process
+from .services import (
+    get_permission_filter,
+    get_user_current_process_count,
+    get_user_current_processes,
+)
+from .views import (
+    ProcessDetailView,
+    ProcessListView,
+    ProcessUpdateView,
+    UserCurrentProcessListView,
+)
+
+_flows = {}
+
+
+def get_benchmark_flow(name):
+    """
+    The benchmark flows, created on first use so they are only registered
+    when benchmarking.
+    """
+    if "linear" not in _flows:
+        _flows["linear"] = (
+            Flow("processlib_benchmark_linear")
+            .start_with("start", StartActivity)
+            .and_then("view", ViewActivity, view=ProcessUpdateView.as_view(fields=[]))
+            .and_then("end", EndActivity)
+        )
+        fan_out = Flow("processlib_benchmark_fan_out").start_with(
+            "start", StartActivity
+        )
+        branches = ["branch_{}".format(i) for i in range(4)]
+        for branch in branches:
+            fan_out.add_activity(
+                branch, FunctionActivity, after="start", callback=lambda a: None
+            )
+        fan_out.add_activity("join", Wait, wait_for=branches)
+        fan_out.and_then("end", EndActivity)
+        _flows["fan_out"] = fan_out
+    return _flows[name]
+
+
+def get_dataset_flows(count):
+    """
+    count synthetic flows for the dataset, registered on first use. Every
+    third flow requires a flow permission and every third (starting with the
+    second) a permission for its view activity, the others none.
+    """
+    flows = []
+    for i in range(count):
+        label = "processlib_benchmark_{}".format(i)
+        if label not in _flows:
+            flow_permission = None
+            activity_permission = None
+            if i % 3 == 0:
+                flow_permission = "processlib.{}".format(label)
+            elif i % 3 == 1:
+                activity_permission = "processlib.{}_view".format(label)
+            _flows[label] = (
+                Flow(label, permission=flow_permission)
+                .start_with("start", StartActivity)
+                .and_then(
+                    "view",
+                    ViewActivity,
+                    view=ProcessUpdateView.as_view(fields=[]),
+                    permission=activity_permission,
+                )
+                .and_then("end", EndActivity)
+            )
+        flows.append(_flows[label])
+    return flows
+
+
+def _get_permissions(flow):
+    permissions = [flow.permission] if flow.permission else []
+    permissions.extend(
+        activity.permission
+        for activity in flow.compile().metadata.values()
+        if activity.permission
+    )
+    return permissions
+
+
+def measure(func, repeat=5):
+    """
+    Call func repeat times, returning wall time statistics in milliseconds and
+    the query counts.
+    """
+    durations = []
+    queries = []
+    for i in range(repeat):
+        with CaptureQueriesContext(connection) as captured:
+            started = time.perf_counter()
+            func()
+            durations.append((time.perf_counter() - started) * 1000)
+        queries.append(len(captured))
+    return {
+        "repeat": repeat,
+        "min_ms": round(min(durations), 3),
+        "median_ms": round(statistics.median(durations), 3),
+        "mean_ms": round(statistics.mean(durations), 3),
+        "max_ms": round(max(durations), 3),
+        "queries": max(queries),
+    }
+
+
+class Dataset(object):
+    def __init__(self, processes=1000, users=50, groups=10, flows=4, seed=0):
+        if flows < 1:
+            raise ValueError("The dataset needs at least one flow")
+        self.processes = processes
+        self.users = users
+        self.groups = groups
+        self.flows = flows
+        self.random = random.Random(seed)
+
+    def create_permissions(self, flows):
+        """
+        Create the permissions of the flows (they are only created by migrate
+        otherwise) and grant each to half of the groups.
+        """
+        content_type = ContentType.objects.get_for_model(Process)
+        for flow in flows:
+            for permission in _get_permissions(flow):
+                app_label, codename = permission.split(".", 1)
+                permission, created = Permission.objects.get_or_create(
+                    content_type=content_type,
+                    codename=codename,
+                    defaults={"name": codename},
+                )
+                for group in self.random.sample(
+                    self.group_objects, (len(self.group_objects) + 1) // 2
+                ):
+                    group.permissions.add(permission)
+
+    def create(self):
+        user_model = get_user_model()
+        self.group_objects = Group.objects.bulk_create(
+            [
+                Group(name="processlib-benchmark-{}".format(i))
+                for i in range(self.groups)
+            ]
+        )
+        self.user_objects = []
+        for i in range(self.users):
+            user = user_model.objects.create(
+                **{user_model.USERNAME_FIELD: "processlib-benchmark-{}".format(i)}
+            )
+            user.groups.add(self.random.choice(self.group_objects))
+            self.user_objects.append(user)
+        self.superuser = user_model.objects.create(
+            is_superuser=True,
+            **{user_model.USERNAME_FIELD: "processlib-benchmark-superuser"},
+        )
+
+        flows = get_dataset_flows(self.flows)
+        self.create_permissions(flows)
+
+        # spread the processes evenly over the flows and groups
+        pairs = [(flow, group) for flow in flows for group in self.group_objects]
+        for i, (flow, group) in enumerate(pairs):
+            count = self.processes // len(pairs) + (
+                1 if i < self.processes % len(pairs) else 0
+            )
+            if not count:
+                continue
+            processes, errors = flow.start_many(
+                [{} for j in range(count)],
+                activity_instance_kwargs={"assigned_group": group},
+            )
+            if errors:
+                raise ValueError("Creating the dataset failed: {}".format(errors))
+        self.process = Process.objects.filter(
+            flow_label__in=[flow.label for flow in flows]
+        ).first()
+
+    def as_dict(self):
+        return {
+            "processes": self.processes,
+            "users": self.users,
+            "groups": self.groups,
+            "dataset_flows": self.flows,
+            "flows": len(get_flows()),
+        }
+
+
+def _request(user):
+    request = RequestFactory().get("/")
+    request.user = user
+    return request
+
+
+def get_benchmarks(dataset):
+    """
+    The benchmarks as (name, function) pairs.
+    """
+
+    def start_and_finish(flow_name):
+        def run():
+            start = get_benchmark_flow(flow_name).get_start_activity()
+            start.start()
+            start.finish()
+
+        return run
+
+    user = dataset.user_objects[0]
+
+    def current_processes():
+        list(get_user_current_processes(user)[:25])
+
+    def current_process_count():
+        get_user_current_process_count(user)
+
+    def permission_filter():
+        Process.objects.filter(get_permission_filter(user)).distinct().count()
+
+    def list_view():
+        ProcessListView.as_view()(_request(dataset.superuser)).render()
+
+    def user_list_view():
+        UserCurrentProcessListView.as_view()(_request(user)).render()
+
+    def detail_view():
+        ProcessDetailView.as_view()(
+            _request(dataset.superuser), pk=dataset.process.pk
+        ).render()
+
+    return [
+        ("start_finish_linear", start_and_finish("linear")),
+        ("start_finish_fan_out_join", start_and_finish("fan_out")),
+        ("user_current_processes", current_processes),
+        ("user_current_process_count", current_process_count),
+        ("permission_filter", permission_filter),
+        ("process_list_view", list_view),
+        ("user_process_list_view", user_list_view),
+        ("process_detail_view", detail_view),
+    ]
+
+
+def run_benchmarks(dataset, repeat=5, names=None):
+    """
+    Create the dataset, run the benchmarks and roll everything back.
+    """
+    results = {}
+    with transaction.atomic():
+        dataset.create()
+        for name, func in get_benchmarks(dataset):
+            if names and name not in names:
+                continue
+            try:
+                with transaction.atomic():
+                    results[name] = measure(func, repeat=repeat)
+            except Exception as e:
+                results[name] = {"error": repr(e)}
+        transaction.set_rollback(True)
+
+    return {
+        "created_at": datetime.now(dt_timezone.utc).isoformat(),
+        "environment": {
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "database": connection.vendor,
+        },
+        "dataset": dataset.as_dict(),
+        "results": results,
+    }
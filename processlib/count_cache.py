@@ -0,0 +1,181 @@
+"""
+Caches the to-do counts of users, e.g. for badges, until something they count
+changes.
+
+Enable it with ``PROCESSLIB_CACHE_TO_DO_COUNTS = True``. Cache keys contain a
+version per user, per group of the user, for unassigned to-dos and a global
+one. track_instances bumps the versions of the old and new assignment of
+every changed to-do, track_processes the versions of the assignments of the
+to-dos of processes whose status changed, as only started processes are
+current. Changes of group memberships and permissions bump the global
+version. A cache hit costs no queries, only four cache lookups.
+Entries expire after ``PROCESSLIB_TO_DO_COUNT_CACHE_TIMEOUT`` seconds.
+"""
+
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from .models import ActivityInstance
+
+KEY_PREFIX = "processlib:to-do"
+GLOBAL_VERSION_KEY = "{}:version".format(KEY_PREFIX)
+UNASSIGNED_VERSION_KEY = "{}:version:unassigned".format(KEY_PREFIX)
+
+
+def count_cache_enabled():
+    return getattr(settings, "PROCESSLIB_CACHE_TO_DO_COUNTS", False)
+
+
+def get_cache():
+    return caches[getattr(settings, "PROCESSLIB_TO_DO_COUNT_CACHE", "default")]
+
+
+def get_timeout():
+    return getattr(settings, "PROCESSLIB_TO_DO_COUNT_CACHE_TIMEOUT", 300)
+
+
+def get_user_version_key(user_id):
+    return "{}:version:user:{}".format(KEY_PREFIX, user_id)
+
+
+def get_group_version_key(group_id):
+    return "{}:version:group:{}".format(KEY_PREFIX, group_id)
+
+
+def _new_version():
+    # versions that were evicted start over above any value they had before
+    return time.time_ns()
+
+
+def _get_versions(keys):
+    cache = get_cache()
+    versions = cache.get_many(keys)
+    missing = {key: _new_version() for key in keys if key not in versions}
+    if missing:
+        for key, version in missing.items():
+            cache.add(key, version, None)
+        versions.update(cache.get_many(list(missing)))
+    return [versions.get(key, missing.get(key)) for key in keys]
+
+
+def _bump_versions(keys):
+    cache = get_cache()
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, _new_version(), None)
+
+
+def bump_versions(keys):
+    """
+    Invalidate the counts depending on the version keys, now for the current
+    transaction and once more on commit for counts computed concurrently from
+    the state before it.
+    """
+    keys = sorted(set(keys))
+    if not keys:
+        return
+    _bump_versions(keys)
+    transaction.on_commit(lambda: _bump_versions(keys))
+
+
+def _get_version_keys(states):
+    keys = set()
+    for state in states:
+        if state is None:
+            continue
+        user_id, group_id = state
+        if user_id is not None:
+            keys.add(get_user_version_key(user_id))
+        if group_id is not None:
+            keys.add(get_group_version_key(group_id))
+        if user_id is None and group_id is None:
+            keys.add(UNASSIGNED_VERSION_KEY)
+    return keys
+
+
+def invalidate_to_do_counts(changes):
+    """
+    Invalidate the counts affected by (instance, old to-do state, new to-do
+    state) changes.
+    """
+    bump_versions(
+        _get_version_keys(
+            state
+            for instance, old_state, new_state in changes
+            for state in (old_state, new_state)
+        )
+    )
+
+
+def invalidate_process_counts(processes):
+    """
+    Invalidate the counts of the users the to-dos of the processes are
+    assigned to, after the status of the processes changed.
+    """
+    process_ids = [process.pk for process in processes]
+    if not process_ids:
+        return
+    bump_versions(
+        _get_version_keys(
+            ActivityInstance.objects.filter(
+                process_id__in=process_ids,
+                status__in=ActivityInstance.TO_DO_STATUSES,
+            )
+            .order_by()
+            .values_list("assigned_user_id", "assigned_group_id")
+            .distinct()
+        )
+    )
+
+
+def invalidate_all_to_do_counts(**kwargs):
+    """
+    Invalidate all counts, connected to changes of group memberships and
+    permissions.
+    """
+    if count_cache_enabled():
+        bump_versions([GLOBAL_VERSION_KEY])
+
+
+def get_cached_to_do_count(user, name, compute, include_unassigned=True):
+    """
+    The count called name of the user, computed by compute() on a cache miss.
+    """
+    if not count_cache_enabled() or not user.is_authenticated:
+        return compute()
+
+    cache = get_cache()
+    global_version, user_version = _get_versions(
+        [GLOBAL_VERSION_KEY, get_user_version_key(user.pk)]
+    )
+    groups_key = "{}:groups:{}:{}".format(KEY_PREFIX, user.pk, global_version)
+    group_ids = cache.get(groups_key)
+    if group_ids is None:
+        group_ids = sorted(user.groups.values_list("pk", flat=True))
+        cache.set(groups_key, group_ids, get_timeout())
+
+    version_keys = [get_group_version_key(group_id) for group_id in group_ids]
+    if include_unassigned:
+        version_keys.append(UNASSIGNED_VERSION_KEY)
+    versions = [global_version, user_version] + _get_versions(version_keys)
+
+    key = "{}:count:{}:{}:{}:{}".format(
+        KEY_PREFIX,
+        name,
+        user.pk,
+        int(include_unassigned),
+        hashlib.md5(
+            ".".join(str(version) for version in versions).encode()
+        ).hexdigest(),
+    )
+    count = cache.get(key)
+    if count is None:
+        count = compute()
+        cache.set(key, count, get_timeout())
+    return count
@@ -0,0 +1,201 @@
+"""
+Counters of processes per flow and status and of to-dos per assignment, read
+by get_flow_status_counts and get_user_to_do_count instead of counting rows.
+
+Enable them with ``PROCESSLIB_USE_COUNTERS = True``. The activities apply the
+changes of a transition as F() increments of FlowStatusCount and ToDoCount
+rows, in key order so concurrent transitions don't deadlock. A transition
+holds the row locks of the counters it changed until it commits. Changes made
+without the activities (e.g. updates of the tables or deleted users) are not
+counted; run ``reconcile_counters`` (the processlib_reconcile_counters
+command) periodically and once after enabling the counters.
+"""
+
+import logging
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+
+from .models import ActivityInstance, FlowStatusCount, Process, ToDoCount
+
+logger = logging.getLogger(__name__)
+
+
+def counters_enabled():
+    return getattr(settings, "PROCESSLIB_USE_COUNTERS", False)
+
+
+def _apply_deltas(model, deltas, get_fields):
+    """
+    Add the deltas (by key) to the count of the model's rows, creating the
+    rows that don't exist yet.
+    """
+    for key in sorted(deltas, key=str):
+        delta = deltas[key]
+        if not delta:
+            continue
+        fields = get_fields(key)
+        rows = model._default_manager.filter(**fields)
+        if not rows.update(count=F("count") + delta):
+            model._default_manager.bulk_create(
+                [model(count=0, **fields)], ignore_conflicts=True
+            )
+            rows.update(count=F("count") + delta)
+
+
+# the fields making up the keys of the deltas
+_KEY_FIELDS = {
+    FlowStatusCount: ("flow_label", "status"),
+    ToDoCount: ("flow_label", "assigned_user_id", "assigned_group_id"),
+}
+
+
+def _get_to_do_count_fields(key):
+    flow_label, user_id, group_id = key
+    return {
+        "key": ToDoCount.get_key(flow_label, user_id, group_id),
+        "flow_label": flow_label,
+        "assigned_user_id": user_id,
+        "assigned_group_id": group_id,
+    }
+
+
+def _get_flow_status_count_fields(key):
+    flow_label, status = key
+    return {"flow_label": flow_label, "status": status}
+
+
+def update_to_do_counts(changes):
+    """
+    Apply (instance, old to-do state, new to-do state) changes to the counts.
+    """
+    deltas = Counter()
+    for instance, old_state, new_state in changes:
+        flow_label = instance.process.flow_label
+        if old_state is not None:
+            deltas[(flow_label,) + tuple(old_state)] -= 1
+        if new_state is not None:
+            deltas[(flow_label,) + tuple(new_state)] += 1
+    _apply_deltas(ToDoCount, deltas, _get_to_do_count_fields)
+
+
+def update_flow_status_counts(changes):
+    """
+    Apply (process, old status, new status) changes to the counts, a status of
+    None meaning the process did not exist before or does not exist anymore.
+    """
+    deltas = Counter()
+    for process, old_status, new_status in changes:
+        if old_status is not None:
+            deltas[(process.flow_label, old_status)] -= 1
+        if new_status is not None:
+            deltas[(process.flow_label, new_status)] += 1
+    _apply_deltas(FlowStatusCount, deltas, _get_flow_status_count_fields)
+
+
+def get_flow_status_counts(flow_labels=None):
+    """
+    The number of processes by flow label and status.
+    """
+    if counters_enabled():
+        rows = FlowStatusCount.objects.filter(count__gt=0)
+    else:
+        rows = (
+            Process.objects.order_by()
+            .values("flow_label", "status")
+            .annotate(count=Count("pk"))
+        )
+    if flow_labels is not None:
+        rows = rows.filter(flow_label__in=flow_labels)
+
+    counts = defaultdict(dict)
+    for flow_label, status, count in rows.values_list("flow_label", "status", "count"):
+        counts[flow_label][status] = count
+    return dict(counts)
+
+
+def get_to_do_count(user, flow_labels, include_unassigned=True):
+    """
+    The number of activity instances in the given flows that are something to
+    do for the user, assigned to them, one of their groups or, if
+    include_unassigned, nobody.
+    """
+    q = Q(assigned_user=user) | Q(assigned_group__in=user.groups.all())
+    if include_unassigned:
+        q |= Q(assigned_user__isnull=True, assigned_group__isnull=True)
+
+    if counters_enabled():
+        rows = ToDoCount.objects.filter(q, flow_label__in=flow_labels)
+        return rows.aggregate(total=Sum("count"))["total"] or 0
+
+    return ActivityInstance.objects.filter(
+        q,
+        status__in=ActivityInstance.TO_DO_STATUSES,
+        process__flow_label__in=flow_labels,
+    ).count()
+
+
+def _get_expected_flow_status_counts():
+    return {
+        (row["flow_label"], row["status"]): row["count"]
+        for row in Process.objects.order_by()
+        .values("flow_label", "status")
+        .annotate(count=Count("pk"))
+    }
+
+
+def _get_expected_to_do_counts():
+    return {
+        (
+            row["process__flow_label"],
+            row["assigned_user_id"],
+            row["assigned_group_id"],
+        ): row["count"]
+        for row in ActivityInstance.objects.filter(
+            status__in=ActivityInstance.TO_DO_STATUSES
+        )
+        .order_by()
+        .values("process__flow_label", "assigned_user_id", "assigned_group_id")
+        .annotate(count=Count("pk"))
+    }
+
+
+def reconcile_counters():
+    """
+    Recompute the counters from the processes and activity instances and fix
+    the ones that drifted. Returns the number of fixed counters.
+
+    The existing counters are locked before counting, so transitions that
+    changed them are either committed and counted or wait for the fix.
+    """
+    fixed = 0
+    with transaction.atomic():
+        for model, get_expected, get_fields in (
+            (
+                FlowStatusCount,
+                _get_expected_flow_status_counts,
+                _get_flow_status_count_fields,
+            ),
+            (ToDoCount, _get_expected_to_do_counts, _get_to_do_count_fields),
+        ):
+            counts = {
+                tuple(values[1:]): values[0]
+                for values in model._default_manager.select_for_update()
+                .order_by()
+                .values_list("count", *_KEY_FIELDS[model])
+            }
+            expected = get_expected()
+            deltas = Counter(
+                {
+                    key: expected.get(key, 0) - counts.get(key, 0)
+                    for key in set(counts) | set(expected)
+                }
+            )
+            _apply_deltas(model, deltas, get_fields)
+            fixed += sum(1 for delta in deltas.values() if delta)
+
+    if fixed:
+        logger.warning("Fixed %d drifted counters", fixed)
+    return fixed
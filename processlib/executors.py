@@ -0,0 +1,172 @@
+"""
+Executors run async activities once the transaction that scheduled them has
+been committed.
+
+The executor is configured with ``PROCESSLIB_ASYNC_EXECUTOR``, the dotted path
+of an executor class, and ``PROCESSLIB_ASYNC_EXECUTOR_OPTIONS``, keyword
+arguments for it. The default sends Celery tasks.
+"""
+
+import asyncio
+import threading
+from concurrent import futures
+from logging import getLogger
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils.module_loading import import_string
+
+logger = getLogger(__name__)
+
+DEFAULT_EXECUTOR = "processlib.executors.CeleryExecutor"
+
+
+class BaseExecutor(object):
+    def submit(self, flow_label, activity_instance_ids):
+        """
+        Run the given async activity instances of a flow.
+        """
+        raise NotImplementedError
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class CeleryExecutor(BaseExecutor):
+    """
+    Sends one Celery task per call. Without Celery the tasks run synchronously.
+    """
+
+    def submit(self, flow_label, activity_instance_ids):
+        from .tasks import run_async_activities, run_async_activity
+
+        if len(activity_instance_ids) == 1:
+            run_async_activity.delay(flow_label, activity_instance_ids[0])
+        else:
+            run_async_activities.delay(flow_label, list(activity_instance_ids))
+
+
+class SynchronousExecutor(BaseExecutor):
+    """
+    Runs the activities in the committing thread, e.g. for tests.
+    """
+
+    def submit(self, flow_label, activity_instance_ids):
+        from .tasks import run_async_activities
+
+        run_async_activities(flow_label, list(activity_instance_ids))
+
+
+class ThreadPoolExecutor(BaseExecutor):
+    """
+    Runs the activities on a pool of max_workers threads in this process.
+
+    At most max_queue_size batches may be running or waiting, submitting more
+    blocks until one of them is done.
+    """
+
+    def __init__(self, max_workers=4, max_queue_size=100):
+        self._pool = futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="processlib"
+        )
+        self._slots = threading.BoundedSemaphore(max_queue_size)
+
+    def submit(self, flow_label, activity_instance_ids):
+        self._slots.acquire()
+        try:
+            return self._pool.submit(self._run, flow_label, list(activity_instance_ids))
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _run(self, flow_label, activity_instance_ids):
+        from .tasks import run_async_activities
+
+        close_old_connections()
+        try:
+            run_async_activities(flow_label, activity_instance_ids)
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            close_old_connections()
+            self._slots.release()
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+
+class AsyncioExecutor(BaseExecutor):
+    """
+    Runs the activities on an event loop in a background thread, up to
+    concurrency callbacks per batch at the same time. Meant for async def
+    callbacks: synchronous ones and all database access go through
+    sync_to_async, which runs them one at a time on a single thread.
+    """
+
+    def __init__(self, concurrency=100):
+        self.concurrency = concurrency
+        self._loop = asyncio.new_event_loop()
+        self._futures = set()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="processlib-asyncio", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, flow_label, activity_instance_ids):
+        from .tasks import arun_async_activities
+
+        future = asyncio.run_coroutine_threadsafe(
+            arun_async_activities(
+                flow_label, list(activity_instance_ids), self.concurrency
+            ),
+            self._loop,
+        )
+        self._futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        self._futures.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            logger.exception(future.exception())
+
+    def shutdown(self, wait=True):
+        if wait:
+            futures.wait(list(self._futures))
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        if wait:
+            self._thread.join()
+            self._loop.close()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    :rtype: processlib.executors.BaseExecutor
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            executor_class = import_string(
+                getattr(settings, "PROCESSLIB_ASYNC_EXECUTOR", DEFAULT_EXECUTOR)
+            )
+            _executor = executor_class(
+                **getattr(settings, "PROCESSLIB_ASYNC_EXECUTOR_OPTIONS", {})
+            )
+        return _executor
+
+
+def reset_executor(setting=None, **kwargs):
+    """
+    Shut down the current executor, the next get_executor call creates a new one.
+    """
+    global _executor
+    if setting is not None and not setting.startswith("PROCESSLIB_ASYNC_EXECUTOR"):
+        return
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown()
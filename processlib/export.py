@@ -0,0 +1,158 @@
+"""
+Streaming export of processes with their activity instance timeline.
+
+Processes are read with a server side cursor where available and their
+instances and predecessor links are fetched per chunk of processes, so memory
+use does not depend on the size of the export.
+"""
+
+import csv
+import json
+from collections import defaultdict
+from datetime import datetime, time
+from itertools import islice
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .models import ActivityInstance, Process
+
+PROCESS_FIELDS = ("id", "flow_label", "status", "started_at", "finished_at")
+ACTIVITY_FIELDS = (
+    "id",
+    "activity_name",
+    "status",
+    "instantiated_at",
+    "scheduled_at",
+    "started_at",
+    "finished_at",
+    "assigned_user_id",
+    "assigned_group_id",
+)
+EXPORT_FORMATS = ("csv", "jsonl")
+
+
+def parse_export_datetime(value):
+    """
+    Parse an ISO date or datetime, dates mean midnight in the current time zone.
+    """
+    parsed = parse_datetime(value)
+    if parsed is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError("Invalid date: {}".format(value))
+        parsed = datetime.combine(date, time())
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def get_export_queryset(
+    flow_labels=None, statuses=None, started_after=None, started_before=None
+):
+    processes = Process.objects.order_by("started_at", "pk")
+    if flow_labels is not None:
+        processes = processes.filter(flow_label__in=flow_labels)
+    if statuses:
+        processes = processes.filter(status__in=statuses)
+    if started_after is not None:
+        processes = processes.filter(started_at__gte=started_after)
+    if started_before is not None:
+        processes = processes.filter(started_at__lt=started_before)
+    return processes
+
+
+def get_activity_timelines(process_ids):
+    """
+    The activity instances of the given processes as dicts, by process id.
+    """
+    field = ActivityInstance._meta.get_field("predecessors")
+    from_name = field.m2m_field_name()
+    to_name = field.m2m_reverse_field_name()
+    predecessors = defaultdict(list)
+    for instance_id, predecessor_id in field.remote_field.through.objects.filter(
+        **{"{}__process_id__in".format(from_name): process_ids}
+    ).values_list("{}_id".format(from_name), "{}_id".format(to_name)):
+        predecessors[instance_id].append(predecessor_id)
+
+    timelines = defaultdict(list)
+    for values in (
+        ActivityInstance.objects.filter(process_id__in=process_ids)
+        .order_by("instantiated_at", "pk")
+        .values("process_id", *ACTIVITY_FIELDS)
+    ):
+        process_id = values.pop("process_id")
+        values["predecessors"] = predecessors[values["id"]]
+        timelines[process_id].append(values)
+    return timelines
+
+
+def iter_process_records(processes, chunk_size=500):
+    """
+    Yield a dict per process of the queryset, with its activity instances
+    ordered by instantiation under "activities".
+    """
+    rows = processes.values_list(*PROCESS_FIELDS).iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        timelines = get_activity_timelines([row[0] for row in chunk])
+        for row in chunk:
+            record = dict(zip(PROCESS_FIELDS, row))
+            record["activities"] = timelines[record["id"]]
+            yield record
+
+
+def iter_jsonl(records):
+    for record in records:
+        yield json.dumps(record, cls=DjangoJSONEncoder) + "\n"
+
+
+class _Echo(object):
+    def write(self, value):
+        return value
+
+
+def _format_csv_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, list):
+        return " ".join(str(item) for item in value)
+    return "" if value is None else value
+
+
+def iter_csv(records):
+    """
+    Yield CSV lines with a row per activity instance (or process without any),
+    process columns prefixed with process_ and activity columns with activity_.
+    """
+    columns = ["process_{}".format(field) for field in PROCESS_FIELDS] + [
+        "activity_{}".format(field) for field in ACTIVITY_FIELDS + ("predecessors",)
+    ]
+    writer = csv.writer(_Echo())
+    yield writer.writerow(columns)
+    for record in records:
+        process = [_format_csv_value(record[field]) for field in PROCESS_FIELDS]
+        for activity in record["activities"] or [None]:
+            if activity is None:
+                values = [""] * (len(ACTIVITY_FIELDS) + 1)
+            else:
+                values = [
+                    _format_csv_value(activity[field])
+                    for field in ACTIVITY_FIELDS + ("predecessors",)
+                ]
+            yield writer.writerow(process + values)
+
+
+def iter_export(processes, export_format="jsonl", chunk_size=500):
+    """
+    Yield the lines of the export of the processes queryset in the given format.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError("Unknown export format: {}".format(export_format))
+    records = iter_process_records(processes, chunk_size=chunk_size)
+    if export_format == "csv":
+        return iter_csv(records)
+    return iter_jsonl(records)
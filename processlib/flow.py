@@ -1,6 +1,7 @@
 from __future__ import unicode_literals
 
 from collections import OrderedDict, defaultdict
+from itertools import islice
 
 import logging
 from django.utils import timezone
@@ -32,6 +33,103 @@ def register_flow(flow):
     _FLOWS[flow.label] = flow
 
 
+class ActivityMetadata(object):
+    """
+    The static configuration of an activity, i.e. everything that can be known
+    without a process or an activity instance.
+    """
+
+    def __init__(self, activity, conditional):
+        self.name = activity.name
+        self.activity_class = type(activity)
+        self.verbose_name = activity.verbose_name
+        self.permission = activity.permission
+        self.permission_name = activity.permission_name
+        self.auto_create_permission = activity.auto_create_permission
+        self.has_view = activity.has_view()
+        self.waits = bool(activity.flow._activity_kwargs[activity.name].get("wait_for"))
+        self.conditional = conditional
+
+    def __str__(self):
+        return str(self.verbose_name or self.name)
+
+    def __repr__(self):
+        return 'ActivityMetadata(name="{}")'.format(self.name)
+
+
+class CompiledFlow(object):
+    """
+    An immutable, index based snapshot of a flow's graph.
+
+    Activities are numbered in the order they were added to the flow. All
+    tables are tuples indexed by those numbers, so resolving the successors of
+    an activity is a lookup instead of a walk over the flow's edge dicts.
+    """
+
+    def __init__(self, flow):
+        from .activity import Activity
+
+        names = tuple(flow._activities)
+        index = {name: i for i, name in enumerate(names)}
+
+        for name, successors in flow._out_edges.items():
+            for successor in [name] + successors:
+                if successor not in index:
+                    raise ValueError(
+                        "Flow {} references unknown activity {}".format(
+                            flow.label, successor
+                        )
+                    )
+
+        self.names = names
+        self.index = index
+        self.successors = tuple(
+            tuple(index[successor] for successor in flow._out_edges.get(name, ()))
+            for name in names
+        )
+        self.predecessors = tuple(
+            tuple(index[predecessor] for predecessor in flow._in_edges.get(name, ()))
+            for name in names
+        )
+        self.skip_if = tuple(
+            flow._activity_kwargs[name].get("skip_if") for name in names
+        )
+        self.conditional = tuple(
+            self.skip_if[i] is not None
+            or flow._activities[name].should_skip is not Activity.should_skip
+            for i, name in enumerate(names)
+        )
+        # built from a prototype without process or instance, once per flow
+        self.metadata = OrderedDict(
+            (
+                name,
+                ActivityMetadata(
+                    flow._get_activity_by_name(None, name), self.conditional[i]
+                ),
+            )
+            for i, name in enumerate(names)
+        )
+        self.has_any_permissions = bool(flow.permission) or any(
+            metadata.permission for metadata in self.metadata.values()
+        )
+
+    def get_next_activity_names(self, activity_name, should_skip):
+        """
+        Yield the names of the activities following activity_name.
+
+        Conditional successors are passed to should_skip (by name) and, if they
+        are skipped, replaced by their own successors. Activities without a
+        condition are never checked.
+        """
+        stack = list(reversed(self.successors[self.index[activity_name]]))
+        while stack:
+            j = stack.pop()
+            if self.conditional[j] and should_skip(self.names[j]):
+                stack.extend(reversed(self.successors[j]))
+            else:
+                yield self.names[j]
+
+
 class Flow(object):
     def __init__(
         self,
@@ -55,14 +153,34 @@ class Flow(object):
         self.description = description
         self.permission = permission
         self.auto_create_permission = auto_create_permission
+        self._compiled = None
 
         register_flow(self)
 
+    def compile(self):
+        """
+        Freeze the flow's graph into a CompiledFlow.
+
+        This happens automatically on first use and during autodiscovery, adding
+        activities afterwards discards the compiled graph.
+        """
+        if self._compiled is None:
+            self._compiled = CompiledFlow(self)
+        return self._compiled
+
     def has_any_permissions(self):
-        return self.permission or any(
-            self._get_activity_by_name(None, activity_name).permission
-            for activity_name in self._activities
-        )
+        return self.compile().has_any_permissions
+
+    def get_activity_metadata(self, activity_name):
+        """
+        :rtype: processlib.flow.ActivityMetadata
+        """
+        return self.compile().metadata[activity_name]
+
+    @property
+    def start_activity_metadata(self):
+        compiled = self.compile()
+        return compiled.metadata[compiled.names[0]]
 
     def __str__(self):
         return str(self.verbose_name or self.name)
@@ -73,6 +191,7 @@ class Flow(object):
 
         self._activities[activity_name] = activity
         self._activity_kwargs[activity_name] = activity_kwargs
+        self._compiled = None
         return self
 
     def and_then(self, activity_name, activity, **activity_kwargs):
@@ -113,6 +232,7 @@ class Flow(object):
 
         self._activities[activity_name] = activity
         self._activity_kwargs[activity_name] = activity_kwargs
+        self._compiled = None
 
         return self
 
@@ -125,14 +245,78 @@ class Flow(object):
             **self._activity_kwargs[activity_name],
         )
 
-    def get_activity_by_instance(self, instance):
+    def get_activity_by_instance(self, instance, process=None):
+        """
+        Build the activity for an instance. The process is only fetched if
+        neither the given process nor the one cached on the instance are of
+        the flow's process model.
+        """
         activity_name = instance.activity_name
-        process = self.process_model._default_manager.get(pk=instance.process_id)
+        if process is None and instance._meta.get_field("process").is_cached(instance):
+            process = instance.process
+        if not isinstance(process, self.process_model):
+            process = self.process_model._default_manager.get(pk=instance.process_id)
         kwargs = self._activity_kwargs[activity_name]
         return self._activities[activity_name](
             flow=self, process=process, instance=instance, name=activity_name, **kwargs
         )
 
+    def start_many(
+        self, rows, activity_instance_kwargs=None, user=None, chunk_size=500
+    ):
+        """
+        Start a process for every row, a dict of process field values, and
+        finish its start activity.
+
+        Rows are started in chunks with bulk inserts, see start_processes. If
+        inserting a chunk fails its rows are retried one by one so a single bad
+        row only fails itself. If instantiating the successors fails all rows of
+        the chunk fail with that exception and are not retried: the callbacks
+        of activities that ran before may have had side effects the rollback
+        doesn't undo. Use a chunk_size of 1 to isolate every row.
+
+        :return: a list with the started process or None per row, and a dict
+            mapping the indexes of the failed rows to their exception
+        """
+        from .activity import SuccessorsFailed, start_processes
+
+        processes = []
+        errors = {}
+        rows = iter(rows)
+        while True:
+            offset = len(processes)
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            try:
+                chunk_processes, chunk_errors = start_processes(
+                    self, chunk, activity_instance_kwargs, user
+                )
+            except SuccessorsFailed as e:
+                logger.exception("Starting %d %s processes failed", len(chunk), self)
+                chunk_processes = [None] * len(chunk)
+                chunk_errors = {i: e.exception for i in range(len(chunk))}
+            except Exception:
+                logger.exception("Starting %d %s processes failed", len(chunk), self)
+                chunk_processes, chunk_errors = [], {}
+                for i, row in enumerate(chunk):
+                    try:
+                        started, row_errors = start_processes(
+                            self, [row], activity_instance_kwargs, user
+                        )
+                    except SuccessorsFailed as e:
+                        started, row_errors = [None], {0: e.exception}
+                    except Exception as e:
+                        started, row_errors = [None], {0: e}
+                    chunk_processes.extend(started)
+                    if row_errors:
+                        chunk_errors[i] = row_errors[0]
+
+            processes.extend(chunk_processes)
+            for i, error in chunk_errors.items():
+                errors[offset + i] = error
+        return processes, errors
+
     def get_start_activity(
         self, process_kwargs=None, activity_instance_kwargs=None, request=None
     ):
@@ -142,6 +326,6 @@ class Flow(object):
             status=self.process_model.STATUS_STARTED,
             **(process_kwargs or {}),
         )
-        activity = self._get_activity_by_name(process, list(self._activities)[0])
+        activity = self._get_activity_by_name(process, self.compile().names[0])
         activity.instantiate(instance_kwargs=activity_instance_kwargs, request=request)
         return activity
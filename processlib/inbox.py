@@ -0,0 +1,92 @@
+"""
+The inbox is a denormalized table with one InboxEntry per activity instance
+that is something to do (instantiated or errored), keyed by its assignment.
+
+Enable it with ``PROCESSLIB_USE_INBOX = True``. The activities keep the
+entries up to date as instances are instantiated, assigned, finished,
+canceled, undone or fail. Run ``rebuild_inbox`` once after enabling it for a
+database with existing processes.
+"""
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+
+from .models import ActivityInstance, InboxEntry
+
+
+def inbox_enabled():
+    return getattr(settings, "PROCESSLIB_USE_INBOX", False)
+
+
+def _get_entry(instance, state):
+    user_id, group_id = state
+    return InboxEntry(
+        activity_instance_id=instance.pk,
+        process_id=instance.process_id,
+        flow_label=instance.process.flow_label,
+        assigned_user_id=user_id,
+        assigned_group_id=group_id,
+    )
+
+
+def update_inbox(changes):
+    """
+    Apply (instance, old to-do state, new to-do state) changes to the inbox.
+    """
+    to_create = []
+    to_delete = []
+    for instance, old_state, new_state in changes:
+        if new_state is None:
+            to_delete.append(instance.pk)
+        elif old_state is None:
+            to_create.append(_get_entry(instance, new_state))
+        else:
+            user_id, group_id = new_state
+            InboxEntry.objects.filter(activity_instance_id=instance.pk).update(
+                assigned_user_id=user_id, assigned_group_id=group_id
+            )
+
+    if to_delete:
+        InboxEntry.objects.filter(activity_instance_id__in=to_delete).delete()
+    if to_create:
+        InboxEntry.objects.bulk_create(to_create, ignore_conflicts=True)
+
+
+def get_inbox_process_ids(user, flow_labels, include_unassigned=True):
+    """
+    A values queryset of the ids of processes with something to do for the user
+    in one of the given flows, to be used as a subquery.
+    """
+    q = Q(assigned_user=user) | Q(assigned_group__in=user.groups.all())
+    if include_unassigned:
+        q |= Q(assigned_user__isnull=True, assigned_group__isnull=True)
+
+    return InboxEntry.objects.filter(q, flow_label__in=flow_labels).values("process_id")
+
+
+def rebuild_inbox(batch_size=1000):
+    """
+    Replace all inbox entries with entries computed from the activity instances.
+    """
+    instances = (
+        ActivityInstance.objects.filter(status__in=ActivityInstance.TO_DO_STATUSES)
+        .select_related("process")
+        .only(
+            "id",
+            "status",
+            "assigned_user_id",
+            "assigned_group_id",
+            "process__id",
+            "process__flow_label",
+        )
+    )
+    with transaction.atomic():
+        InboxEntry.objects.all().delete()
+        entries = []
+        for instance in instances.iterator(chunk_size=batch_size):
+            entries.append(_get_entry(instance, instance.get_to_do_state()))
+            if len(entries) >= batch_size:
+                InboxEntry.objects.bulk_create(entries)
+                entries = []
+        InboxEntry.objects.bulk_create(entries)
@@ -0,0 +1,221 @@
+"""
+Timing and query count events for the activity lifecycle methods.
+
+Every call of instantiate, start, claim, finish, cancel, undo, error,
+schedule_retry and dead_letter, and every cascade of
+_instantiate_next_activities, sends the activity_lifecycle signal with an
+ActivityEvent once it returned or raised. Nothing is measured while no receiver
+is connected.
+
+Durations and query counts include nested calls, e.g. the finish of an
+activity includes the instantiation of its successors. depth is the number of
+instrumented calls the call is nested in, so 0 marks the call that started a
+cascade. Queries are only counted with ``PROCESSLIB_INSTRUMENT_QUERIES = True``,
+which installs a connection.execute_wrapper around every call.
+
+Activities instantiated together by bulk_instantiate send an instantiate event
+each, all with the duration and query count of the whole batch and its size as
+batch_size.
+
+processes_started is sent with the flow label and the processes when processes
+were started, one by one or with Flow.start_many.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import connection
+from django.dispatch import Signal
+
+LIFECYCLE_METHODS = {
+    "instantiate": "instantiate",
+    "start": "start",
+    "finish": "finish",
+    "cancel": "cancel",
+    "undo": "undo",
+    "error": "error",
+    "claim": "claim",
+    "schedule_retry": "schedule_retry",
+    "dead_letter": "dead_letter",
+    "_instantiate_next_activities": "cascade",
+}
+
+activity_lifecycle = Signal(use_caching=True)
+processes_started = Signal()
+
+_local = threading.local()
+
+
+class ActivityEvent(object):
+    def __init__(self, activity, method, depth):
+        self.flow_label = activity.flow.label
+        self.activity_name = activity.name
+        self.activity_class = type(activity)
+        self.method = method
+        self.depth = depth
+        self.batch_size = 1
+        self.instance = activity.instance
+        self.duration = None
+        self.queries = None
+        self.exception = None
+
+    @property
+    def duration_ms(self):
+        return self.duration * 1000
+
+    def as_dict(self):
+        return {
+            "flow_label": self.flow_label,
+            "activity_name": self.activity_name,
+            "activity_class": self.activity_class.__name__,
+            "method": self.method,
+            "depth": self.depth,
+            "batch_size": self.batch_size,
+            "duration_ms": round(self.duration_ms, 3),
+            "queries": self.queries,
+            "exception": repr(self.exception) if self.exception else None,
+        }
+
+    def __repr__(self):
+        return 'ActivityEvent(flow_label="{}", activity_name="{}", method="{}")'.format(
+            self.flow_label, self.activity_name, self.method
+        )
+
+
+def _get_stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def count_queries():
+    return getattr(settings, "PROCESSLIB_INSTRUMENT_QUERIES", False)
+
+
+class _QueryCounter(object):
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def instrument(func, method):
+    """
+    Wrap the lifecycle method func of an activity class to send events.
+    """
+
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if not activity_lifecycle.has_listeners(type(self)):
+            return func(self, *args, **kwargs)
+
+        stack = _get_stack()
+        for outer in stack:
+            # a super() call of an instrumented method
+            if outer[0] is self and outer[1] == method:
+                return func(self, *args, **kwargs)
+
+        event = ActivityEvent(self, method, depth=len(stack))
+        counter = _QueryCounter() if count_queries() else None
+        stack.append((self, method))
+        started = time.perf_counter()
+        try:
+            if counter is None:
+                return func(self, *args, **kwargs)
+            with connection.execute_wrapper(counter):
+                return func(self, *args, **kwargs)
+        except Exception as e:
+            event.exception = e
+            raise
+        finally:
+            event.duration = time.perf_counter() - started
+            stack.pop()
+            if counter is not None:
+                event.queries = counter.count
+            # the instance may have been created by the call
+            event.instance = self.instance
+            activity_lifecycle.send(sender=type(self), event=event)
+
+    wrapper._instrumented = True
+    return wrapper
+
+
+@contextmanager
+def instrument_batch(activities, method):
+    """
+    Send an event per activity for the block handling all of them at once.
+    """
+    activities = [
+        activity
+        for activity in activities
+        if activity_lifecycle.has_listeners(type(activity))
+    ]
+    if not activities:
+        yield
+        return
+
+    stack = _get_stack()
+    events = [
+        ActivityEvent(activity, method, depth=len(stack)) for activity in activities
+    ]
+    counter = _QueryCounter() if count_queries() else None
+    # a marker for the depth of nested calls
+    stack.append((None, method))
+    started = time.perf_counter()
+    try:
+        if counter is None:
+            yield
+        else:
+            with connection.execute_wrapper(counter):
+                yield
+    except Exception as e:
+        for event in events:
+            event.exception = e
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        stack.pop()
+        for activity, event in zip(activities, events):
+            event.duration = duration
+            event.batch_size = len(events)
+            if counter is not None:
+                event.queries = counter.count
+            event.instance = activity.instance
+            activity_lifecycle.send(sender=type(activity), event=event)
+
+
+def instrument_class(cls):
+    for name, method in LIFECYCLE_METHODS.items():
+        func = cls.__dict__.get(name)
+        if func is not None and not getattr(func, "_instrumented", False):
+            setattr(cls, name, instrument(func, method))
+
+
+def send_processes_started(flow, processes):
+    if processes and processes_started.has_listeners(flow.process_model):
+        processes_started.send(
+            sender=flow.process_model, flow_label=flow.label, processes=processes
+        )
+
+
+@contextmanager
+def capture_activity_events():
+    """
+    Collect the events sent in the block, in the order the calls returned.
+    """
+    events = []
+
+    def receiver(event, **kwargs):
+        events.append(event)
+
+    activity_lifecycle.connect(receiver, weak=False)
+    try:
+        yield events
+    finally:
+        activity_lifecycle.disconnect(receiver)
@@ -0,0 +1,37 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from processlib.archive import archive_processes
+from processlib.export import parse_export_datetime
+
+
+class Command(BaseCommand):
+    help = "Move processes that were done or canceled before a cutoff into the archive."
+
+    def add_arguments(self, parser):
+        cutoff = parser.add_mutually_exclusive_group(required=True)
+        cutoff.add_argument(
+            "--before", help="Archive processes finished before this ISO date."
+        )
+        cutoff.add_argument(
+            "--older-than-days",
+            type=int,
+            help="Archive processes finished more than this many days ago.",
+        )
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        if options["before"]:
+            try:
+                finished_before = parse_export_datetime(options["before"])
+            except ValueError as e:
+                raise CommandError(str(e))
+        else:
+            finished_before = timezone.now() - timedelta(
+                days=options["older_than_days"]
+            )
+
+        archived = archive_processes(finished_before, batch_size=options["batch_size"])
+        self.stdout.write("Archived {} processes".format(archived))
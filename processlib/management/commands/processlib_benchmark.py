@@ -0,0 +1,54 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from processlib.benchmark import Dataset, run_benchmarks
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark transitions, inbox queries and views on a synthetic dataset "
+        "that is rolled back afterwards, and write the results as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=1000)
+        parser.add_argument("--users", type=int, default=50)
+        parser.add_argument("--groups", type=int, default=10)
+        parser.add_argument(
+            "--flows",
+            type=int,
+            default=4,
+            help="Number of synthetic flows, some requiring flow or activity "
+            "permissions, the processes are spread over.",
+        )
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--benchmark",
+            action="append",
+            dest="names",
+            help="Only run the named benchmark, may be repeated.",
+        )
+        parser.add_argument(
+            "--output", help="File to write to, defaults to standard output."
+        )
+
+    def handle(self, *args, **options):
+        dataset = Dataset(
+            processes=options["processes"],
+            users=options["users"],
+            groups=options["groups"],
+            flows=options["flows"],
+            seed=options["seed"],
+        )
+        results = run_benchmarks(
+            dataset, repeat=options["repeat"], names=options["names"]
+        )
+
+        output = json.dumps(results, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output + "\n")
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from processlib.export import (
+    EXPORT_FORMATS,
+    get_export_queryset,
+    iter_export,
+    parse_export_datetime,
+)
+
+
+class Command(BaseCommand):
+    help = "Export processes with their activity timeline as CSV or JSON lines."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--format", choices=EXPORT_FORMATS, default="jsonl", dest="export_format"
+        )
+        parser.add_argument(
+            "--flow", action="append", dest="flow_labels", help="May be repeated."
+        )
+        parser.add_argument("--status", action="append", dest="statuses")
+        parser.add_argument("--started-after", help="ISO date or datetime.")
+        parser.add_argument("--started-before", help="ISO date or datetime.")
+        parser.add_argument(
+            "--output", help="File to write to, defaults to standard output."
+        )
+        parser.add_argument("--chunk-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        filters = {}
+        for name in ("started_after", "started_before"):
+            if options[name]:
+                try:
+                    filters[name] = parse_export_datetime(options[name])
+                except ValueError as e:
+                    raise CommandError(str(e))
+
+        processes = get_export_queryset(
+            flow_labels=options["flow_labels"], statuses=options["statuses"], **filters
+        )
+        lines = iter_export(
+            processes, options["export_format"], chunk_size=options["chunk_size"]
+        )
+
+        if options["output"]:
+            with open(options["output"], "w", newline="") as output:
+                output.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending="")
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from processlib.counters import reconcile_counters
+
+
+class Command(BaseCommand):
+    help = "Recompute the process and to-do counters and fix the ones that drifted."
+
+    def handle(self, *args, **options):
+        fixed = reconcile_counters()
+        self.stdout.write("Fixed {} counters".format(fixed))
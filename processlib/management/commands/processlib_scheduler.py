@@ -0,0 +1,47 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from processlib.tasks import dispatch_due_activities
+
+
+class Command(BaseCommand):
+    help = (
+        "Dispatch due timers and retries to the async executor. Runs until "
+        "interrupted unless --once is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Dispatch everything that is due and exit.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=5,
+            help="Seconds to sleep when nothing is due (default 5).",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Instances claimed per query (default 100).",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            total = 0
+            while True:
+                dispatched = dispatch_due_activities(batch_size=options["batch_size"])
+                total += dispatched
+                if dispatched < options["batch_size"]:
+                    break
+
+            if total and options["verbosity"] > 1:
+                self.stdout.write("Dispatched {} activities".format(total))
+
+            if options["once"]:
+                return
+            time.sleep(options["interval"])
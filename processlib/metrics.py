@@ -0,0 +1,420 @@
+"""
+Process and activity metrics in the Prometheus text format.
+
+Enable them with ``PROCESSLIB_METRICS = True``. Counters and latency
+histograms are fed by the instrumentation signals in every process, e.g. web
+servers and Celery workers, and kept in the cache named by
+``PROCESSLIB_METRICS_CACHE`` (default "default"). It has to be shared by all
+processes and increment atomically, e.g. Redis or memcached. The label values
+are the registered flows and their activities. The gauges of running processes
+and open activity instances are read with aggregate queries over the open rows
+only (see processlib_ai_open_idx), cached in the same cache for
+``PROCESSLIB_METRICS_CACHE_TIMEOUT`` seconds.
+"""
+
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Count
+
+from .flow import get_flows
+from .instrumentation import activity_lifecycle, processes_started
+from .models import ActivityInstance, Process
+
+DEFAULT_BUCKETS = (0.01, 0.1, 1, 10, 60, 600, 3600, 6 * 3600, 86400, 7 * 86400)
+KEY_PREFIX = "processlib:metrics"
+GAUGE_CACHE_KEY = "{}:gauges".format(KEY_PREFIX)
+
+
+def metrics_enabled():
+    return getattr(settings, "PROCESSLIB_METRICS", False)
+
+
+def get_cache():
+    return caches[getattr(settings, "PROCESSLIB_METRICS_CACHE", "default")]
+
+
+def _incr(key, amount):
+    store = get_cache()
+    try:
+        store.incr(key, amount)
+    except ValueError:
+        if not store.add(key, amount, None):
+            store.incr(key, amount)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(
+                name,
+                str(value)
+                .replace("\\", "\\\\")
+                .replace("\n", "\\n")
+                .replace('"', '\\"'),
+            )
+            for name, value in labels
+        )
+    )
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def get_flow_labelvalues():
+    return [(label,) for label, flow in get_flows()]
+
+
+def get_activity_labelvalues():
+    return [
+        (label, name) for label, flow in get_flows() for name in flow.compile().names
+    ]
+
+
+class Metric(object):
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def samples(self):
+        """
+        (name, labels, value) tuples, labels as (name, value) pairs.
+        """
+        raise NotImplementedError
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.metric_type),
+        ]
+        for name, labels, value in self.samples():
+            lines.append(
+                "{}{} {}".format(name, _format_labels(labels), _format_value(value))
+            )
+        return "\n".join(lines) + "\n"
+
+
+class StoredMetric(Metric):
+    """
+    A metric whose values are kept in the metrics cache, for the label value
+    tuples returned by get_labelvalues.
+    """
+
+    def __init__(self, name, documentation, labelnames=(), get_labelvalues=None):
+        super(StoredMetric, self).__init__(name, documentation, labelnames)
+        self.get_labelvalues = get_labelvalues or (lambda: [()])
+
+    def get_key(self, labelvalues, suffix=""):
+        # label values may contain characters memcached doesn't allow in keys
+        digest = hashlib.md5(repr(tuple(labelvalues)).encode()).hexdigest()
+        return "{}:{}{}:{}".format(KEY_PREFIX, self.name, suffix, digest)
+
+    def get_keys(self, labelvalues):
+        return [self.get_key(labelvalues)]
+
+    def reset(self):
+        get_cache().delete_many(
+            [
+                key
+                for labelvalues in self.get_labelvalues()
+                for key in self.get_keys(labelvalues)
+            ]
+        )
+
+    def get_values(self):
+        """
+        The stored values by key, of all label value tuples, in a single cache
+        lookup.
+        """
+        return get_cache().get_many(
+            [
+                key
+                for labelvalues in self.get_labelvalues()
+                for key in self.get_keys(labelvalues)
+            ]
+        )
+
+
+class Counter(StoredMetric):
+    metric_type = "counter"
+
+    def inc(self, labelvalues=(), amount=1):
+        _incr(self.get_key(labelvalues), amount)
+
+    def get(self, labelvalues=()):
+        return get_cache().get(self.get_key(labelvalues), 0)
+
+    def samples(self):
+        values = self.get_values()
+        for labelvalues in sorted(self.get_labelvalues()):
+            key = self.get_key(labelvalues)
+            if key in values:
+                yield self.name, list(zip(self.labelnames, labelvalues)), values[key]
+
+
+class Histogram(StoredMetric):
+    """
+    Stores a count per bucket, the total count and the sum in microseconds.
+    """
+
+    metric_type = "histogram"
+
+    def __init__(
+        self,
+        name,
+        documentation,
+        labelnames=(),
+        get_labelvalues=None,
+        buckets=DEFAULT_BUCKETS,
+    ):
+        super(Histogram, self).__init__(
+            name, documentation, labelnames, get_labelvalues
+        )
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def get_keys(self, labelvalues):
+        return [
+            self.get_key(labelvalues, ":{}".format(i)) for i in range(len(self.buckets))
+        ] + [
+            self.get_key(labelvalues, ":count"),
+            self.get_key(labelvalues, ":sum"),
+        ]
+
+    def observe(self, value, labelvalues=()):
+        bucket = next(i for i, bound in enumerate(self.buckets) if value <= bound)
+        _incr(self.get_key(labelvalues, ":{}".format(bucket)), 1)
+        _incr(self.get_key(labelvalues, ":count"), 1)
+        _incr(self.get_key(labelvalues, ":sum"), int(round(value * 1000000)))
+
+    def get_count(self, labelvalues=()):
+        return get_cache().get(self.get_key(labelvalues, ":count"), 0)
+
+    def samples(self):
+        values = self.get_values()
+        for labelvalues in sorted(self.get_labelvalues()):
+            keys = self.get_keys(labelvalues)
+            if keys[-2] not in values:
+                continue
+            labels = list(zip(self.labelnames, labelvalues))
+            count = 0
+            for bound, key in zip(self.buckets, keys):
+                count += values.get(key, 0)
+                bucket_labels = labels + [("le", _format_value(bound))]
+                yield self.name + "_bucket", bucket_labels, count
+            yield self.name + "_count", labels, values[keys[-2]]
+            yield self.name + "_sum", labels, values.get(keys[-1], 0) / 1000000
+
+
+class Gauge(Metric):
+    """
+    A gauge whose samples are read from get_values, a callable returning a
+    dict of label value tuples to values.
+    """
+
+    metric_type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), get_values=None):
+        super(Gauge, self).__init__(name, documentation, labelnames)
+        self.get_values = get_values
+
+    def samples(self):
+        for labelvalues, value in sorted(self.get_values().items()):
+            yield self.name, list(zip(self.labelnames, labelvalues)), value
+
+
+def _get_buckets():
+    return getattr(settings, "PROCESSLIB_METRICS_BUCKETS", DEFAULT_BUCKETS)
+
+
+processes_started_total = Counter(
+    "processlib_processes_started_total",
+    "Processes started.",
+    ["flow"],
+    get_labelvalues=get_flow_labelvalues,
+)
+
+
+def _activity_counter(name, documentation):
+    return Counter(
+        name,
+        documentation,
+        ["flow", "activity"],
+        get_labelvalues=get_activity_labelvalues,
+    )
+
+
+activity_starts_total = _activity_counter(
+    "processlib_activity_starts_total", "Activities started."
+)
+activity_claims_total = _activity_counter(
+    "processlib_activity_claims_total", "Scheduled activities claimed by a worker."
+)
+activity_finishes_total = _activity_counter(
+    "processlib_activity_finishes_total", "Activities finished."
+)
+activity_errors_total = _activity_counter(
+    "processlib_activity_errors_total", "Activities that ended in an error."
+)
+activity_retries_total = _activity_counter(
+    "processlib_activity_retries_total", "Failed attempts scheduled to be retried."
+)
+activity_dead_letters_total = _activity_counter(
+    "processlib_activity_dead_letters_total",
+    "Activities that exhausted their retries.",
+)
+activity_cancels_total = _activity_counter(
+    "processlib_activity_cancels_total", "Activities canceled."
+)
+activity_wait_seconds = Histogram(
+    "processlib_activity_wait_seconds",
+    "Time from scheduling (or instantiation) to the start of finished activities.",
+    ["flow", "activity"],
+    get_labelvalues=get_activity_labelvalues,
+    buckets=_get_buckets(),
+)
+activity_run_seconds = Histogram(
+    "processlib_activity_run_seconds",
+    "Time from start to finish of finished activities.",
+    ["flow", "activity"],
+    get_labelvalues=get_activity_labelvalues,
+    buckets=_get_buckets(),
+)
+
+_event_counters = {
+    "start": activity_starts_total,
+    "claim": activity_claims_total,
+    "finish": activity_finishes_total,
+    "error": activity_errors_total,
+    "schedule_retry": activity_retries_total,
+    "dead_letter": activity_dead_letters_total,
+    "cancel": activity_cancels_total,
+}
+
+
+def get_open_counts():
+    """
+    The number of running processes by flow and of open activity instances
+    by flow, activity and status, cached for
+    PROCESSLIB_METRICS_CACHE_TIMEOUT seconds.
+    """
+    counts = get_cache().get(GAUGE_CACHE_KEY)
+    if counts is not None:
+        return counts
+
+    counts = {"processes": {}, "activity_instances": {}}
+    for row in (
+        Process.objects.filter(status=Process.STATUS_STARTED)
+        .order_by()
+        .values("flow_label")
+        .annotate(count=Count("pk"))
+    ):
+        counts["processes"][(row["flow_label"],)] = row["count"]
+    for row in (
+        ActivityInstance.objects.filter(status__in=ActivityInstance.OPEN_STATUSES)
+        .order_by()
+        .values("process__flow_label", "activity_name", "status")
+        .annotate(count=Count("pk"))
+    ):
+        counts["activity_instances"][
+            (row["process__flow_label"], row["activity_name"], row["status"])
+        ] = row["count"]
+
+    get_cache().set(
+        GAUGE_CACHE_KEY,
+        counts,
+        getattr(settings, "PROCESSLIB_METRICS_CACHE_TIMEOUT", 15),
+    )
+    return counts
+
+
+running_processes = Gauge(
+    "processlib_running_processes",
+    "Processes that are neither done nor canceled.",
+    ["flow"],
+    get_values=lambda: get_open_counts()["processes"],
+)
+open_activity_instances = Gauge(
+    "processlib_open_activity_instances",
+    "Activity instances that are neither done nor canceled, scheduled ones are "
+    "waiting for a worker.",
+    ["flow", "activity", "status"],
+    get_values=lambda: get_open_counts()["activity_instances"],
+)
+
+REGISTRY = [
+    processes_started_total,
+    activity_starts_total,
+    activity_claims_total,
+    activity_finishes_total,
+    activity_errors_total,
+    activity_retries_total,
+    activity_dead_letters_total,
+    activity_cancels_total,
+    activity_wait_seconds,
+    activity_run_seconds,
+    running_processes,
+    open_activity_instances,
+]
+
+
+def render_metrics(metrics=None):
+    return "".join(metric.render() for metric in metrics or REGISTRY)
+
+
+def record_activity_event(event, **kwargs):
+    counter = _event_counters.get(event.method)
+    if counter is None or event.exception is not None:
+        return
+
+    instance = event.instance
+    # claim() returns False without changes if another worker was faster
+    if event.method == "claim" and instance.status != instance.STATUS_STARTED:
+        return
+
+    labelvalues = (event.flow_label, event.activity_name)
+    counter.inc(labelvalues)
+
+    if event.method == "finish" and instance is not None and instance.started_at:
+        waiting_since = instance.scheduled_at or instance.instantiated_at
+        if waiting_since:
+            activity_wait_seconds.observe(
+                max((instance.started_at - waiting_since).total_seconds(), 0),
+                labelvalues,
+            )
+        if instance.finished_at:
+            activity_run_seconds.observe(
+                max((instance.finished_at - instance.started_at).total_seconds(), 0),
+                labelvalues,
+            )
+
+
+def record_processes_started(flow_label, processes, **kwargs):
+    processes_started_total.inc((flow_label,), len(processes))
+
+
+def update_metrics_receivers(setting=None, **kwargs):
+    """
+    Connect the receivers feeding the metrics if they are enabled, disconnect
+    them otherwise.
+    """
+    if setting is not None and setting != "PROCESSLIB_METRICS":
+        return
+    receivers = [
+        (activity_lifecycle, record_activity_event),
+        (processes_started, record_processes_started),
+    ]
+    for signal, receiver in receivers:
+        dispatch_uid = "processlib.metrics.{}".format(receiver.__name__)
+        if metrics_enabled():
+            signal.connect(receiver, dispatch_uid=dispatch_uid)
+        else:
+            signal.disconnect(receiver, dispatch_uid=dispatch_uid)
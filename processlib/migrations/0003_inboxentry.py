@@ -0,0 +1,74 @@
+# Generated by Django 4.2.30 on 2026-10-17 20:25
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("auth", "0012_alter_user_first_name_max_length"),
+        ("processlib", "0002_auto_20220525_1136"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="InboxEntry",
+            fields=[
+                (
+                    "activity_instance",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="inbox_entry",
+                        serialize=False,
+                        to="processlib.activityinstance",
+                    ),
+                ),
+                ("flow_label", models.CharField(max_length=255)),
+                (
+                    "assigned_group",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="+",
+                        to="auth.group",
+                    ),
+                ),
+                (
+                    "assigned_user",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                (
+                    "process",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="processlib.process",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Inbox entry",
+                "indexes": [
+                    models.Index(
+                        fields=["assigned_user", "flow_label", "process"],
+                        name="processlib_inbox_user_idx",
+                    ),
+                    models.Index(
+                        fields=["assigned_group", "flow_label", "process"],
+                        name="processlib_inbox_group_idx",
+                    ),
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 4.2.30 on 2026-10-17 20:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("processlib", "0003_inboxentry"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="activityinstance",
+            index=models.Index(
+                fields=["process", "status", "instantiated_at"],
+                name="processlib_ai_process_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="activityinstance",
+            index=models.Index(
+                fields=["process", "activity_name"], name="processlib_ai_name_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="activityinstance",
+            index=models.Index(
+                fields=["assigned_user", "status"], name="processlib_ai_user_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="activityinstance",
+            index=models.Index(
+                fields=["assigned_group", "status"], name="processlib_ai_group_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="activityinstance",
+            index=models.Index(
+                condition=models.Q(
+                    ("assigned_group__isnull", True),
+                    ("assigned_user__isnull", True),
+                    ("status__in", ("instantiated", "error")),
+                ),
+                fields=["process"],
+                name="processlib_ai_unassigned_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="process",
+            index=models.Index(
+                fields=["status", "flow_label"], name="processlib_process_status_idx"
+            ),
+        ),
+    ]
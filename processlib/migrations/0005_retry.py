@@ -0,0 +1,64 @@
+# Generated by Django 4.2.30 on 2026-10-17 20:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("processlib", "0004_indexes"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="activityinstance",
+            name="processlib_ai_unassigned_idx",
+        ),
+        migrations.AddField(
+            model_name="activityinstance",
+            name="attempts",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="activityinstance",
+            name="due_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name="activityinstance",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("instantiated", "instantiated"),
+                    ("scheduled", "scheduled"),
+                    ("started", "started"),
+                    ("canceled", "canceled"),
+                    ("done", "done"),
+                    ("error", "error"),
+                    ("dead_letter", "dead letter"),
+                ],
+                default="instantiated",
+                max_length=16,
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="activityinstance",
+            index=models.Index(
+                condition=models.Q(
+                    ("assigned_group__isnull", True),
+                    ("assigned_user__isnull", True),
+                    ("status__in", ("instantiated", "error", "dead_letter")),
+                ),
+                fields=["process"],
+                name="processlib_ai_unassigned_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="activityinstance",
+            index=models.Index(
+                condition=models.Q(("status", "scheduled")),
+                fields=["due_at"],
+                name="processlib_ai_due_idx",
+            ),
+        ),
+    ]
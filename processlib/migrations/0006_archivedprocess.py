@@ -0,0 +1,41 @@
+# Generated by Django 4.2.30 on 2026-10-17 20:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("processlib", "0005_retry"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ArchivedProcess",
+            fields=[
+                ("id", models.UUIDField(primary_key=True, serialize=False)),
+                ("flow_label", models.CharField(max_length=255)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("started", "started"),
+                            ("canceled", "canceled"),
+                            ("done", "done"),
+                        ],
+                        max_length=16,
+                    ),
+                ),
+                ("started_at", models.DateTimeField(blank=True, null=True)),
+                (
+                    "finished_at",
+                    models.DateTimeField(blank=True, db_index=True, null=True),
+                ),
+                ("archived_at", models.DateTimeField(auto_now_add=True)),
+                ("data", models.BinaryField()),
+            ],
+            options={
+                "verbose_name": "Archived process",
+            },
+        ),
+    ]
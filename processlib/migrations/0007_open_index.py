@@ -0,0 +1,32 @@
+# Generated by Django 4.2.30 on 2026-10-17 20:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("processlib", "0006_archivedprocess"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="activityinstance",
+            index=models.Index(
+                condition=models.Q(
+                    (
+                        "status__in",
+                        (
+                            "instantiated",
+                            "scheduled",
+                            "started",
+                            "error",
+                            "dead_letter",
+                        ),
+                    )
+                ),
+                fields=["status", "activity_name"],
+                name="processlib_ai_open_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,79 @@
+# Generated by Django 4.2.30 on 2026-10-17 20:49
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("auth", "0012_alter_user_first_name_max_length"),
+        ("processlib", "0007_open_index"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FlowStatusCount",
+            fields=[
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                ("flow_label", models.CharField(max_length=255)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("started", "started"),
+                            ("canceled", "canceled"),
+                            ("done", "done"),
+                        ],
+                        max_length=16,
+                    ),
+                ),
+                ("count", models.IntegerField(default=0)),
+            ],
+            options={
+                "verbose_name": "Flow status count",
+            },
+        ),
+        migrations.CreateModel(
+            name="ToDoCount",
+            fields=[
+                (
+                    "key",
+                    models.CharField(max_length=320, primary_key=True, serialize=False),
+                ),
+                ("flow_label", models.CharField(max_length=255)),
+                ("count", models.IntegerField(default=0)),
+                (
+                    "assigned_group",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="auth.group",
+                    ),
+                ),
+                (
+                    "assigned_user",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "To-do count",
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="flowstatuscount",
+            constraint=models.UniqueConstraint(
+                fields=("flow_label", "status"), name="processlib_flow_status_unique"
+            ),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.30 on 2026-10-17 20:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("processlib", "0008_counters"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="activityinstance",
+            name="generation",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="activityinstance",
+            name="join_mask",
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name="activityinstance",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("join_mask__isnull", False)),
+                fields=("process", "activity_name", "generation"),
+                name="processlib_ai_join_unique",
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-17 21:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("processlib", "0009_join_state"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="activityinstance",
+            name="dispatched_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
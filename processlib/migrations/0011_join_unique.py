@@ -0,0 +1,38 @@
+# Generated by Django 4.2.30 on 2026-10-17 21:20
+
+from django.db import migrations, models
+
+
+def clear_generations(apps, schema_editor):
+    """
+    Only wait instances with join state have a generation.
+    """
+    ActivityInstance = apps.get_model("processlib", "ActivityInstance")
+    ActivityInstance.objects.filter(join_mask__isnull=True).update(generation=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("processlib", "0010_dispatch_lease"),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name="activityinstance",
+            name="processlib_ai_join_unique",
+        ),
+        migrations.AlterField(
+            model_name="activityinstance",
+            name="generation",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(clear_generations, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="activityinstance",
+            constraint=models.UniqueConstraint(
+                fields=("process", "activity_name", "generation"),
+                name="processlib_ai_join_unique",
+            ),
+        ),
+    ]
@@ -1,10 +1,14 @@
+import json
 import uuid
 import string
+import zlib
 
 from django.conf import settings
 from django.contrib.auth.models import Group
 from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
+from django.utils.dateparse import parse_datetime
 from django.utils.translation import gettext_lazy as _
 
 
@@ -61,19 +65,22 @@ class Process(models.Model):
             return str(self.flow.verbose_name)
         return self.flow.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        process = super(Process, cls).from_db(db, field_names, values)
+        if all(name in process.__dict__ for name in ("status", "flow_label")):
+            process._tracked_status = process.status
+        return process
+
     @property
     def full(self):
-        return self.flow.process_model._default_manager.get(pk=self.pk)
+        process_model = self.flow.process_model
+        if isinstance(self, process_model):
+            return self
+        return process_model._default_manager.get(pk=self.pk)
 
     def can_cancel(self, user=None):
-        return (
-            self.status not in (self.STATUS_DONE, self.STATUS_CANCELED)
-            and
-            # FIXME allow cancelation of scheduled instances
-            not self._activity_instances.filter(
-                status=ActivityInstance.STATUS_SCHEDULED
-            ).exists()
-        )
+        return self.status not in (self.STATUS_DONE, self.STATUS_CANCELED)
 
     @property
     def description(self):
@@ -97,6 +104,11 @@ class Process(models.Model):
     class Meta:
         verbose_name = _("Process")
         ordering = ("-finished_at", "-started_at")
+        indexes = [
+            models.Index(
+                fields=["status", "flow_label"], name="processlib_process_status_idx"
+            ),
+        ]
 
 
 class ActivityInstance(models.Model):
@@ -106,6 +118,7 @@ class ActivityInstance(models.Model):
     STATUS_CANCELED = "canceled"
     STATUS_DONE = "done"
     STATUS_ERROR = "error"
+    STATUS_DEAD_LETTER = "dead_letter"
 
     STATUS_CHOICES = (
         (STATUS_INSTANTIATED, _("instantiated")),
@@ -114,6 +127,7 @@ class ActivityInstance(models.Model):
         (STATUS_CANCELED, _("canceled")),
         (STATUS_DONE, _("done")),
         (STATUS_ERROR, _("error")),
+        (STATUS_DEAD_LETTER, _("dead letter")),
     )
 
     status = models.CharField(
@@ -135,6 +149,17 @@ class ActivityInstance(models.Model):
     started_at = models.DateTimeField(null=True, blank=True)
     finished_at = models.DateTimeField(null=True, blank=True)
 
+    # failed attempts and, for scheduled instances, when to run the next one
+    attempts = models.PositiveIntegerField(default=0)
+    due_at = models.DateTimeField(null=True, blank=True)
+    # when dispatch_due_activities last handed the due instance to the executor
+    dispatched_at = models.DateTimeField(null=True, blank=True)
+
+    # wait instances: a bit per arrived predecessor and the loop iteration,
+    # both NULL for other instances
+    join_mask = models.BigIntegerField(null=True, blank=True)
+    generation = models.PositiveIntegerField(null=True, blank=True)
+
     modified_by = models.ForeignKey(
         settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, related_name="+"
     )
@@ -146,11 +171,41 @@ class ActivityInstance(models.Model):
         Group, on_delete=models.SET_NULL, null=True, blank=True
     )
 
+    # statuses of instances that are neither done nor canceled
+    OPEN_STATUSES = (
+        STATUS_INSTANTIATED,
+        STATUS_SCHEDULED,
+        STATUS_STARTED,
+        STATUS_ERROR,
+        STATUS_DEAD_LETTER,
+    )
+    TO_DO_STATUSES = (STATUS_INSTANTIATED, STATUS_ERROR, STATUS_DEAD_LETTER)
+    # statuses of instances that failed and have to be retried by a user
+    FAILED_STATUSES = (STATUS_ERROR, STATUS_DEAD_LETTER)
+
     def __repr__(self):
         return '{}(activity_name="{}")'.format(
             self.__class__.__name__, self.activity_name
         )
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(ActivityInstance, cls).from_db(db, field_names, values)
+        if all(
+            name in instance.__dict__
+            for name in ("status", "assigned_user_id", "assigned_group_id")
+        ):
+            instance._tracked_to_do_state = instance.get_to_do_state()
+        return instance
+
+    def get_to_do_state(self):
+        """
+        The assignment of the instance if it is something to do, None otherwise.
+        """
+        if self.status not in self.TO_DO_STATUSES:
+            return None
+        return self.assigned_user_id, self.assigned_group_id
+
     def save(
         self, force_insert=False, force_update=False, using=None, update_fields=None
     ):
@@ -160,6 +215,65 @@ class ActivityInstance(models.Model):
             force_insert, force_update, using, update_fields
         )
 
+    class Meta:
+        indexes = [
+            # current activities / to-dos of a process
+            models.Index(
+                fields=["process", "status", "instantiated_at"],
+                name="processlib_ai_process_idx",
+            ),
+            # looking up wait instances
+            models.Index(
+                fields=["process", "activity_name"], name="processlib_ai_name_idx"
+            ),
+            # processes assigned to a user or group
+            models.Index(
+                fields=["assigned_user", "status"], name="processlib_ai_user_idx"
+            ),
+            models.Index(
+                fields=["assigned_group", "status"], name="processlib_ai_group_idx"
+            ),
+            # unassigned to-dos, only created on backends with partial indexes
+            models.Index(
+                fields=["process"],
+                condition=models.Q(
+                    assigned_user__isnull=True,
+                    assigned_group__isnull=True,
+                    status__in=("instantiated", "error", "dead_letter"),
+                ),
+                name="processlib_ai_unassigned_idx",
+            ),
+            # open instances by status, e.g. for the metrics gauges
+            models.Index(
+                fields=["status", "activity_name"],
+                condition=models.Q(
+                    status__in=(
+                        "instantiated",
+                        "scheduled",
+                        "started",
+                        "error",
+                        "dead_letter",
+                    )
+                ),
+                name="processlib_ai_open_idx",
+            ),
+            # scheduled instances waiting for their due time
+            models.Index(
+                fields=["due_at"],
+                condition=models.Q(status="scheduled"),
+                name="processlib_ai_due_idx",
+            ),
+        ]
+        constraints = [
+            # a single wait instance per loop iteration, also the index used to
+            # look up the open one. Unconditional, as MySQL has no partial
+            # constraints, the NULL generation of other instances never clashes.
+            models.UniqueConstraint(
+                fields=["process", "activity_name", "generation"],
+                name="processlib_ai_join_unique",
+            ),
+        ]
+
     @property
     def has_active_successors(self):
         return self.successors.exclude(status=self.STATUS_CANCELED).exists()
@@ -167,3 +281,172 @@ class ActivityInstance(models.Model):
     @property
     def activity(self):
         return self.process.flow.get_activity_by_instance(self)
+
+
+class InboxEntry(models.Model):
+    """
+    A denormalized row for every activity instance that is something to do,
+    used to look up a user's current processes without joining and
+    de-duplicating activity instances. Only maintained if PROCESSLIB_USE_INBOX
+    is enabled, see processlib.inbox.
+    """
+
+    activity_instance = models.OneToOneField(
+        ActivityInstance,
+        primary_key=True,
+        on_delete=models.CASCADE,
+        related_name="inbox_entry",
+    )
+    process = models.ForeignKey(Process, on_delete=models.CASCADE, related_name="+")
+    flow_label = models.CharField(max_length=255)
+
+    assigned_user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="+",
+    )
+    assigned_group = models.ForeignKey(
+        Group, on_delete=models.SET_NULL, null=True, blank=True, related_name="+"
+    )
+
+    class Meta:
+        verbose_name = _("Inbox entry")
+        indexes = [
+            models.Index(
+                fields=["assigned_user", "flow_label", "process"],
+                name="processlib_inbox_user_idx",
+            ),
+            models.Index(
+                fields=["assigned_group", "flow_label", "process"],
+                name="processlib_inbox_group_idx",
+            ),
+        ]
+
+
+class FlowStatusCount(models.Model):
+    """
+    The number of processes of a flow with a status. Only maintained if
+    PROCESSLIB_USE_COUNTERS is enabled, see processlib.counters.
+    """
+
+    id = models.BigAutoField(primary_key=True)
+    flow_label = models.CharField(max_length=255)
+    status = models.CharField(max_length=16, choices=Process.STATUS_CHOICES)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name = _("Flow status count")
+        constraints = [
+            models.UniqueConstraint(
+                fields=["flow_label", "status"], name="processlib_flow_status_unique"
+            ),
+        ]
+
+
+class ToDoCount(models.Model):
+    """
+    The number of activity instances of a flow that are something to do for
+    an assignment, i.e. a user, a group, both or neither. Only maintained if
+    PROCESSLIB_USE_COUNTERS is enabled, see processlib.counters.
+    """
+
+    # flow label and assignment, unique even though the assignment may be null
+    key = models.CharField(max_length=320, primary_key=True)
+    flow_label = models.CharField(max_length=255)
+    assigned_user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name="+",
+    )
+    assigned_group = models.ForeignKey(
+        Group, on_delete=models.CASCADE, null=True, blank=True, related_name="+"
+    )
+    count = models.IntegerField(default=0)
+
+    @staticmethod
+    def get_key(flow_label, user_id, group_id):
+        return "{}:{}:{}".format(
+            flow_label,
+            "" if user_id is None else user_id,
+            "" if group_id is None else group_id,
+        )
+
+    class Meta:
+        verbose_name = _("To-do count")
+
+
+class ArchivedProcess(models.Model):
+    """
+    A finished process moved out of the process and activity instance tables
+    by processlib.archive. The process fields and the activity instance
+    timeline are kept as zlib compressed JSON in data.
+    """
+
+    id = models.UUIDField(primary_key=True)
+    flow_label = models.CharField(max_length=255)
+    status = models.CharField(max_length=16, choices=Process.STATUS_CHOICES)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+    data = models.BinaryField()
+
+    # activity instance fields stored as ISO strings
+    DATETIME_FIELDS = ("instantiated_at", "scheduled_at", "started_at", "finished_at")
+
+    def __str__(self):
+        return str(self.flow)
+
+    @property
+    def flow(self):
+        """
+        :rtype: processlib.flow.Flow
+        """
+        from .flow import get_flow
+
+        return get_flow(self.flow_label)
+
+    @property
+    def payload(self):
+        try:
+            return self._payload
+        except AttributeError:
+            self._payload = json.loads(zlib.decompress(self.data))
+            return self._payload
+
+    @payload.setter
+    def payload(self, value):
+        self._payload = value
+        self.data = zlib.compress(
+            json.dumps(value, cls=DjangoJSONEncoder).encode("utf-8")
+        )
+
+    @property
+    def description(self):
+        return self.payload["description"]
+
+    @property
+    def activities(self):
+        """
+        The activity instances as dicts ordered by instantiation, with the
+        display names of the activity and its status added.
+        """
+        statuses = dict(ActivityInstance.STATUS_CHOICES)
+        metadata = self.flow.compile().metadata
+        activities = self.payload["activities"]
+        for activity in activities:
+            for field in self.DATETIME_FIELDS:
+                if isinstance(activity.get(field), str):
+                    activity[field] = parse_datetime(activity[field])
+            name = activity["activity_name"]
+            activity["verbose_name"] = str(metadata[name]) if name in metadata else name
+            activity["status_display"] = statuses.get(
+                activity["status"], activity["status"]
+            )
+        return activities
+
+    class Meta:
+        verbose_name = _("Archived process")
@@ -0,0 +1,194 @@
+"""
+Keyset (cursor) pagination for processes.
+
+Processes are ordered by (started_at, id), newest first, and pages are
+addressed by opaque cursors that encode the position to continue from. Unlike
+page numbers this needs no OFFSET and, unless asked for, no total count, so
+deep pages cost the same as the first one.
+"""
+
+import base64
+import binascii
+import json
+from collections import OrderedDict
+
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db.models import F, Q
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class CountedPaginator(Paginator):
+    """
+    A page number paginator with a count known in advance, e.g. from a cache.
+    """
+
+    def __init__(self, object_list, per_page, count=None, **kwargs):
+        super(CountedPaginator, self).__init__(object_list, per_page, **kwargs)
+        if count is not None:
+            self.count = count
+
+
+def encode_cursor(process, reverse=False):
+    started_at = process.started_at.isoformat() if process.started_at else None
+    value = json.dumps([started_at, str(process.pk), reverse])
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, model):
+    """
+    Returns a (started_at, pk, reverse) tuple, raises InvalidCursor.
+    """
+    try:
+        value = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        started_at, pk, reverse = json.loads(value.decode())
+        if started_at is not None:
+            started_at = parse_datetime(started_at)
+            if started_at is None:
+                raise ValueError(started_at)
+        pk = model._meta.pk.to_python(pk)
+    except (ValueError, TypeError, binascii.Error, ValidationError):
+        raise InvalidCursor(cursor)
+    return started_at, pk, bool(reverse)
+
+
+class KeysetPage(object):
+    is_keyset = True
+
+    def __init__(self, object_list, paginator, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator(object):
+    def __init__(self, queryset, per_page, count_total=False):
+        self.queryset = queryset
+        self.per_page = int(per_page)
+        self.count_total = count_total
+
+    @cached_property
+    def count(self):
+        """
+        The total number of objects, None unless count_total is set.
+        """
+        if not self.count_total:
+            return None
+        return self.queryset.count()
+
+    def _get_forward_queryset(self, started_at, pk):
+        queryset = self.queryset.order_by(
+            F("started_at").desc(nulls_last=True), F("pk").desc()
+        )
+        if pk is None:
+            return queryset
+        if started_at is None:
+            return queryset.filter(started_at__isnull=True, pk__lt=pk)
+        return queryset.filter(
+            Q(started_at__lt=started_at)
+            | Q(started_at=started_at, pk__lt=pk)
+            | Q(started_at__isnull=True)
+        )
+
+    def _get_backward_queryset(self, started_at, pk):
+        queryset = self.queryset.order_by(
+            F("started_at").asc(nulls_first=True), F("pk").asc()
+        )
+        if started_at is None:
+            return queryset.filter(
+                Q(started_at__isnull=False) | Q(started_at__isnull=True, pk__gt=pk)
+            )
+        return queryset.filter(
+            Q(started_at__gt=started_at) | Q(started_at=started_at, pk__gt=pk)
+        )
+
+    def page(self, cursor=None):
+        started_at, pk, reverse = None, None, False
+        if cursor:
+            started_at, pk, reverse = decode_cursor(cursor, self.queryset.model)
+
+        if reverse:
+            queryset = self._get_backward_queryset(started_at, pk)
+        else:
+            queryset = self._get_forward_queryset(started_at, pk)
+
+        object_list = list(queryset[: self.per_page + 1])
+        has_more = len(object_list) > self.per_page
+        object_list = object_list[: self.per_page]
+
+        if reverse:
+            object_list.reverse()
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, pk is not None
+
+        next_cursor = previous_cursor = None
+        if object_list and has_next:
+            next_cursor = encode_cursor(object_list[-1])
+        if object_list and has_previous:
+            previous_cursor = encode_cursor(object_list[0], reverse=True)
+        return KeysetPage(object_list, self, next_cursor, previous_cursor)
+
+
+class ProcessCursorPagination(BasePagination):
+    """
+    Keyset pagination for the ProcessViewSet, e.g. by setting it as the
+    viewset's pagination_class.
+    """
+
+    page_size = 10
+    cursor_query_param = "cursor"
+    count_total = False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.paginator = KeysetPaginator(
+            queryset, self.page_size, count_total=self.count_total
+        )
+        try:
+            self.page = self.paginator.page(
+                request.query_params.get(self.cursor_query_param)
+            )
+        except InvalidCursor:
+            raise NotFound("Invalid cursor.")
+        return self.page.object_list
+
+    def _get_link(self, cursor):
+        if cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def get_paginated_response(self, data):
+        content = OrderedDict()
+        if self.count_total:
+            content["count"] = self.paginator.count
+        content["next"] = self._get_link(self.page.next_cursor)
+        content["previous"] = self._get_link(self.page.previous_cursor)
+        content["results"] = data
+        return Response(content)
@@ -0,0 +1,119 @@
+"""
+Per-user resolution of processlib permissions.
+
+A PermissionResolver remembers every permission it checked, the flows the user
+may see and the activities of each flow the user may do. It is cached on the
+user object, so it lives as long as the request's user, and is discarded when
+any user's groups or permissions change.
+"""
+
+import itertools
+
+from .flow import get_flows
+from .models import ActivityInstance
+
+_versions = itertools.count()
+_version = next(_versions)
+
+
+def invalidate_permission_resolvers(**kwargs):
+    global _version
+    _version = next(_versions)
+
+
+class PermissionResolver(object):
+    def __init__(self, user):
+        self.user = user
+        self.version = _version
+        self._perms = {}
+        self._flow_labels = None
+        self._activity_names = {}
+
+    def has_perm(self, perm):
+        try:
+            return self._perms[perm]
+        except KeyError:
+            result = self._perms[perm] = self.user.has_perm(perm)
+            return result
+
+    def get_permitted_flow_labels(self):
+        if self._flow_labels is None:
+            self._flow_labels = [
+                label
+                for (label, flow) in get_flows()
+                if not flow.permission or self.has_perm(flow.permission)
+            ]
+        return self._flow_labels
+
+    def get_permitted_activity_names(self, flow):
+        """
+        The names of the flow's activities that require a permission the user has.
+        """
+        try:
+            return self._activity_names[flow.label]
+        except KeyError:
+            pass
+
+        names = set()
+        for activity in flow.compile().metadata.values():
+            if activity.permission and self.has_perm(activity.permission):
+                names.add(activity.name)
+        self._activity_names[flow.label] = names
+        return names
+
+    def has_activity_perm(self, activity):
+        if activity.permission and not self.has_perm(activity.permission):
+            return False
+        if activity.flow.permission and not self.has_perm(activity.flow.permission):
+            return False
+        # if there are no required permissions we grant access
+        return True
+
+    def has_any_process_perm(self, process):
+        flow = process.flow
+        # if there are no required permissions we grant access
+        if not flow.has_any_permissions():
+            return True
+
+        if flow.permission and self.has_perm(flow.permission):
+            return True
+
+        activity_names = self.get_permitted_activity_names(flow)
+        if not activity_names:
+            return False
+
+        return (
+            process.activity_instances.filter(activity_name__in=activity_names)
+            .exclude(status=ActivityInstance.STATUS_CANCELED)
+            .exists()
+        )
+
+    def has_any_archived_process_perm(self, archived_process):
+        """
+        has_any_process_perm for an ArchivedProcess, based on its timeline.
+        """
+        flow = archived_process.flow
+        if not flow.has_any_permissions():
+            return True
+
+        if flow.permission and self.has_perm(flow.permission):
+            return True
+
+        activity_names = self.get_permitted_activity_names(flow)
+        return any(
+            activity["activity_name"] in activity_names
+            and activity["status"] != ActivityInstance.STATUS_CANCELED
+            for activity in archived_process.activities
+        )
+
+
+def get_permission_resolver(user):
+    resolver = getattr(user, "_processlib_permission_resolver", None)
+    if resolver is None or resolver.version != _version:
+        if resolver is not None:
+            # permissions changed, also drop the permissions the auth backend
+            # cached on the user
+            for attr in ("_perm_cache", "_user_perm_cache", "_group_perm_cache"):
+                user.__dict__.pop(attr, None)
+        resolver = user._processlib_permission_resolver = PermissionResolver(user)
+    return resolver
@@ -0,0 +1,48 @@
+import random
+from datetime import timedelta
+
+
+class RetryPolicy(object):
+    """
+    When and how often a failing FunctionActivity or AsyncActivity is retried.
+
+    The n-th retry waits delay * backoff ** (n - 1) seconds, at most max_delay,
+    shortened by up to jitter (a fraction of the delay) at random so that
+    activities that failed together don't retry together. Only exceptions that
+    are instances of retry_on are retried, once max_attempts attempts have
+    failed the instance goes to the dead letter status.
+    """
+
+    def __init__(
+        self,
+        max_attempts=3,
+        delay=10,
+        backoff=2,
+        max_delay=3600,
+        jitter=0.1,
+        retry_on=(Exception,),
+    ):
+        if max_attempts < 1:
+            raise ValueError("max_attempts has to be at least 1")
+        self.max_attempts = max_attempts
+        self.delay = delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.retry_on = tuple(retry_on)
+
+    def should_retry(self, attempts, exception):
+        """
+        Whether to retry after the given number of failed attempts.
+        """
+        return attempts < self.max_attempts and isinstance(exception, self.retry_on)
+
+    def get_delay(self, attempts):
+        """
+        The time to wait after the given number of failed attempts.
+
+        :rtype: datetime.timedelta
+        """
+        seconds = min(self.delay * self.backoff ** (attempts - 1), self.max_delay)
+        seconds *= 1 - random.uniform(0, self.jitter)
+        return timedelta(seconds=seconds)
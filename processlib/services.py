@@ -1,8 +1,15 @@
+from collections import defaultdict
+
 from django.db.models import Q
 from django.utils import timezone
 
+from .count_cache import get_cached_to_do_count
+from .counters import get_flow_status_counts, get_to_do_count
 from .flow import get_flow, get_flows
+from .inbox import inbox_enabled, get_inbox_process_ids
 from .models import Process, ActivityInstance
+from .permissions import get_permission_resolver
+from .tracking import track_processes
 
 
 def get_process_for_flow(flow_label, process_id):
@@ -17,6 +24,15 @@ def get_activity_for_flow(flow_label, activity_instance_id):
     return flow.get_activity_by_instance(instance)
 
 
+def _is_to_do(user, activity):
+    if not user_has_activity_perm(user, activity):
+        return False
+    return (
+        activity.has_view()
+        or activity.instance.status in activity.instance.FAILED_STATUSES
+    )
+
+
 def get_activities_to_do(user, process):
     if process.status in (process.STATUS_CANCELED, process.STATUS_DONE):
         return []
@@ -25,26 +41,79 @@ def get_activities_to_do(user, process):
         process_id=process.id
     )
     activities = []
-    for instance in instances.exclude(
-        status__in=(process.STATUS_DONE, process.STATUS_CANCELED)
+    for instance in instances.filter(
+        status__in=ActivityInstance.OPEN_STATUSES
     ).order_by("instantiated_at"):
-        activity = instance.activity
-        if not user_has_activity_perm(user, activity):
-            continue
-
-        if activity.has_view() or instance.status == instance.STATUS_ERROR:
+        activity = process.flow.get_activity_by_instance(instance, process=process)
+        if _is_to_do(user, activity):
             activities.append(activity)
     return activities
 
 
+def get_concrete_processes(processes):
+    """
+    Return the given processes as instances of their flow's process model.
+
+    Processes that are not yet instances of it are fetched with one query per
+    process model. The result keeps the order of ``processes``.
+    """
+    processes = list(processes)
+    concrete = {}
+    missing = defaultdict(list)
+    for process in processes:
+        process_model = process.flow.process_model
+        if isinstance(process, process_model):
+            concrete[process.pk] = process
+        else:
+            missing[process_model].append(process.pk)
+
+    for process_model, ids in missing.items():
+        for process in process_model._default_manager.filter(pk__in=ids):
+            concrete[process.pk] = process
+    return [concrete[process.pk] for process in processes if process.pk in concrete]
+
+
+def get_activities_to_do_bulk(user, processes):
+    """
+    get_activities_to_do for a whole page of processes.
+
+    Returns a dict mapping process ids to the activities to do. The open
+    instances of all processes are fetched with one query per activity model.
+    """
+    activities = {process.pk: [] for process in processes}
+    open_processes = {
+        process.pk: process
+        for process in get_concrete_processes(
+            process
+            for process in processes
+            if process.status not in (process.STATUS_CANCELED, process.STATUS_DONE)
+        )
+    }
+
+    process_ids_by_model = defaultdict(list)
+    for process in open_processes.values():
+        process_ids_by_model[process.flow.activity_model].append(process.pk)
+
+    for activity_model, process_ids in process_ids_by_model.items():
+        instances = activity_model._default_manager.filter(
+            process_id__in=process_ids, status__in=ActivityInstance.OPEN_STATUSES
+        ).order_by("instantiated_at")
+        for instance in instances:
+            process = open_processes[instance.process_id]
+            activity = process.flow.get_activity_by_instance(instance, process=process)
+            if _is_to_do(user, activity):
+                activities[process.pk].append(activity)
+    return activities
+
+
 def get_current_activities_in_process(process):
     instances = process.flow.activity_model._default_manager.filter(
         process_id=process.id
     )
     return (
-        instance.activity
-        for instance in instances.exclude(
-            status__in=(process.STATUS_DONE, process.STATUS_CANCELED)
+        process.flow.get_activity_by_instance(instance, process=process)
+        for instance in instances.filter(
+            status__in=ActivityInstance.OPEN_STATUSES
         ).order_by("instantiated_at")
     )
 
@@ -54,7 +123,8 @@ def get_finished_activities_in_process(process):
         process_id=process.id
     ).order_by("instantiated_at")
     return (
-        instance.activity for instance in instances.filter(status=process.STATUS_DONE)
+        process.flow.get_activity_by_instance(instance, process=process)
+        for instance in instances.filter(status=process.STATUS_DONE)
     )
 
 
@@ -63,7 +133,7 @@ def get_activities_in_process(process):
         process_id=process.id
     ).order_by("instantiated_at")
     return (
-        instance.activity
+        process.flow.get_activity_by_instance(instance, process=process)
         for instance in instances.exclude(status=process.STATUS_CANCELED)
     )
 
@@ -71,7 +141,9 @@ def get_activities_in_process(process):
 def cancel_and_undo_predecessors(activity):
     activity.cancel()
     for instance in activity.instance.predecessors.all():
-        instance.activity.undo()
+        activity.flow.get_activity_by_instance(
+            instance, process=activity.process
+        ).undo()
 
 
 def cancel_process(process, user):
@@ -84,6 +156,7 @@ def cancel_process(process, user):
     process.status = Process.STATUS_CANCELED
     process.finished_at = timezone.now()
     process.save()
+    track_processes([process])
 
 
 def get_user_processes(user, include_unassigned=True):
@@ -110,28 +183,29 @@ def get_user_current_processes(user, include_unassigned=True):
     if not user.is_authenticated:
         return Process.objects.none()
 
+    if inbox_enabled():
+        return Process.objects.filter(
+            status=Process.STATUS_STARTED,
+            pk__in=get_inbox_process_ids(
+                user,
+                get_permitted_flow_labels(user),
+                include_unassigned=include_unassigned,
+            ),
+        )
+
     q = Q(
         _activity_instances__assigned_group__in=user.groups.all(),
-        _activity_instances__status__in=(
-            ActivityInstance.STATUS_INSTANTIATED,
-            ActivityInstance.STATUS_ERROR,
-        ),
+        _activity_instances__status__in=ActivityInstance.TO_DO_STATUSES,
     ) | Q(
         _activity_instances__assigned_user=user,
-        _activity_instances__status__in=(
-            ActivityInstance.STATUS_INSTANTIATED,
-            ActivityInstance.STATUS_ERROR,
-        ),
+        _activity_instances__status__in=ActivityInstance.TO_DO_STATUSES,
     )
 
     if include_unassigned:
         q |= Q(
             _activity_instances__assigned_group__isnull=True,
             _activity_instances__assigned_user__isnull=True,
-            _activity_instances__status__in=(
-                ActivityInstance.STATUS_INSTANTIATED,
-                ActivityInstance.STATUS_ERROR,
-            ),
+            _activity_instances__status__in=ActivityInstance.TO_DO_STATUSES,
         )
 
     q &= get_permission_filter(user)
@@ -144,40 +218,65 @@ def get_user_current_processes(user, include_unassigned=True):
     )
 
 
+def get_user_current_process_count(user, include_unassigned=True):
+    return get_cached_to_do_count(
+        user,
+        "processes",
+        lambda: get_user_current_processes(
+            user, include_unassigned=include_unassigned
+        ).count(),
+        include_unassigned=include_unassigned,
+    )
+
+
+def get_user_to_do_count(user, include_unassigned=True):
+    """
+    The number of activity instances that are something to do for the user,
+    read from the counters if PROCESSLIB_USE_COUNTERS is enabled. Unlike
+    get_user_current_process_count, a process with several to-dos counts
+    several times.
+    """
+    if not user.is_authenticated:
+        return 0
+    return get_cached_to_do_count(
+        user,
+        "to-dos",
+        lambda: get_to_do_count(
+            user,
+            get_permitted_flow_labels(user),
+            include_unassigned=include_unassigned,
+        ),
+        include_unassigned=include_unassigned,
+    )
+
+
+def get_user_flow_status_counts(user):
+    """
+    The number of processes by flow label and status, for the flows the user
+    may see.
+    """
+    if not user.is_authenticated:
+        return {}
+    return get_flow_status_counts(get_permitted_flow_labels(user))
+
+
+def get_permitted_flow_labels(user):
+    return get_permission_resolver(user).get_permitted_flow_labels()
+
+
 def get_permission_filter(user):
-    flows = get_flows()
-    flows_label_list = [
-        label
-        for (label, flow) in flows
-        if not flow.permission or user.has_perm(flow.permission)
-    ]
-    return Q(_activity_instances__process__flow_label__in=flows_label_list)
+    return Q(
+        _activity_instances__process__flow_label__in=get_permitted_flow_labels(user)
+    )
 
 
 def user_has_any_process_perm(user, process):
-    # if there are no required permissions we grant access
-    if not process.flow.has_any_permissions():
-        return True
+    return get_permission_resolver(user).has_any_process_perm(process)
 
-    if process.flow.permission and user.has_perm(process.flow.permission):
-        return True
 
-    for activity in get_activities_in_process(process):
-        if activity.permission and user.has_perm(activity.permission):
-            return True
-
-    return False
+def user_has_any_archived_process_perm(user, archived_process):
+    return get_permission_resolver(user).has_any_archived_process_perm(archived_process)
 
 
 def user_has_activity_perm(user, activity):
-    if not activity.permission and not activity.flow.permission:
-        # if there are no required permissions we grant access
-        return True
-    elif activity.permission and activity.flow.permission:
-        return user.has_perm(activity.permission) and user.has_perm(
-            activity.flow.permission
-        )
-    elif activity.permission:
-        return user.has_perm(activity.permission)
-    elif activity.flow.permission:
-        return user.has_perm(activity.flow.permission)
+    return get_permission_resolver(user).has_activity_perm(activity)
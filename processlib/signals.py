@@ -44,8 +44,7 @@ def create_flow_permissions(app_config, **kwargs):
                 defaults={"name": str(flow)},
             )
         activity_content_type = ContentType.objects.get_for_model(flow.process_model)
-        for activity_name in flow._activities:
-            activity = flow._get_activity_by_name(None, activity_name)
+        for activity in flow.compile().metadata.values():
             if not activity.auto_create_permission or activity.permission is None:
                 continue
 
@@ -1,7 +1,21 @@
+import asyncio
+import threading
 import warnings
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import timedelta
 from logging import getLogger
 
-from processlib.services import get_activity_for_flow
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from processlib.executors import get_executor
+from processlib.flow import get_flow, get_flows
+from processlib.models import ActivityInstance, Process
+from processlib.services import get_concrete_processes
 
 logger = getLogger(__name__)
 
@@ -24,12 +38,218 @@ except ImportError:
 
 @shared_task(name="run_async_activity")
 def run_async_activity(flow_label, activity_instance_id):
-    activity = get_activity_for_flow(
-        flow_label, activity_instance_id=activity_instance_id
+    run_async_activities(flow_label, [activity_instance_id])
+
+
+def _get_activities(flow_label, activity_instance_ids):
+    """
+    The activities of the given instances, loading the instances and their
+    processes with one query per model. Ids that no longer exist (e.g. because
+    their transaction was rolled back) are skipped.
+    """
+    flow = get_flow(flow_label)
+    instances = flow.activity_model._default_manager.in_bulk(activity_instance_ids)
+    processes = {
+        process.pk: process
+        for process in get_concrete_processes(
+            flow.process_model._default_manager.filter(
+                pk__in={instance.process_id for instance in instances.values()}
+            )
+        )
+    }
+
+    activities = []
+    for activity_instance_id in activity_instance_ids:
+        instance = instances.get(activity_instance_id)
+        if instance is None:
+            logger.warning(
+                "Async activity %s.%s does not exist", flow_label, activity_instance_id
+            )
+            continue
+        activities.append(
+            flow.get_activity_by_instance(
+                instance, process=processes[instance.process_id]
+            )
+        )
+    return activities
+
+
+def _finish_activity(activity, run=True):
+    """
+    Run (if run) and finish the claimed activity in a savepoint. If that
+    fails the instance and process are read again, as the rollback left them.
+    """
+    instance, process = activity.instance, activity.process
+    tracked_to_do_state = getattr(instance, "_tracked_to_do_state", None)
+    tracked_status = getattr(process, "_tracked_status", None)
+    try:
+        with transaction.atomic():
+            if run:
+                activity.run()
+            activity.finish()
+    except Exception:
+        instance.refresh_from_db()
+        process.refresh_from_db()
+        instance._tracked_to_do_state = tracked_to_do_state
+        process._tracked_status = tracked_status
+        raise
+
+
+def _handle_failure(activity, exception):
+    """
+    Record the failure of a claimed activity, without letting errors of the
+    error handling stop the rest of the batch.
+    """
+    logger.exception(exception)
+    if activity.instance.status == activity.instance.STATUS_DONE:
+        return
+    try:
+        with transaction.atomic():
+            activity.handle_error(exception)
+    except Exception:
+        logger.exception(
+            "Recording the failure of async activity %r failed", activity.instance
+        )
+
+
+@shared_task(name="run_async_activities")
+def run_async_activities(flow_label, activity_instance_ids):
+    """
+    Run a batch of async activities of one flow.
+
+    Each instance is claimed before its callback runs, instances that are not
+    scheduled anymore (e.g. redelivered tasks) are skipped. Each activity runs
+    in its own savepoint, a failing one doesn't affect the others.
+    """
+    for activity in _get_activities(flow_label, activity_instance_ids):
+        if not activity.claim():
+            logger.info("Async activity %r was already claimed", activity.instance)
+            continue
+        try:
+            _finish_activity(activity)
+        except Exception as e:
+            _handle_failure(activity, e)
+
+
+async def _arun_async_activity(activity, semaphore):
+    async with semaphore:
+        if not await sync_to_async(activity.claim)():
+            logger.info("Async activity %r was already claimed", activity.instance)
+            return
+        try:
+            await activity.arun()
+            await sync_to_async(_finish_activity)(activity, run=False)
+        except Exception as e:
+            await sync_to_async(_handle_failure)(activity, e)
+
+
+async def arun_async_activities(flow_label, activity_instance_ids, concurrency=100):
+    """
+    Run a batch of async activities of one flow on the running event loop.
+
+    Up to concurrency callbacks run at the same time, async def callbacks in
+    the loop itself. Database access goes through sync_to_async.
+    """
+    activities = await sync_to_async(_get_activities)(flow_label, activity_instance_ids)
+    semaphore = asyncio.Semaphore(concurrency)
+    await asyncio.gather(
+        *(_arun_async_activity(activity, semaphore) for activity in activities)
     )
+
+
+_dispatch_buffer = threading.local()
+
+
+def get_async_batch_size():
+    return getattr(settings, "PROCESSLIB_ASYNC_BATCH_SIZE", 100)
+
+
+def _send_batches(pending):
+    executor = get_executor()
+    batch_size = get_async_batch_size()
+    for flow_label, ids in pending.items():
+        for i in range(0, len(ids), batch_size):
+            executor.submit(flow_label, ids[i : i + batch_size])
+
+
+@contextmanager
+def batch_async_dispatch():
+    """
+    Collect the async activities scheduled inside the block and send them as
+    batches to the executor once the transaction commits, instead of one
+    task per activity. Nested blocks are collected by the outermost one.
+
+    The collected activities are also sent if the block raises: instances
+    saved before, e.g. in autocommit mode, still have to run. on_commit drops
+    them if their transaction is rolled back.
+    """
+    if getattr(_dispatch_buffer, "pending", None) is not None:
+        yield
+        return
+
+    pending = _dispatch_buffer.pending = OrderedDict()
     try:
-        activity.start()
-        activity.finish()
-    except Exception as e:
-        logger.exception(e)
-        activity.error(exception=e)
+        yield
+    finally:
+        _dispatch_buffer.pending = None
+        if pending:
+            transaction.on_commit(lambda: _send_batches(pending))
+
+
+def dispatch_async_activity(flow_label, activity_instance_id):
+    """
+    Run the async activity once the current transaction commits, batched with
+    others if called inside batch_async_dispatch.
+    """
+    pending = getattr(_dispatch_buffer, "pending", None)
+    if pending is not None:
+        pending.setdefault(flow_label, []).append(activity_instance_id)
+    else:
+        transaction.on_commit(
+            lambda: get_executor().submit(flow_label, [activity_instance_id])
+        )
+
+
+def dispatch_due_activities(batch_size=100):
+    """
+    Hand up to batch_size scheduled instances whose due_at has passed (per
+    activity model) to the executor, returns how many were dispatched.
+
+    The instances are read through the partial due_at index, locked with
+    SKIP LOCKED where supported so several pollers can run at once. They keep
+    their due_at until a worker claims them, dispatched_at leases them for
+    PROCESSLIB_DISPATCH_LEASE seconds, after which instances that were lost
+    on the way to a worker are dispatched again.
+    """
+    now = timezone.now()
+    lease_expired = now - timedelta(
+        seconds=getattr(settings, "PROCESSLIB_DISPATCH_LEASE", 300)
+    )
+    dispatched = 0
+    for activity_model in {flow.activity_model for label, flow in get_flows()}:
+        manager = activity_model._default_manager
+        with transaction.atomic(using=manager.db):
+            due = manager.filter(
+                Q(dispatched_at__isnull=True) | Q(dispatched_at__lte=lease_expired),
+                status=ActivityInstance.STATUS_SCHEDULED,
+                due_at__lte=now,
+            ).order_by("due_at")
+            if connections[manager.db].features.has_select_for_update_skip_locked:
+                due = due.select_for_update(skip_locked=True)
+            rows = list(due.values_list("pk", "process_id")[:batch_size])
+            if not rows:
+                continue
+
+            manager.filter(pk__in=[pk for pk, process_id in rows]).update(
+                dispatched_at=now
+            )
+            flow_labels = dict(
+                Process.objects.filter(
+                    pk__in={process_id for pk, process_id in rows}
+                ).values_list("pk", "flow_label")
+            )
+            with batch_async_dispatch():
+                for pk, process_id in rows:
+                    dispatch_async_activity(flow_labels[process_id], pk)
+        dispatched += len(rows)
+    return dispatched
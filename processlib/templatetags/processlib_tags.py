@@ -7,7 +7,17 @@ register = template.Library()
 
 @register.simple_tag
 def get_user_current_process_count(user):
-    return len(services.get_user_current_processes(user))
+    return services.get_user_current_process_count(user)
+
+
+@register.simple_tag
+def get_user_to_do_count(user):
+    return services.get_user_to_do_count(user)
+
+
+@register.simple_tag
+def get_user_flow_status_counts(user):
+    return services.get_user_flow_status_counts(user)
 
 
 @register.filter
@@ -15,6 +25,15 @@ def get_current_activities_in_process(process):
     return services.get_current_activities_in_process(process)
 
 
-@register.simple_tag
-def get_activities_to_do(user, process):
+@register.simple_tag(takes_context=True)
+def get_activities_to_do(context, user, process):
+    # use the activities loaded by get_activities_to_do_bulk if there are any
+    activities_to_do = context.get("activities_to_do_by_process")
+    if activities_to_do is not None and process.pk in activities_to_do:
+        return activities_to_do[process.pk]
     return services.get_activities_to_do(user, process)
+
+
+@register.simple_tag
+def get_activities_to_do_bulk(user, processes):
+    return services.get_activities_to_do_bulk(user, processes)
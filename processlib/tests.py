@@ -1,11 +1,27 @@
+import asyncio
+import csv
 import json
+import uuid
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
 
-from django.db import transaction
+from asgiref.sync import async_to_sync
+from django.db import IntegrityError, connection, transaction
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group, Permission
+from django.core.cache import cache, caches
 from django.core.exceptions import PermissionDenied, ValidationError
-from django.test import TestCase, TransactionTestCase, RequestFactory
+from django.core.management import call_command
+from django.test import (
+    TestCase,
+    TransactionTestCase,
+    RequestFactory,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 
 from processlib.activity import FunctionActivity, AsyncActivity
 from processlib.forms import ProcessCancelForm
@@ -15,16 +31,44 @@ from .activity import (
     ViewActivity,
     Wait,
     StartViewActivity,
+    State,
+    TimerActivity,
 )
+from . import tasks
+from .archive import archive_processes
 from .assignment import inherit, nobody, request_user
+from .benchmark import Dataset, get_dataset_flows
+from .executors import SynchronousExecutor, get_executor, reset_executor
+from .export import get_export_queryset, iter_process_records
 from .flow import Flow
-from .models import ActivityInstance
+from .inbox import rebuild_inbox
+from .instrumentation import activity_lifecycle, capture_activity_events
+from . import metrics
+from .counters import reconcile_counters
+from .models import (
+    ActivityInstance,
+    ArchivedProcess,
+    InboxEntry,
+    Process,
+    ToDoCount,
+)
+from .pagination import InvalidCursor, KeysetPaginator, ProcessCursorPagination
+from .retry import RetryPolicy
 from .services import (
+    cancel_process,
+    get_activities_to_do,
+    get_activities_to_do_bulk,
+    get_concrete_processes,
+    get_user_current_process_count,
+    get_user_flow_status_counts,
+    get_user_to_do_count,
     get_user_processes,
     get_user_current_processes,
     get_current_activities_in_process,
 )
+from .permissions import get_permission_resolver
 from .services import user_has_activity_perm, user_has_any_process_perm
+from .services import get_permission_filter
 from .views import (
     ProcessUpdateView,
     ProcessDetailView,
@@ -52,6 +96,169 @@ class FlowTest(TestCase):
         with self.assertRaises(ValueError):
             flow.and_then("wait", Wait, wait_for=["optional"])
 
+    def test_compile_indexes_graph(self):
+        flow = (
+            Flow("compile_flow")
+            .start_with("start", StartActivity)
+            .and_then(
+                "optional",
+                ViewActivity,
+                view=ProcessUpdateView.as_view(fields=[]),
+                skip_if=lambda a: True,
+            )
+            .and_then("end", EndActivity)
+        )
+
+        compiled = flow.compile()
+
+        self.assertEqual(compiled.names, ("start", "optional", "end"))
+        self.assertEqual(compiled.successors, ((1,), (2,), ()))
+        self.assertEqual(compiled.conditional, (False, True, False))
+        self.assertIs(flow.compile(), compiled)
+
+        flow.and_then("after_end", EndActivity)
+        self.assertIsNot(flow.compile(), compiled)
+
+    def test_activity_metadata(self):
+        flow = (
+            Flow("metadata_flow")
+            .start_with("start", StartActivity)
+            .and_then(
+                "view",
+                ViewActivity,
+                view=ProcessUpdateView.as_view(fields=[]),
+                verbose_name="A view",
+                permission="processlib.metadata_permission",
+                auto_create_permission=False,
+            )
+            .and_then("wait", Wait, wait_for=["view"])
+        )
+        flow.compile()
+
+        with mock.patch.object(
+            Flow, "_get_activity_by_name", side_effect=AssertionError
+        ):
+            self.assertTrue(flow.has_any_permissions())
+            self.assertFalse(flow.start_activity_metadata.has_view)
+
+            view = flow.get_activity_metadata("view")
+            self.assertEqual(view.activity_class, ViewActivity)
+            self.assertEqual(str(view), "A view")
+            self.assertEqual(view.permission, "processlib.metadata_permission")
+            self.assertTrue(view.has_view)
+            self.assertFalse(view.waits)
+            self.assertTrue(flow.get_activity_metadata("wait").waits)
+
+            user = User.objects.create(username="metadata_user")
+            self.assertEqual(
+                get_permission_resolver(user).get_permitted_activity_names(flow),
+                set(),
+            )
+
+    def test_skipped_activities_resolve_to_their_successors(self):
+        flow = (
+            Flow("compile_skip_flow")
+            .start_with("start", StartActivity)
+            .and_then("skipped", StartActivity, skip_if=lambda a: True)
+            .and_then("also_skipped", StartActivity, skip_if=lambda a: True)
+            .and_then("end", EndActivity)
+            .add_activity("parallel", EndActivity, after="start")
+        )
+        start = flow.get_start_activity()
+
+        self.assertEqual(
+            [activity.name for activity in start._get_next_activities()],
+            ["end", "parallel"],
+        )
+
+    def test_successors_are_instantiated_in_bulk(self):
+        user = User.objects.create(username="fan_out")
+        flow = (
+            Flow("bulk_instantiate_flow")
+            .start_with("start", StartActivity)
+            .and_then("one", ViewActivity, view=ProcessUpdateView.as_view(fields=[]))
+            .add_activity(
+                "two",
+                ViewActivity,
+                after="start",
+                view=ProcessUpdateView.as_view(fields=[]),
+            )
+            .add_activity(
+                "three",
+                ViewActivity,
+                after="start",
+                view=ProcessUpdateView.as_view(fields=[]),
+                assign_to=nobody,
+            )
+        )
+        start = flow.get_start_activity(
+            activity_instance_kwargs={"assigned_user": user}
+        )
+        start.start()
+
+        with CaptureQueriesContext(connection) as queries:
+            start.finish()
+
+        inserts = [
+            query["sql"] for query in queries if query["sql"].startswith("INSERT")
+        ]
+        # process, start instance, successors, predecessor relations
+        self.assertEqual(len(inserts), 4)
+
+        instances = {
+            instance.activity_name: instance
+            for instance in start.process.activity_instances.exclude(
+                activity_name="start"
+            )
+        }
+        self.assertEqual(set(instances), {"one", "two", "three"})
+        for instance in instances.values():
+            self.assertEqual(list(instance.predecessors.all()), [start.instance])
+        self.assertEqual(instances["one"].assigned_user, user)
+        self.assertEqual(instances["two"].assigned_user, user)
+        self.assertIsNone(instances["three"].assigned_user)
+
+    def test_transition_reuses_rows_it_wrote(self):
+        flow = (
+            Flow("transition_join_flow")
+            .start_with("start", StartActivity)
+            .and_then("left", State)
+            .add_activity("right", State, after="start")
+            .add_activity("join", Wait, after="left", wait_for=["left", "right"])
+            .and_then("end", EndActivity)
+        )
+        start = flow.get_start_activity()
+        start.start()
+        start.finish()
+
+        process = start.process
+        process.refresh_from_db()
+        self.assertEqual(process.status, process.STATUS_DONE)
+        self.assertEqual(
+            {
+                instance.activity_name
+                for instance in process.activity_instances.get(
+                    activity_name="join"
+                ).predecessors.all()
+            },
+            {"left", "right"},
+        )
+        # the second arrival skips looking up the join instance
+        self.assertEqual(start.last_transition.queries_saved, 1)
+        join = process.activity_instances.get(activity_name="join")
+        self.assertEqual((join.join_mask, join.generation), (0b11, 0))
+
+    def test_activities_share_the_given_process(self):
+        start = no_permissions_test_flow.get_start_activity()
+        start.start()
+        start.finish()
+        process = start.process
+        instance = process.activity_instances.get(activity_name="start")
+
+        with self.assertNumQueries(0):
+            activity = process.flow.get_activity_by_instance(instance, process=process)
+        self.assertIs(activity.process, process)
+
     def test_assignment_inheritance(self):
         user = User.objects.create(username="assigned")
         flow = (
@@ -140,6 +347,143 @@ user_processes_test_flow = (
 )
 
 
+join_test_flow = (
+    Flow("join_test_flow")
+    .start_with("start", StartActivity)
+    .and_then("left", ViewActivity, view=ProcessUpdateView.as_view(fields=[]))
+    .add_activity(
+        "right", ViewActivity, after="start", view=ProcessUpdateView.as_view(fields=[])
+    )
+    .add_activity("join", Wait, after="left", wait_for=["left", "right"])
+    .and_then("end", EndActivity)
+)
+
+
+class JoinTest(TestCase):
+    def setUp(self):
+        start = join_test_flow.get_start_activity()
+        start.start()
+        start.finish()
+        self.process = start.process
+        self.branches = {
+            activity.name: activity
+            for activity in get_current_activities_in_process(self.process)
+        }
+
+    def finish(self, name):
+        activity = self.branches[name]
+        activity.start()
+        activity.finish()
+
+    def get_join(self, **kwargs):
+        return self.process.activity_instances.get(activity_name="join", **kwargs)
+
+    def arrive(self, name):
+        join = join_test_flow._get_activity_by_name(self.process, "join")
+        join.instantiate(predecessor=self.branches[name])
+        return join
+
+    def test_arrivals_set_bits(self):
+        self.finish("left")
+        join = self.get_join()
+        self.assertEqual((join.join_mask, join.generation), (0b01, 0))
+        self.assertEqual(join.status, join.STATUS_STARTED)
+
+        self.finish("right")
+        join = self.get_join()
+        self.assertEqual(join.join_mask, 0b11)
+        self.assertEqual(join.status, join.STATUS_DONE)
+        self.assertEqual(
+            {instance.activity_name for instance in join.predecessors.all()},
+            {"left", "right"},
+        )
+        self.process.refresh_from_db()
+        self.assertEqual(self.process.status, self.process.STATUS_DONE)
+
+    def test_arrival_after_finished_join_starts_next_generation(self):
+        self.finish("left")
+        self.finish("right")
+
+        join = self.arrive("left")
+        self.assertEqual((join.instance.join_mask, join.instance.generation), (1, 1))
+        # arriving again does not change the join
+        join = self.arrive("left")
+        self.assertEqual(join.instance.join_mask, 0b01)
+        join = self.arrive("right")
+        self.assertEqual(join.instance.status, join.instance.STATUS_DONE)
+
+        # lookup, insert in a savepoint and predecessor link, no matter how many
+        # generations there were before
+        with self.assertNumQueries(5):
+            join = self.arrive("right")
+        self.assertEqual((join.instance.join_mask, join.instance.generation), (2, 2))
+        self.assertEqual(join.instance.status, join.instance.STATUS_STARTED)
+
+    def test_instances_without_join_state_are_upgraded(self):
+        self.finish("left")
+        self.finish("right")
+        self.arrive("left")
+        # instances written before the join state existed
+        ActivityInstance.objects.filter(activity_name="join").update(
+            join_mask=None, generation=None
+        )
+
+        join = self.arrive("right")
+
+        self.assertEqual(
+            list(
+                self.process.activity_instances.filter(activity_name="join")
+                .order_by("generation")
+                .values_list("generation", "join_mask", "status")
+            ),
+            [
+                (0, 0b11, ActivityInstance.STATUS_DONE),
+                (1, 0b11, ActivityInstance.STATUS_DONE),
+            ],
+        )
+        self.assertEqual(join.instance.generation, 1)
+
+    def test_concurrent_arrival_updates_the_current_mask(self):
+        self.finish("left")
+        stale = self.get_join()
+        stale.join_mask = 0
+
+        with mock.patch.object(
+            Wait,
+            "_get_latest_instance",
+            side_effect=[stale, self.get_join()],
+        ):
+            join = self.arrive("right")
+
+        self.assertEqual(join.instance.join_mask, 0b11)
+        self.assertEqual(self.get_join().status, ActivityInstance.STATUS_DONE)
+
+    def test_generation_is_unique_for_wait_instances_only(self):
+        for i in range(2):
+            ActivityInstance.objects.create(process=self.process, activity_name="left")
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            ActivityInstance.objects.create(
+                process=self.process, activity_name="join", join_mask=0, generation=0
+            )
+            ActivityInstance.objects.create(
+                process=self.process, activity_name="join", join_mask=0, generation=0
+            )
+
+    def test_concurrent_creation_joins_the_created_instance(self):
+        self.finish("left")
+
+        with mock.patch.object(
+            Wait, "_get_latest_instance", side_effect=[None, self.get_join()]
+        ):
+            join = self.arrive("right")
+
+        self.assertEqual(join.instance.generation, 0)
+        self.assertEqual(
+            self.process.activity_instances.filter(activity_name="join").count(), 1
+        )
+        self.assertEqual(self.get_join().status, ActivityInstance.STATUS_DONE)
+
+
 class UserProcessesTest(TestCase):
     def setUp(self):
         self.user_1 = User.objects.create(username="user_1")
@@ -247,6 +591,301 @@ class UserProcessesTest(TestCase):
         self.assertSequenceEqual([], get_user_current_processes(self.user_1))
 
 
+@override_settings(PROCESSLIB_USE_INBOX=True)
+class ToDoTestCase(TestCase):
+    """
+    A user in a group, another user and a helper starting view_test_flow
+    processes with the given assignment.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username="to_do_user")
+        self.other_user = User.objects.create(username="other_to_do_user")
+        self.group = Group.objects.create(name="to_do_group")
+        self.user.groups.add(self.group)
+
+    def start_process(self, **activity_instance_kwargs):
+        start = view_test_flow.get_start_activity(
+            activity_instance_kwargs=activity_instance_kwargs
+        )
+        start.start()
+        start.finish()
+        return start.process
+
+
+class InboxTest(ToDoTestCase):
+    def test_current_processes_of_user_and_group(self):
+        user_process = self.start_process(assigned_user=self.user)
+        group_process = self.start_process(assigned_group=self.group)
+        self.start_process(assigned_user=self.other_user)
+
+        self.assertEqual(
+            set(get_user_current_processes(self.user, include_unassigned=False)),
+            {user_process, group_process},
+        )
+        self.assertEqual(
+            get_user_current_process_count(self.user, include_unassigned=False), 2
+        )
+
+    def test_unassigned_processes(self):
+        process = self.start_process()
+
+        self.assertSequenceEqual([process], get_user_current_processes(self.user))
+        self.assertSequenceEqual(
+            [], get_user_current_processes(self.user, include_unassigned=False)
+        )
+
+    def test_entries_follow_transitions(self):
+        process = self.start_process(assigned_user=self.user)
+        activity = next(get_current_activities_in_process(process))
+        self.assertEqual(InboxEntry.objects.get().activity_instance, activity.instance)
+
+        activity.assign_to(self.other_user, None)
+        self.assertEqual(InboxEntry.objects.get().assigned_user, self.other_user)
+        self.assertSequenceEqual([process], get_user_current_processes(self.other_user))
+
+        activity.start()
+        activity.finish()
+        next_activity = next(get_current_activities_in_process(process))
+        self.assertEqual(
+            InboxEntry.objects.get().activity_instance, next_activity.instance
+        )
+
+        next_activity.cancel()
+        self.assertFalse(InboxEntry.objects.exists())
+
+        activity.undo()
+        self.assertEqual(InboxEntry.objects.get().activity_instance, activity.instance)
+
+    def test_rebuild_inbox(self):
+        process = self.start_process(assigned_user=self.user)
+        InboxEntry.objects.all().delete()
+
+        rebuild_inbox()
+
+        self.assertSequenceEqual(
+            [process], get_user_current_processes(self.user, include_unassigned=False)
+        )
+
+
+@override_settings(PROCESSLIB_USE_COUNTERS=True)
+class CountersTest(ToDoTestCase):
+    def assertStatusCounts(self, **counts):
+        self.assertEqual(
+            get_user_flow_status_counts(self.user).get("view_test_flow", {}), counts
+        )
+
+    def test_to_do_counts_follow_transitions(self):
+        process = self.start_process(assigned_user=self.user)
+        self.start_process(assigned_group=self.group)
+        self.start_process(assigned_user=self.other_user)
+        self.start_process()
+
+        with self.assertNumQueries(3):
+            self.assertEqual(get_user_to_do_count(self.user), 3)
+        self.assertEqual(get_user_to_do_count(self.user, include_unassigned=False), 2)
+        self.assertEqual(get_user_to_do_count(self.other_user), 2)
+
+        activity = next(get_current_activities_in_process(process))
+        activity.assign_to(self.other_user, None)
+        self.assertEqual(get_user_to_do_count(self.user), 2)
+        self.assertEqual(get_user_to_do_count(self.other_user), 3)
+
+        activity.start()
+        activity.finish()
+        next_activity = next(get_current_activities_in_process(process))
+        next_activity.cancel()
+        self.assertEqual(get_user_to_do_count(self.other_user), 2)
+
+    def test_flow_status_counts(self):
+        process = self.start_process()
+        canceled = self.start_process()
+        view_test_flow.start_many([{}, {}])
+        self.assertStatusCounts(started=4)
+
+        cancel_process(canceled, self.user)
+        for name in ("view_one", "view_two"):
+            activity = next(get_current_activities_in_process(process))
+            activity.start()
+            activity.finish()
+        self.assertStatusCounts(started=2, done=1, canceled=1)
+
+        Process.objects.filter(pk=process.pk).update(
+            finished_at=timezone.now() - timedelta(days=1)
+        )
+        archive_processes(timezone.now() - timedelta(hours=1))
+        self.assertStatusCounts(started=2, canceled=1)
+
+    def test_reconcile_counters(self):
+        self.start_process(assigned_user=self.user)
+        self.start_process(assigned_group=self.group)
+        ActivityInstance.objects.filter(assigned_group=self.group).update(
+            assigned_group=None
+        )
+        Process.objects.update(status=Process.STATUS_DONE)
+        self.assertEqual(reconcile_counters(), 4)
+
+        self.assertStatusCounts(done=2)
+        self.assertEqual(get_user_to_do_count(self.user), 2)
+        self.assertEqual(get_user_to_do_count(self.other_user), 1)
+
+        output = StringIO()
+        call_command("processlib_reconcile_counters", stdout=output)
+        self.assertIn("Fixed 0 counters", output.getvalue())
+
+    @override_settings(PROCESSLIB_USE_COUNTERS=False)
+    def test_counts_without_counters(self):
+        self.start_process(assigned_user=self.user)
+        self.start_process(assigned_user=self.other_user)
+
+        self.assertEqual(get_user_to_do_count(self.user), 1)
+        self.assertStatusCounts(started=2)
+        self.assertFalse(ToDoCount.objects.exists())
+
+
+@override_settings(PROCESSLIB_CACHE_TO_DO_COUNTS=True)
+class CountCacheTest(ToDoTestCase):
+    def setUp(self):
+        cache.clear()
+        super(CountCacheTest, self).setUp()
+
+    def test_count_is_cached_until_a_to_do_changes(self):
+        process = self.start_process(assigned_user=self.user)
+        self.start_process(assigned_group=self.group)
+
+        self.assertEqual(get_user_current_process_count(self.user), 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_user_current_process_count(self.user), 2)
+
+        # other users' to-dos don't invalidate the count
+        self.start_process(assigned_user=self.other_user)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_user_current_process_count(self.user), 2)
+
+        self.start_process()
+        self.assertEqual(get_user_current_process_count(self.user), 3)
+        self.assertEqual(
+            get_user_current_process_count(self.user, include_unassigned=False), 2
+        )
+
+        activity = next(get_current_activities_in_process(process))
+        activity.assign_to(self.other_user, None)
+        self.assertEqual(get_user_current_process_count(self.user), 2)
+        self.assertEqual(get_user_current_process_count(self.other_user), 3)
+
+    def test_finished_process_invalidates(self):
+        flow = (
+            Flow("count_cache_parallel_flow")
+            .start_with("start", StartActivity)
+            .and_then(
+                "view", ViewActivity, view=ProcessUpdateView.as_view(), assign_to=nobody
+            )
+            .and_then("end", EndActivity, assign_to=nobody)
+            .add_activity(
+                "parallel",
+                ViewActivity,
+                after="start",
+                view=ProcessUpdateView.as_view(),
+            )
+        )
+        start = flow.get_start_activity(
+            activity_instance_kwargs={"assigned_user": self.user}
+        )
+        start.start()
+        start.finish()
+        self.assertEqual(
+            get_user_current_process_count(self.user, include_unassigned=False), 1
+        )
+
+        # the user's parallel to-do is still open, but the process is done
+        view = start.process._activity_instances.get(activity_name="view").activity
+        view.start()
+        view.finish()
+        self.assertEqual(
+            start.process._activity_instances.get(activity_name="parallel").status,
+            ActivityInstance.STATUS_INSTANTIATED,
+        )
+        self.assertEqual(
+            get_user_current_process_count(self.user, include_unassigned=False), 0
+        )
+
+    def test_group_membership_invalidates(self):
+        self.start_process(assigned_group=self.group)
+        self.assertEqual(get_user_current_process_count(self.other_user), 0)
+
+        self.other_user.groups.add(self.group)
+        self.assertEqual(get_user_current_process_count(self.other_user), 1)
+
+    def test_list_view_uses_cached_count(self):
+        for i in range(3):
+            self.start_process(assigned_user=self.user)
+        get_user_current_process_count(self.user)
+
+        request = RequestFactory().get("/")
+        request.user = self.user
+        with CaptureQueriesContext(connection) as queries:
+            response = UserCurrentProcessListView.as_view()(request)
+        self.assertEqual(response.context_data["paginator"].count, 3)
+        self.assertFalse(
+            [query for query in queries if "COUNT(" in query["sql"].upper()]
+        )
+
+
+@skipUnless(connection.vendor == "sqlite", "checks SQLite query plans")
+class IndexUsageTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="index_user")
+        self.process = Process.objects.create(flow_label="view_test_flow")
+
+    def assertUsesIndex(self, queryset, index_name):
+        self.assertIn("USING INDEX {}".format(index_name), queryset.explain())
+
+    def test_current_activities_use_process_index(self):
+        self.assertUsesIndex(
+            ActivityInstance.objects.filter(
+                process=self.process, status__in=ActivityInstance.OPEN_STATUSES
+            ).order_by("instantiated_at"),
+            "processlib_ai_process_idx",
+        )
+
+    def test_wait_lookup_uses_name_index(self):
+        self.assertUsesIndex(
+            ActivityInstance.objects.filter(process=self.process, activity_name="wait"),
+            "processlib_ai_name_idx",
+        )
+
+    def test_assignment_lookups_use_assignment_indexes(self):
+        self.assertUsesIndex(
+            ActivityInstance.objects.filter(
+                assigned_user=self.user, status__in=ActivityInstance.TO_DO_STATUSES
+            ),
+            "processlib_ai_user_idx",
+        )
+        self.assertUsesIndex(
+            ActivityInstance.objects.filter(
+                assigned_group__in=self.user.groups.all(),
+                status__in=ActivityInstance.TO_DO_STATUSES,
+            ),
+            "processlib_ai_group_idx",
+        )
+
+    def test_process_list_uses_status_index(self):
+        self.assertUsesIndex(
+            Process.objects.filter(
+                status=Process.STATUS_STARTED, flow_label__in=["view_test_flow"]
+            ),
+            "processlib_process_status_idx",
+        )
+
+    def test_due_activities_use_due_index(self):
+        self.assertUsesIndex(
+            ActivityInstance.objects.filter(
+                status=ActivityInstance.STATUS_SCHEDULED, due_at__lte=timezone.now()
+            ).order_by("due_at"),
+            "processlib_ai_due_idx",
+        )
+
+
 no_permissions_test_flow = (
     Flow("no_permissions_test_flow")
     .start_with("start", StartActivity)
@@ -372,6 +1011,46 @@ class ProcessPermissionsTest(TestCase):
         self.assertTrue(user_has_activity_perm(self.user, start))
 
 
+class PermissionResolverTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="resolver_user")
+        self.has_perm_calls = []
+        has_perm = self.user.has_perm
+
+        def counting_has_perm(perm, obj=None):
+            self.has_perm_calls.append(perm)
+            return has_perm(perm, obj)
+
+        self.user.has_perm = counting_has_perm
+
+    def test_permissions_are_checked_once(self):
+        start = combined_permissions_test_flow.get_start_activity()
+
+        for i in range(3):
+            get_permission_filter(self.user)
+            user_has_activity_perm(self.user, start)
+
+        self.assertEqual(
+            len(self.has_perm_calls), len(set(self.has_perm_calls)), self.has_perm_calls
+        )
+
+    def test_permission_changes_invalidate_resolver(self):
+        resolver = get_permission_resolver(self.user)
+        self.assertIs(get_permission_resolver(self.user), resolver)
+        self.assertNotIn(
+            flow_permissions_test_flow.label, resolver.get_permitted_flow_labels()
+        )
+
+        self.user.user_permissions.add(
+            Permission.objects.get(codename="flow_permission")
+        )
+
+        resolver = get_permission_resolver(self.user)
+        self.assertIn(
+            flow_permissions_test_flow.label, resolver.get_permitted_flow_labels()
+        )
+
+
 class ProcesslibViewPermissionTest(TestCase):
     def setUp(self):
         self.user_without_perms = User.objects.create(username="user_perms")
@@ -752,6 +1431,155 @@ class ProcesslibViewTest(TestCase):
             ).first()
         )
 
+    def test_start_many(self):
+        rows = [{} for i in range(5)] + [{"status": "bogus"}, {"no_such_field": 1}]
+        with CaptureQueriesContext(connection) as queries:
+            processes, errors = view_test_flow.start_many(
+                rows, user=self.user, chunk_size=4
+            )
+
+        self.assertEqual(sorted(errors), [5, 6])
+        self.assertIsInstance(errors[5], ValidationError)
+        self.assertEqual(processes[5:], [None, None])
+        # processes, start instances, successors and their predecessor links
+        inserts = [q for q in queries if q["sql"].startswith("INSERT")]
+        self.assertEqual(len(inserts), 8)
+
+        for process in processes[:5]:
+            self.assertEqual(
+                sorted(
+                    process._activity_instances.values_list("activity_name", "status")
+                ),
+                [
+                    ("start", ActivityInstance.STATUS_DONE),
+                    ("view_one", ActivityInstance.STATUS_INSTANTIATED),
+                ],
+            )
+            self.assertEqual(
+                process._activity_instances.get(activity_name="start").modified_by,
+                self.user,
+            )
+
+    def test_start_many_falls_back_to_single_rows(self):
+        flow = (
+            Flow("start_many_fallback_flow")
+            .start_with("start", StartActivity)
+            .and_then("state", State)
+        )
+        # the duplicate id fails the insert of the chunk and of the second row
+        pk = uuid.uuid4()
+        processes, errors = flow.start_many([{"id": pk}, {"id": pk}])
+
+        self.assertEqual(list(errors), [1])
+        self.assertIsInstance(errors[1], IntegrityError)
+        self.assertEqual(processes[0].pk, pk)
+        self.assertEqual(Process.objects.filter(flow_label=flow.label).count(), 1)
+
+    def test_start_many_does_not_repeat_successors(self):
+        flow = (
+            Flow("start_many_successors_flow")
+            .start_with("start", StartActivity)
+            .and_then("state", State)
+        )
+        with mock.patch.object(
+            State, "after_instantiate", side_effect=[None, ValueError, None]
+        ) as after_instantiate:
+            processes, errors = flow.start_many([{}, {}, {}], chunk_size=2)
+
+        # the first chunk fails as a whole, the second one is started
+        self.assertEqual(after_instantiate.call_count, 3)
+        self.assertEqual(sorted(errors), [0, 1])
+        self.assertIsInstance(errors[0], ValueError)
+        self.assertEqual(processes[:2], [None, None])
+        self.assertEqual(Process.objects.filter(flow_label=flow.label).count(), 1)
+
+    def test_process_viewset_bulk(self):
+        post = RequestFactory().post(
+            "/",
+            data={
+                "flow_label": view_test_flow.label,
+                "rows": [{}, {"status": "bogus"}, {}],
+            },
+            content_type="application/json",
+        )
+        post.user = self.user
+        post._dont_enforce_csrf_checks = True
+
+        response = ProcessViewSet.as_view({"post": "bulk"})(post)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data["created"]), 2)
+        self.assertEqual(list(response.data["errors"]), ["1"])
+        self.assertEqual(
+            Process.objects.filter(pk__in=response.data["created"]).count(), 2
+        )
+
+    def test_process_viewset_bulk_rejects_activity_data(self):
+        post = RequestFactory().post(
+            "/",
+            data={
+                "flow_label": view_test_flow.label,
+                "rows": [{}, {"activity_data": {"user": self.user.pk}}],
+            },
+            content_type="application/json",
+        )
+        post.user = self.user
+        post._dont_enforce_csrf_checks = True
+
+        response = ProcessViewSet.as_view({"post": "bulk"})(post)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("activity_data", response.data)
+        self.assertFalse(
+            Process.objects.filter(flow_label=view_test_flow.label)
+            .exclude(pk=self.process.pk)
+            .exists()
+        )
+
+    def test_activities_to_do_bulk(self):
+        processes = [self.process]
+        for i in range(2):
+            start = view_test_flow.get_start_activity()
+            start.start()
+            start.finish()
+            processes.append(start.process)
+
+        processes = list(Process.objects.filter(pk__in=[p.pk for p in processes]))
+        with self.assertNumQueries(1):
+            to_do = get_activities_to_do_bulk(self.user, processes)
+
+        for process in processes:
+            self.assertEqual(
+                [activity.instance for activity in to_do[process.pk]],
+                [
+                    activity.instance
+                    for activity in get_activities_to_do(self.user, process)
+                ],
+            )
+            self.assertEqual(len(to_do[process.pk]), 1)
+
+    def test_get_concrete_processes(self):
+        other = Process.objects.create(flow_label="view_test_flow")
+        processes = list(Process.objects.filter(pk__in=[other.pk, self.process.pk]))
+        processes.reverse()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(get_concrete_processes(processes), processes)
+            self.assertIs(processes[0].full, processes[0])
+
+    def test_process_list_queries_do_not_grow_with_rows(self):
+        url = reverse("processlib:process-list")
+        with CaptureQueriesContext(connection) as single:
+            self.client.get(url)
+
+        for i in range(3):
+            start = view_test_flow.get_start_activity()
+            start.start()
+            start.finish()
+
+        with CaptureQueriesContext(connection) as several:
+            response = self.client.get(url)
+        self.assertEqual(len(response.context["process_list"]), 4)
+        self.assertEqual(len(several), len(single))
+
     def test_process_list(self):
         url = reverse(
             "processlib:process-list",
@@ -762,6 +1590,80 @@ class ProcesslibViewTest(TestCase):
         self.assertContains(response, str(self.process.pk))
 
 
+class KeysetPaginationTest(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        self.processes = [
+            Process.objects.create(
+                flow_label="view_test_flow", started_at=now - timedelta(minutes=i)
+            )
+            for i in range(5)
+        ]
+        self.processes.append(Process.objects.create(flow_label="view_test_flow"))
+        for process in self.processes:
+            ActivityInstance.objects.create(process=process, activity_name="start")
+
+    def test_pages_forward_and_backward(self):
+        paginator = KeysetPaginator(Process.objects.all(), 2)
+
+        first = paginator.page()
+        self.assertEqual(first.object_list, self.processes[:2])
+        self.assertFalse(first.has_previous())
+
+        second = paginator.page(first.next_cursor)
+        self.assertEqual(second.object_list, self.processes[2:4])
+
+        third = paginator.page(second.next_cursor)
+        # processes without started_at come last
+        self.assertEqual(third.object_list, self.processes[4:])
+        self.assertFalse(third.has_next())
+
+        self.assertEqual(
+            paginator.page(third.previous_cursor).object_list, self.processes[2:4]
+        )
+        back_to_first = paginator.page(second.previous_cursor)
+        self.assertEqual(back_to_first.object_list, self.processes[:2])
+        self.assertFalse(back_to_first.has_previous())
+        self.assertIsNone(paginator.count)
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(InvalidCursor):
+            KeysetPaginator(Process.objects.all(), 2).page("not-a-cursor")
+
+    def test_process_list_view(self):
+        user = User.objects.create(username="cursor_user", is_superuser=True)
+        view = ProcessListView.as_view(cursor_pagination=True, paginate_by=4)
+
+        request = RequestFactory().get("/")
+        request.user = user
+        response = view(request)
+        self.assertEqual(
+            list(response.context_data["process_list"]), self.processes[:4]
+        )
+        next_cursor = response.context_data["page_obj"].next_cursor
+        self.assertContains(response, "?cursor={}".format(next_cursor))
+
+        request = RequestFactory().get("/", {"cursor": next_cursor})
+        request.user = user
+        response = view(request)
+        self.assertEqual(
+            list(response.context_data["process_list"]), self.processes[4:]
+        )
+
+    def test_process_viewset(self):
+        user = User.objects.create(username="cursor_api_user")
+        view = ProcessViewSet.as_view(
+            {"get": "list"}, pagination_class=ProcessCursorPagination
+        )
+
+        request = RequestFactory().get("/")
+        request.user = user
+        response = view(request)
+        self.assertEqual(len(response.data["results"]), 6)
+        self.assertIsNone(response.data["next"])
+        self.assertNotIn("count", response.data)
+
+
 end_direct_test_flow = (
     Flow("end_direct_test_flow")
     .start_with("start", StartActivity)
@@ -777,6 +1679,163 @@ end_direct_test_flow = (
 )
 
 
+class ExportTest(TestCase):
+    def setUp(self):
+        self.processes = []
+        for i in range(3):
+            start = view_test_flow.get_start_activity()
+            start.start()
+            start.finish()
+            self.processes.append(start.process)
+        self.processes[0].status = Process.STATUS_CANCELED
+        self.processes[0].save()
+
+    def test_records(self):
+        with self.assertNumQueries(1 + 2 * 2):
+            records = list(iter_process_records(get_export_queryset(), chunk_size=2))
+
+        self.assertEqual(
+            [record["id"] for record in records],
+            [process.pk for process in self.processes],
+        )
+        start, view_one = records[1]["activities"]
+        self.assertEqual(start["activity_name"], "start")
+        self.assertEqual(view_one["activity_name"], "view_one")
+        self.assertEqual(view_one["predecessors"], [start["id"]])
+
+    def test_export_view(self):
+        user = User.objects.create(username="export_user", is_superuser=True)
+        self.client.force_login(user)
+        response = self.client.get(
+            reverse("processlib:process-export"),
+            {"format": "jsonl", "status": "started", "flow": view_test_flow.label},
+        )
+        self.assertEqual(response.status_code, 200)
+        records = [
+            json.loads(line)
+            for line in b"".join(response.streaming_content).decode().splitlines()
+        ]
+        self.assertEqual(
+            [record["id"] for record in records],
+            [str(process.pk) for process in self.processes[1:]],
+        )
+
+        response = self.client.get(
+            reverse("processlib:process-export"), {"started_after": "tomorrow"}
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_export_command(self):
+        output = StringIO()
+        call_command("processlib_export", export_format="csv", stdout=output)
+        rows = list(csv.DictReader(StringIO(output.getvalue())))
+
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[0]["process_id"], str(self.processes[0].pk))
+        self.assertEqual(rows[1]["activity_predecessors"], rows[0]["activity_id"])
+
+
+class ArchiveTest(TestCase):
+    def setUp(self):
+        self.processes = []
+        for i in range(3):
+            start = view_test_flow.get_start_activity()
+            start.start()
+            start.finish()
+            self.processes.append(start.process)
+
+        Process.objects.filter(pk=self.processes[0].pk).update(
+            status=Process.STATUS_DONE,
+            finished_at=timezone.now() - timedelta(days=30),
+        )
+        Process.objects.filter(pk=self.processes[1].pk).update(
+            status=Process.STATUS_CANCELED, finished_at=timezone.now()
+        )
+
+    def test_archive_processes(self):
+        archived = archive_processes(timezone.now() - timedelta(days=1), batch_size=1)
+
+        self.assertEqual(archived, 1)
+        pk = self.processes[0].pk
+        self.assertFalse(Process.objects.filter(pk=pk).exists())
+        self.assertFalse(ActivityInstance.objects.filter(process_id=pk).exists())
+        self.assertEqual(Process.objects.count(), 2)
+
+        archived_process = ArchivedProcess.objects.get(pk=pk)
+        self.assertEqual(archived_process.status, Process.STATUS_DONE)
+        self.assertEqual(
+            archived_process.payload["process"]["flow_label"], "view_test_flow"
+        )
+        start, view_one = archived_process.activities
+        self.assertEqual(view_one["predecessors"], [start["id"]])
+        self.assertEqual(view_one["status_display"], "instantiated")
+
+    def test_archived_process_detail(self):
+        archive_processes(timezone.now() - timedelta(days=1))
+        user = User.objects.create(username="archive_user", is_superuser=True)
+        self.client.force_login(user)
+
+        response = self.client.get(
+            reverse("processlib:process-detail", args=[self.processes[0].pk])
+        )
+        self.assertTemplateUsed(response, "processlib/process_archived_detail.html")
+        self.assertContains(response, "view_one")
+
+        response = self.client.get(
+            reverse("processlib:process-detail", args=[uuid.uuid4()])
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_archive_command(self):
+        output = StringIO()
+        call_command("processlib_archive", older_than_days=0, stdout=output)
+        self.assertIn("Archived 2 processes", output.getvalue())
+
+
+class BenchmarkTest(TestCase):
+    def test_benchmark_command(self):
+        output = StringIO()
+        call_command(
+            "processlib_benchmark",
+            processes=6,
+            users=3,
+            groups=2,
+            flows=3,
+            repeat=2,
+            stdout=output,
+        )
+        results = json.loads(output.getvalue())
+
+        self.assertEqual(results["dataset"]["processes"], 6)
+        self.assertEqual(results["dataset"]["dataset_flows"], 3)
+        for name, result in results["results"].items():
+            self.assertNotIn("error", result, name)
+            self.assertEqual(result["repeat"], 2)
+            self.assertGreater(result["queries"], 0)
+        self.assertIn("start_finish_fan_out_join", results["results"])
+        # the dataset is rolled back
+        self.assertFalse(Process.objects.exists())
+
+    def test_dataset_flows(self):
+        dataset = Dataset(processes=12, users=2, groups=2, flows=3)
+        dataset.create()
+
+        flows = get_dataset_flows(3)
+        self.assertEqual(
+            [Process.objects.filter(flow_label=flow.label).count() for flow in flows],
+            [4, 4, 4],
+        )
+        self.assertIsNotNone(flows[0].permission)
+        self.assertTrue(flows[1].has_any_permissions())
+        self.assertFalse(flows[2].has_any_permissions())
+        self.assertEqual(
+            Group.objects.filter(
+                permissions__codename=flows[0].permission.split(".")[1]
+            ).count(),
+            1,
+        )
+
+
 class ProcesslibRedirectViewTest(TestCase):
     def setUp(self):
         self.user = User.objects.create(username="testuser")
@@ -812,6 +1871,210 @@ class ProcesslibRedirectViewTest(TestCase):
         self.assertIsNotNone(self.process.finished_at)
 
 
+class InstrumentationTest(TestCase):
+    def test_lifecycle_events(self):
+        start = end_direct_test_flow.get_start_activity()
+        with capture_activity_events() as events:
+            start.start()
+            start.finish()
+            view = next(get_current_activities_in_process(start.process))
+            view.start()
+            view.finish()
+
+        self.assertEqual(
+            [(e.activity_name, e.method, e.depth) for e in events],
+            [
+                ("start", "start", 0),
+                ("success-view", "instantiate", 2),
+                ("start", "cascade", 1),
+                ("start", "finish", 0),
+                ("success-view", "start", 0),
+                ("end", "start", 3),
+                ("end", "cascade", 4),
+                ("end", "finish", 3),
+                ("end", "instantiate", 2),
+                ("success-view", "cascade", 1),
+                ("success-view", "finish", 0),
+            ],
+        )
+        event = events[-1]
+        self.assertEqual(event.flow_label, "end_direct_test_flow")
+        self.assertIs(event.activity_class, ViewActivity)
+        self.assertEqual(event.instance, view.instance)
+        self.assertGreater(event.duration, 0)
+        self.assertIsNone(event.queries)
+        self.assertEqual(event.as_dict()["activity_class"], "ViewActivity")
+
+    def test_bulk_instantiate_events(self):
+        with capture_activity_events() as events:
+            processes, errors = view_test_flow.start_many([{}, {}])
+
+        instantiated = [e for e in events if e.method == "instantiate"]
+        self.assertEqual(
+            [(e.activity_name, e.batch_size) for e in instantiated],
+            [("view_one", 2), ("view_one", 2)],
+        )
+        self.assertEqual(
+            {e.instance.process_id for e in instantiated},
+            {process.pk for process in processes},
+        )
+
+    @override_settings(PROCESSLIB_INSTRUMENT_QUERIES=True)
+    def test_query_counts(self):
+        start = end_direct_test_flow.get_start_activity()
+        start.start()
+        with capture_activity_events() as events:
+            with CaptureQueriesContext(connection) as queries:
+                start.finish()
+
+        finish = events[-1]
+        self.assertEqual(finish.method, "finish")
+        self.assertEqual(finish.queries, len(queries))
+        self.assertLess(events[0].queries, finish.queries)
+
+    def test_exception(self):
+        start = end_direct_test_flow.get_start_activity()
+        with capture_activity_events() as events:
+            with self.assertRaises(AssertionError):
+                start.finish()
+        self.assertIsInstance(events[0].exception, AssertionError)
+
+    def test_no_receivers(self):
+        self.assertFalse(activity_lifecycle.has_listeners(StartActivity))
+        start = end_direct_test_flow.get_start_activity()
+        with mock.patch("processlib.instrumentation.ActivityEvent") as event:
+            start.start()
+            start.finish()
+        event.assert_not_called()
+
+
+@override_settings(PROCESSLIB_METRICS=True)
+class MetricsTest(TestCase):
+    def setUp(self):
+        for metric in metrics.REGISTRY:
+            if hasattr(metric, "reset"):
+                metric.reset()
+        metrics.get_cache().delete(metrics.GAUGE_CACHE_KEY)
+
+    def test_counters_and_histograms(self):
+        start = end_direct_test_flow.get_start_activity()
+        start.start()
+        start.finish()
+        view = next(get_current_activities_in_process(start.process))
+        view.start()
+        view.finish()
+        end_direct_test_flow.start_many([{}, {}])
+
+        labels = ("end_direct_test_flow", "success-view")
+        self.assertEqual(
+            metrics.processes_started_total.get(("end_direct_test_flow",)), 3
+        )
+        self.assertEqual(metrics.activity_starts_total.get(labels), 1)
+        self.assertEqual(metrics.activity_finishes_total.get(labels), 1)
+        self.assertEqual(metrics.activity_run_seconds.get_count(labels), 1)
+        self.assertEqual(metrics.activity_wait_seconds.get_count(labels), 1)
+
+        text = metrics.render_metrics()
+        self.assertIn(
+            'processlib_processes_started_total{flow="end_direct_test_flow"} 3\n',
+            text,
+        )
+        self.assertIn(
+            "processlib_activity_run_seconds_bucket"
+            '{flow="end_direct_test_flow",activity="success-view",le="+Inf"} 1\n',
+            text,
+        )
+        self.assertIn("# TYPE processlib_activity_wait_seconds histogram\n", text)
+
+    def test_async_activity_run_by_worker(self):
+        failures = [ValueError()]
+
+        def callback(activity):
+            if failures:
+                raise failures.pop()
+
+        flow = (
+            Flow("metrics_async_flow")
+            .start_with("start", StartActivity)
+            .and_then(
+                "async",
+                AsyncActivity,
+                callback=callback,
+                retry_policy=RetryPolicy(max_attempts=2, delay=0, jitter=0),
+            )
+            .and_then("end", EndActivity)
+        )
+        start = flow.get_start_activity()
+        start.start()
+        start.finish()
+        instance = start.process._activity_instances.get(activity_name="async")
+
+        # the first attempt fails and is retried, the second one finishes
+        tasks.run_async_activity(flow.label, instance.pk)
+        tasks.run_async_activity(flow.label, instance.pk)
+        tasks.run_async_activity(flow.label, instance.pk)
+        instance.refresh_from_db()
+        self.assertEqual(instance.status, ActivityInstance.STATUS_DONE)
+
+        text = metrics.render_metrics()
+        labels = '{flow="metrics_async_flow",activity="async"}'
+        self.assertIn("processlib_activity_claims_total{} 2\n".format(labels), text)
+        self.assertIn("processlib_activity_retries_total{} 1\n".format(labels), text)
+        self.assertIn("processlib_activity_finishes_total{} 1\n".format(labels), text)
+        self.assertIn(
+            "processlib_activity_run_seconds_count{} 1\n".format(labels), text
+        )
+        self.assertNotIn(
+            "processlib_activity_dead_letters_total{}".format(labels), text
+        )
+
+    def test_gauges(self):
+        end_direct_test_flow.start_many([{}, {}])
+        with self.assertNumQueries(2):
+            metrics.render_metrics()
+        with self.assertNumQueries(0):
+            text = metrics.render_metrics()
+
+        self.assertIn(
+            'processlib_running_processes{flow="end_direct_test_flow"} 2\n', text
+        )
+        self.assertIn(
+            "processlib_open_activity_instances{flow="
+            '"end_direct_test_flow",activity="success-view",status="instantiated"} 2\n',
+            text,
+        )
+
+    @override_settings(
+        CACHES={
+            "default": {
+                "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                "LOCATION": "default",
+            },
+            "metrics": {
+                "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                "LOCATION": "metrics",
+            },
+        },
+        PROCESSLIB_METRICS_CACHE="metrics",
+    )
+    def test_gauges_use_the_metrics_cache(self):
+        metrics.render_metrics()
+        self.assertIsNotNone(caches["metrics"].get(metrics.GAUGE_CACHE_KEY))
+        self.assertIsNone(caches["default"].get(metrics.GAUGE_CACHE_KEY))
+
+    def test_view(self):
+        response = self.client.get(reverse("processlib:metrics"))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            "# TYPE processlib_running_processes gauge", response.content.decode()
+        )
+
+        with override_settings(PROCESSLIB_METRICS=False):
+            response = self.client.get(reverse("processlib:metrics"))
+            self.assertFalse(activity_lifecycle.has_listeners(StartActivity))
+        self.assertEqual(response.status_code, 404)
+
+
 class ActivityTest(TestCase):
     def test_function_activity_with_error_records_error(self):
         function_error_flow = (
@@ -900,3 +2163,419 @@ class AsyncActivityTest(TransactionTestCase):
         activity_instance.refresh_from_db()
         self.assertEqual(activity_instance.status, ActivityInstance.STATUS_DONE)
         self.assertEqual(activity_instance.assigned_group.name, "side-effect")
+
+    def test_fan_out_is_dispatched_as_one_batch(self):
+        calls = []
+        flow = (
+            Flow("async_batch_flow")
+            .start_with("start", StartActivity)
+            .add_activity("a", AsyncActivity, callback=calls.append)
+            .add_activity("b", AsyncActivity, after="start", callback=calls.append)
+            .add_activity("c", AsyncActivity, after="start", callback=calls.append)
+        )
+        start = flow.get_start_activity()
+
+        with mock.patch.object(tasks.run_async_activities, "delay") as delay:
+            with transaction.atomic():
+                start.start()
+                start.finish()
+                delay.assert_not_called()
+
+        instances = start.process._activity_instances.exclude(activity_name="start")
+        ids = [instance.pk for instance in instances.order_by("activity_name")]
+        delay.assert_called_once_with("async_batch_flow", ids)
+
+        # a rolled back id is skipped
+        tasks.run_async_activities("async_batch_flow", ids + [uuid.uuid4()])
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(
+            {instance.status for instance in instances},
+            {ActivityInstance.STATUS_DONE},
+        )
+
+    def run_fan_out(self, flow_label):
+        calls = []
+        flow = (
+            Flow(flow_label)
+            .start_with("start", StartActivity)
+            .add_activity("a", AsyncActivity, callback=calls.append)
+            .add_activity("b", AsyncActivity, after="start", callback=calls.append)
+        )
+        start = flow.get_start_activity()
+        with transaction.atomic():
+            start.start()
+            start.finish()
+        return start.process, calls
+
+    @override_settings(
+        PROCESSLIB_ASYNC_EXECUTOR="processlib.executors.SynchronousExecutor"
+    )
+    def test_synchronous_executor(self):
+        self.assertIsInstance(get_executor(), SynchronousExecutor)
+        with mock.patch.object(tasks.run_async_activities, "delay") as delay:
+            process, calls = self.run_fan_out("sync_executor_flow")
+
+        delay.assert_not_called()
+        self.assertEqual(len(calls), 2)
+
+    @override_settings(
+        PROCESSLIB_ASYNC_EXECUTOR="processlib.executors.ThreadPoolExecutor",
+        PROCESSLIB_ASYNC_EXECUTOR_OPTIONS={"max_workers": 2, "max_queue_size": 1},
+        PROCESSLIB_ASYNC_BATCH_SIZE=1,
+    )
+    def test_thread_pool_executor(self):
+        process, calls = self.run_fan_out("thread_pool_executor_flow")
+        reset_executor()  # waits for the running activities
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(
+            set(
+                process._activity_instances.exclude(activity_name="start").values_list(
+                    "status", flat=True
+                )
+            ),
+            {ActivityInstance.STATUS_DONE},
+        )
+
+    def test_coroutine_callback_runs_without_loop(self):
+        calls = []
+
+        async def callback(activity):
+            await asyncio.sleep(0)
+            calls.append(activity.name)
+
+        flow = (
+            Flow("coroutine_callback_flow")
+            .start_with("start", StartActivity)
+            .and_then("async", AsyncActivity, callback=callback)
+        )
+        start = flow.get_start_activity()
+        with transaction.atomic():
+            start.start()
+            start.finish()
+
+        self.assertEqual(calls, ["async"])
+        self.assertEqual(
+            start.process._activity_instances.get(activity_name="async").status,
+            ActivityInstance.STATUS_DONE,
+        )
+
+    @override_settings(PROCESSLIB_ASYNC_EXECUTOR="processlib.executors.AsyncioExecutor")
+    def test_asyncio_executor_runs_callbacks_concurrently(self):
+        running = []
+        overlapped = []
+
+        async def callback(activity):
+            running.append(activity.name)
+            await asyncio.sleep(0.05)
+            overlapped.append(len(running) > 1)
+            if activity.name == "fail":
+                raise ValueError()
+
+        flow = (
+            Flow("asyncio_executor_flow")
+            .start_with("start", StartActivity)
+            .add_activity("a", AsyncActivity, callback=callback)
+            .add_activity("b", AsyncActivity, after="start", callback=callback)
+            .add_activity("fail", AsyncActivity, after="start", callback=callback)
+        )
+        start = flow.get_start_activity()
+        with transaction.atomic():
+            start.start()
+            start.finish()
+        reset_executor()  # waits for the running activities
+
+        self.assertTrue(all(overlapped))
+        self.assertEqual(
+            dict(
+                start.process._activity_instances.exclude(
+                    activity_name="start"
+                ).values_list("activity_name", "status")
+            ),
+            {
+                "a": ActivityInstance.STATUS_DONE,
+                "b": ActivityInstance.STATUS_DONE,
+                "fail": ActivityInstance.STATUS_ERROR,
+            },
+        )
+
+    def start_failing_batch(self, flow_label):
+        calls = []
+        flow = (
+            Flow(flow_label)
+            .start_with("start", StartActivity)
+            .add_activity("a", AsyncActivity, callback=calls.append)
+            .add_activity("after_a", State, after="a")
+            .add_activity("b", AsyncActivity, after="start", callback=calls.append)
+        )
+        start = flow.get_start_activity()
+        with mock.patch.object(tasks.run_async_activities, "delay"):
+            start.start()
+            start.finish()
+        instances = start.process._activity_instances.filter(
+            activity_name__in=["a", "b"]
+        )
+        return instances, calls
+
+    def assert_failure_is_isolated(self, instances, calls):
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(
+            dict(instances.values_list("activity_name", "status")),
+            {"a": ActivityInstance.STATUS_ERROR, "b": ActivityInstance.STATUS_DONE},
+        )
+
+    def test_failing_finish_does_not_stop_the_batch(self):
+        instances, calls = self.start_failing_batch("async_failing_batch_flow")
+        ids = [instance.pk for instance in instances.order_by("activity_name")]
+
+        # the finish of a saves it as done before its successor fails
+        with mock.patch.object(
+            State, "after_instantiate", side_effect=[ValueError, None]
+        ):
+            tasks.run_async_activities("async_failing_batch_flow", ids)
+
+        self.assert_failure_is_isolated(instances, calls)
+        self.assertFalse(
+            ActivityInstance.objects.filter(
+                process=instances[0].process, activity_name="after_a"
+            ).exists()
+        )
+
+    def test_failing_finish_does_not_stop_the_async_batch(self):
+        instances, calls = self.start_failing_batch("async_failing_abatch_flow")
+        ids = [instance.pk for instance in instances.order_by("activity_name")]
+
+        with mock.patch.object(
+            State, "after_instantiate", side_effect=[ValueError, None]
+        ):
+            async_to_sync(tasks.arun_async_activities)("async_failing_abatch_flow", ids)
+
+        self.assert_failure_is_isolated(instances, calls)
+
+    def test_batch_is_dispatched_if_the_cascade_fails(self):
+        def fail(activity):
+            raise ValueError()
+
+        flow = (
+            Flow("async_failing_cascade_flow")
+            .start_with("start", StartActivity)
+            .add_activity("a", AsyncActivity, callback=lambda activity: None)
+            .add_activity("state", State, after="start")
+            .add_activity("skipped", State, after="state", skip_if=fail)
+        )
+        start = flow.get_start_activity()
+        with mock.patch.object(tasks.run_async_activity, "delay") as delay:
+            start.start()
+            with self.assertRaises(ValueError):
+                start.finish()
+
+        instance = start.process._activity_instances.get(activity_name="a")
+        delay.assert_called_once_with("async_failing_cascade_flow", instance.pk)
+
+    def test_duplicate_delivery_is_a_no_op(self):
+        calls = []
+        flow = (
+            Flow("duplicate_delivery_flow")
+            .start_with("start", StartActivity)
+            .and_then("async", AsyncActivity, callback=calls.append)
+        )
+        start = flow.get_start_activity()
+        with mock.patch.object(tasks.run_async_activity, "delay"):
+            start.start()
+            start.finish()
+        instance = start.process._activity_instances.get(activity_name="async")
+        self.assertEqual(instance.status, ActivityInstance.STATUS_SCHEDULED)
+
+        tasks.run_async_activity("duplicate_delivery_flow", instance.pk)
+        with self.assertNumQueries(3):
+            tasks.run_async_activities("duplicate_delivery_flow", [instance.pk])
+
+        self.assertEqual(len(calls), 1)
+        instance.refresh_from_db()
+        self.assertEqual(instance.status, ActivityInstance.STATUS_DONE)
+        self.assertIsNotNone(instance.started_at)
+
+
+@override_settings(PROCESSLIB_ASYNC_EXECUTOR="processlib.executors.SynchronousExecutor")
+class RetryTest(TransactionTestCase):
+    def setUp(self):
+        self.failures = []
+
+    def callback(self, activity):
+        if self.failures:
+            raise self.failures.pop(0)
+
+    def start_flow(self, label, activity_class, retry_policy):
+        flow = (
+            Flow(label)
+            .start_with("start", StartActivity)
+            .and_then(
+                "work",
+                activity_class,
+                callback=self.callback,
+                retry_policy=retry_policy,
+            )
+            .and_then("end", EndActivity)
+        )
+        start = flow.get_start_activity()
+        start.start()
+        start.finish()
+        return start.process._activity_instances.get(activity_name="work")
+
+    def make_due(self, instance):
+        ActivityInstance.objects.filter(pk=instance.pk).update(
+            due_at=timezone.now() - timedelta(seconds=1)
+        )
+
+    def test_policy_delays(self):
+        policy = RetryPolicy(delay=10, backoff=2, max_delay=30, jitter=0)
+        self.assertEqual(
+            [policy.get_delay(attempts).total_seconds() for attempts in (1, 2, 3)],
+            [10, 20, 30],
+        )
+        jittered = RetryPolicy(delay=10, jitter=0.5).get_delay(1).total_seconds()
+        self.assertTrue(5 <= jittered <= 10)
+        self.assertFalse(RetryPolicy(retry_on=[KeyError]).should_retry(1, ValueError()))
+
+    def test_async_activity_is_retried_when_due(self):
+        self.failures = [ValueError()]
+        instance = self.start_flow("retry_async_flow", AsyncActivity, RetryPolicy())
+
+        self.assertEqual(instance.status, ActivityInstance.STATUS_SCHEDULED)
+        self.assertEqual(instance.attempts, 1)
+        self.assertGreater(instance.due_at, timezone.now())
+        self.assertEqual(tasks.dispatch_due_activities(), 0)
+
+        self.make_due(instance)
+        self.assertEqual(tasks.dispatch_due_activities(), 1)
+        instance.refresh_from_db()
+        self.assertEqual(instance.status, ActivityInstance.STATUS_DONE)
+        self.assertIsNone(instance.due_at)
+        self.assertIsNone(instance.dispatched_at)
+
+    def test_lost_dispatch_is_repeated_after_lease(self):
+        self.failures = [ValueError()]
+        instance = self.start_flow("retry_lease_flow", AsyncActivity, RetryPolicy())
+        self.make_due(instance)
+
+        # the executor lost the submission, the instance keeps its due_at
+        with mock.patch("processlib.tasks.get_executor"):
+            self.assertEqual(tasks.dispatch_due_activities(), 1)
+        instance.refresh_from_db()
+        self.assertEqual(instance.status, ActivityInstance.STATUS_SCHEDULED)
+        self.assertIsNotNone(instance.due_at)
+        self.assertIsNotNone(instance.dispatched_at)
+        self.assertEqual(tasks.dispatch_due_activities(), 0)
+
+        with override_settings(PROCESSLIB_DISPATCH_LEASE=0):
+            self.assertEqual(tasks.dispatch_due_activities(), 1)
+        instance.refresh_from_db()
+        self.assertEqual(instance.status, ActivityInstance.STATUS_DONE)
+
+    def test_done_instance_is_not_rescheduled(self):
+        instance = self.start_flow("retry_done_flow", AsyncActivity, RetryPolicy())
+        self.assertEqual(instance.status, ActivityInstance.STATUS_DONE)
+        with self.assertRaises(AssertionError):
+            instance.activity.schedule_retry(timedelta(seconds=1))
+
+    def test_function_activity_is_dead_lettered(self):
+        self.failures = [ValueError(), ValueError()]
+        instance = self.start_flow(
+            "retry_function_flow", FunctionActivity, RetryPolicy(max_attempts=2)
+        )
+        self.assertEqual(instance.status, ActivityInstance.STATUS_SCHEDULED)
+
+        self.make_due(instance)
+        tasks.dispatch_due_activities()
+        instance.refresh_from_db()
+        self.assertEqual(instance.status, ActivityInstance.STATUS_DEAD_LETTER)
+        self.assertEqual(instance.attempts, 2)
+
+        instance.activity.retry()
+        instance.refresh_from_db()
+        self.assertEqual(instance.status, ActivityInstance.STATUS_DONE)
+        self.assertEqual(instance.attempts, 0)
+
+    def test_errors_not_retried_are_dead_lettered(self):
+        self.failures = [KeyError()]
+        instance = self.start_flow(
+            "retry_on_flow", AsyncActivity, RetryPolicy(retry_on=[ValueError])
+        )
+        self.assertEqual(instance.status, ActivityInstance.STATUS_DEAD_LETTER)
+
+
+@override_settings(PROCESSLIB_ASYNC_EXECUTOR="processlib.executors.SynchronousExecutor")
+class TimerActivityTest(TransactionTestCase):
+    def test_timer_fires_when_due(self):
+        fired = []
+        flow = (
+            Flow("timer_flow")
+            .start_with("start", StartActivity)
+            .and_then(
+                "timer", TimerActivity, delay=timedelta(hours=1), callback=fired.append
+            )
+            .and_then("end", EndActivity)
+        )
+        start = flow.get_start_activity()
+        start.start()
+        start.finish()
+
+        timer = start.process._activity_instances.get(activity_name="timer")
+        self.assertEqual(timer.status, ActivityInstance.STATUS_SCHEDULED)
+        self.assertGreater(timer.due_at, timezone.now() + timedelta(minutes=59))
+
+        call_command("processlib_scheduler", once=True)
+        self.assertEqual(fired, [])
+
+        ActivityInstance.objects.filter(pk=timer.pk).update(due_at=timezone.now())
+        call_command("processlib_scheduler", once=True, batch_size=1)
+
+        self.assertEqual(len(fired), 1)
+        timer.refresh_from_db()
+        self.assertEqual(timer.status, ActivityInstance.STATUS_DONE)
+        self.assertEqual(
+            Process.objects.get(pk=start.process.pk).status, Process.STATUS_DONE
+        )
+
+    def test_scheduled_timer_can_be_canceled(self):
+        flow = (
+            Flow("timer_cancel_flow")
+            .start_with("start", StartActivity)
+            .and_then("timer", TimerActivity, delay=timedelta(seconds=-1))
+            .and_then("end", EndActivity)
+        )
+        start = flow.get_start_activity()
+        start.start()
+        start.finish()
+        process = Process.objects.get(pk=start.process.pk)
+        self.assertTrue(process.can_cancel())
+
+        cancel_process(process, None)
+
+        timer = process._activity_instances.get(activity_name="timer")
+        self.assertEqual(timer.status, ActivityInstance.STATUS_CANCELED)
+        self.assertIsNone(timer.due_at)
+        self.assertEqual(tasks.dispatch_due_activities(), 0)
+        self.assertEqual(
+            Process.objects.get(pk=process.pk).status, Process.STATUS_CANCELED
+        )
+
+    def test_due_callable(self):
+        due_at = timezone.now() + timedelta(days=3)
+        flow = (
+            Flow("timer_due_flow")
+            .start_with("start", StartActivity)
+            .and_then("timer", TimerActivity, due=lambda activity: due_at)
+        )
+        start = flow.get_start_activity()
+        start.start()
+        start.finish()
+
+        self.assertEqual(
+            start.process._activity_instances.get(activity_name="timer").due_at,
+            due_at,
+        )
+
+    def test_requires_delay_or_due(self):
+        with self.assertRaises(ValueError):
+            TimerActivity(flow=None, process=None, instance=None, name="timer")
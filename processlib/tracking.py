@@ -0,0 +1,63 @@
+"""
+Keeps denormalized to-do data and counters in sync with the activity
+instances and processes.
+
+The activities call track_instances after writing instances and
+track_processes after writing processes. Each instance remembers the to-do
+state (see ActivityInstance.get_to_do_state) and each process the status that
+was last written, so only actual changes are passed on.
+"""
+
+from .count_cache import (
+    count_cache_enabled,
+    invalidate_process_counts,
+    invalidate_to_do_counts,
+)
+from .counters import counters_enabled, update_flow_status_counts, update_to_do_counts
+from .inbox import inbox_enabled, update_inbox
+
+
+def track_instances(instances):
+    changes = []
+    for instance in instances:
+        old_state = getattr(instance, "_tracked_to_do_state", None)
+        new_state = instance.get_to_do_state()
+        if old_state != new_state:
+            changes.append((instance, old_state, new_state))
+            instance._tracked_to_do_state = new_state
+
+    if not changes:
+        return
+
+    if inbox_enabled():
+        update_inbox(changes)
+    if counters_enabled():
+        update_to_do_counts(changes)
+    if count_cache_enabled():
+        invalidate_to_do_counts(changes)
+
+
+def track_processes(processes, deleted=False):
+    """
+    Pass on the status changes of the processes, or their deletion.
+    """
+    changes = []
+    for process in processes:
+        old_status = getattr(process, "_tracked_status", None)
+        new_status = None if deleted else process.status
+        if old_status != new_status:
+            changes.append((process, old_status, new_status))
+            process._tracked_status = new_status
+
+    if not changes:
+        return
+
+    if counters_enabled():
+        update_flow_status_counts(changes)
+    if count_cache_enabled():
+        # new processes have no to-dos yet
+        invalidate_process_counts(
+            process
+            for process, old_status, new_status in changes
+            if old_status is not None
+        )
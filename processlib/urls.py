@@ -11,6 +11,8 @@ from processlib.views import (
     ActivityCancelView,
     ActivityRetryView,
     ProcessCancelView,
+    ProcessExportView,
+    MetricsView,
 )
 
 
@@ -27,6 +29,8 @@ urlpatterns = [
     re_path(
         r"^process/user/$", UserProcessListView.as_view(), name="process-list-user"
     ),
+    re_path(r"^process/export/$", ProcessExportView.as_view(), name="process-export"),
+    re_path(r"^metrics/$", MetricsView.as_view(), name="metrics"),
     re_path(
         r"^process/start/(?P<flow_label>.*)/$",
         ProcessStartView.as_view(),
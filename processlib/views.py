@@ -1,29 +1,50 @@
 from django.contrib import messages
-from django.core.exceptions import ImproperlyConfigured, PermissionDenied
+from django.core.exceptions import (
+    ImproperlyConfigured,
+    PermissionDenied,
+    ValidationError as DjangoValidationError,
+)
 from django.db.models import Q
-from django.http import HttpResponseRedirect
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseRedirect,
+    StreamingHttpResponse,
+)
 from django.template import TemplateDoesNotExist
+from django.template.response import TemplateResponse
 from django.template.loader import get_template
 from django.urls import reverse
 from django.utils.translation import gettext_lazy as _
 from django.views import View
 from django.views.generic import ListView, DetailView, UpdateView, TemplateView
 from rest_framework import viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
 
 from .forms import ProcessCancelForm
+from .export import EXPORT_FORMATS, get_export_queryset, iter_export
+from .export import parse_export_datetime
 from .flow import get_flows, get_flow
-from .models import Process, ActivityInstance
-from .serializers import ProcessSerializer
+from .metrics import metrics_enabled, render_metrics
+from .models import ArchivedProcess, Process, ActivityInstance
+from .pagination import CountedPaginator, InvalidCursor, KeysetPaginator
+from .serializers import ActivityInstanceSerializer, ProcessSerializer
 from .services import (
     get_activities_in_process,
     get_current_activities_in_process,
+    get_concrete_processes,
     get_user_processes,
     get_user_current_processes,
+    get_user_current_process_count,
     get_activity_for_flow,
     user_has_activity_perm,
     get_permission_filter,
+    get_permitted_flow_labels,
 )
-from .services import user_has_any_process_perm
+from .services import user_has_any_archived_process_perm, user_has_any_process_perm
 
 
 class CurrentAppMixin(object):
@@ -50,10 +71,27 @@ class ProcessListView(CurrentAppMixin, ListView):
     detail_view_name = "processlib:process-detail"
     title = _("Processes")
     paginate_by = 10
+    # paginate by (started_at, id) with cursors instead of page numbers
+    cursor_pagination = False
+    # whether cursor pagination counts the total number of processes
+    cursor_count_total = False
 
     def get_title(self):
         return self.title
 
+    def paginate_queryset(self, queryset, page_size):
+        if not self.cursor_pagination:
+            return super(ProcessListView, self).paginate_queryset(queryset, page_size)
+
+        paginator = KeysetPaginator(
+            queryset, page_size, count_total=self.cursor_count_total
+        )
+        try:
+            page = paginator.page(self.request.GET.get("cursor"))
+        except InvalidCursor:
+            raise Http404(_("Invalid cursor."))
+        return paginator, page, page.object_list, page.has_other_pages()
+
     def get_queryset(self):
         qs = super(ProcessListView, self).get_queryset()
         qs = self.filter_queryset(qs)
@@ -99,7 +137,13 @@ class ProcessListView(CurrentAppMixin, ListView):
         kwargs["search"] = self.get_search_query()
         kwargs["title"] = self.get_title()
         kwargs["detail_view_name"] = self.detail_view_name
-        return super(ProcessListView, self).get_context_data(**kwargs)
+        context = super(ProcessListView, self).get_context_data(**kwargs)
+
+        processes = get_concrete_processes(context["object_list"])
+        if context["page_obj"] is not None:
+            context["page_obj"].object_list = processes
+        context["object_list"] = context[self.context_object_name] = processes
+        return context
 
 
 class UserProcessListView(ProcessListView):
@@ -112,11 +156,75 @@ class UserProcessListView(ProcessListView):
 
 class UserCurrentProcessListView(ProcessListView):
     title = _("My current processes")
+    paginator_class = CountedPaginator
 
     def get_queryset(self):
         qs = get_user_current_processes(self.request.user)
         return self.filter_queryset(qs)
 
+    def get_paginator(self, queryset, per_page, **kwargs):
+        # unfiltered, the count is the (cached) count of the badge
+        if not self.get_search_query():
+            kwargs["count"] = get_user_current_process_count(self.request.user)
+        return super(UserCurrentProcessListView, self).get_paginator(
+            queryset, per_page, **kwargs
+        )
+
+
+class ProcessExportView(View):
+    """
+    Streams the processes the user may see with their activity timeline as
+    CSV or JSON lines, filtered by the flow, status, started_after and
+    started_before query parameters.
+    """
+
+    chunk_size = 500
+
+    def get(self, request, *args, **kwargs):
+        export_format = request.GET.get("format", "csv")
+        if export_format not in EXPORT_FORMATS:
+            return HttpResponseBadRequest(_("Unknown export format."))
+
+        flow_labels = set(get_permitted_flow_labels(request.user))
+        if request.GET.getlist("flow"):
+            flow_labels &= set(request.GET.getlist("flow"))
+
+        filters = {}
+        for name in ("started_after", "started_before"):
+            if request.GET.get(name):
+                try:
+                    filters[name] = parse_export_datetime(request.GET[name])
+                except ValueError:
+                    return HttpResponseBadRequest(_("Invalid date."))
+
+        processes = get_export_queryset(
+            flow_labels=flow_labels, statuses=request.GET.getlist("status"), **filters
+        )
+        response = StreamingHttpResponse(
+            iter_export(processes, export_format, chunk_size=self.chunk_size),
+            content_type=(
+                "text/csv" if export_format == "csv" else "application/x-ndjson"
+            ),
+        )
+        response["Content-Disposition"] = 'attachment; filename="processes.{}"'.format(
+            export_format
+        )
+        return response
+
+
+class MetricsView(View):
+    """
+    The process and activity metrics in the Prometheus text format, if
+    PROCESSLIB_METRICS is enabled. Restrict access to it in your web server.
+    """
+
+    def get(self, request, *args, **kwargs):
+        if not metrics_enabled():
+            raise Http404()
+        return HttpResponse(
+            render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8"
+        )
+
 
 class ProcessDetailView(DetailView):
     context_object_name = "process"
@@ -132,11 +240,39 @@ class ProcessDetailView(DetailView):
         names.append("processlib/process_detail.html")
         return names
 
+    archived_template_name = "processlib/process_archived_detail.html"
+
+    def get(self, request, *args, **kwargs):
+        try:
+            return super(ProcessDetailView, self).get(request, *args, **kwargs)
+        except Http404:
+            # fall back to processes moved away by processlib.archive
+            self.object = self.get_archived_object()
+            return TemplateResponse(
+                request,
+                self.archived_template_name,
+                {
+                    "process": self.object,
+                    "activities": self.object.activities,
+                    "list_view_name": self.list_view_name,
+                    "return_to": self.get_return_to_url(),
+                },
+            )
+
     def get_object(self, queryset=None):
         process = super(ProcessDetailView, self).get_object(queryset)
         if not user_has_any_process_perm(self.request.user, process):
             raise PermissionDenied
-        return process.flow.process_model.objects.get(pk=process.id)
+        return process.full
+
+    def get_archived_object(self):
+        try:
+            archived_process = ArchivedProcess.objects.get(pk=self.kwargs["pk"])
+        except (ArchivedProcess.DoesNotExist, DjangoValidationError):
+            raise Http404(_("No process found matching the query"))
+        if not user_has_any_archived_process_perm(self.request.user, archived_process):
+            raise PermissionDenied
+        return archived_process
 
     def get_extra_detail_template_name(self):
         template_name = "processlib/extra_detail_{}.html".format(self.object.flow.label)
@@ -186,7 +322,7 @@ class ProcessCancelView(UpdateView):
         process = super(ProcessCancelView, self).get_object(queryset)
         if not user_has_any_process_perm(self.request.user, process):
             raise PermissionDenied
-        return process.flow.process_model.objects.get(pk=process.id)
+        return process.full
 
     def form_valid(self, form):
         from .services import cancel_process
@@ -386,6 +522,73 @@ class ProcessViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         return self.get_process_model()._default_manager.all()
 
+    @action(detail=False, methods=["post"])
+    def bulk(self, request):
+        """
+        Start a process for each item of rows, all of the flow given by flow_label.
+
+        Responds with the ids of the started processes and the errors by row index.
+        The start activities are finished by the requesting user, activity_data
+        is not supported.
+        """
+        try:
+            flow = get_flow(request.data.get("flow_label"))
+        except KeyError:
+            raise ValidationError({"flow_label": [_("Unknown flow.")]})
+        rows = request.data.get("rows")
+        if not isinstance(rows, list):
+            raise ValidationError({"rows": [_("Expected a list of processes.")]})
+        if "activity_data" in request.data or any(
+            isinstance(row, dict) and "activity_data" in row for row in rows
+        ):
+            raise ValidationError(
+                {"activity_data": [_("Not supported when starting in bulk.")]}
+            )
+
+        start = flow._get_activity_by_name(None, flow.compile().names[0])
+        if not user_has_activity_perm(request.user, start):
+            raise PermissionDenied
+
+        activity_instance = ActivityInstanceSerializer(
+            data=request.data.get("activity_instance", {})
+        )
+        activity_instance.is_valid(raise_exception=True)
+
+        serializer_class = self.get_serializer_class()
+        valid_rows = []
+        row_indexes = []
+        errors = {}
+        for i, data in enumerate(rows):
+            serializer = serializer_class(
+                data=dict(data, flow_label=flow.label),
+                context=self.get_serializer_context(),
+            )
+            if not serializer.is_valid():
+                errors[i] = serializer.errors
+                continue
+            values = dict(serializer.validated_data)
+            for field in ("flow_label", "activity_instance"):
+                values.pop(field, None)
+            valid_rows.append(values)
+            row_indexes.append(i)
+
+        processes, start_errors = flow.start_many(
+            valid_rows,
+            activity_instance_kwargs=activity_instance.validated_data,
+            user=request.user if request.user.is_authenticated else None,
+        )
+        for i, error in start_errors.items():
+            errors[row_indexes[i]] = getattr(error, "message_dict", [str(error)])
+
+        return Response(
+            {
+                "created": [
+                    str(process.pk) for process in processes if process is not None
+                ],
+                "errors": {str(i): errors[i] for i in sorted(errors)},
+            }
+        )
+
     def get_serializer_class(self):
         if self.request.data.get("flow_label") in self.serializer_class_overrides:
             return self.serializer_class_overrides[self.request.data["flow_label"]]